@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+    Codec benchmarks - measure throughput (packets/sec) and allocations
+    per packet for DNSRecord.parse/pack and DNSBuffer.decode_name/
+    encode_name
+
+    The corpus consists of the Wireshark captures from dnslib.dns.test_unpack
+    together with synthetic large responses (many A/MX/NAPTR/TXT RRs and
+    deep compression chains)
+
+    Results are written as JSON - a previous results file can be passed
+    with --compare to flag regressions (exit status is 1 if any benchmark
+    is slower than the previous run by more than --threshold)
+
+    Allocation counts use tracemalloc where available - otherwise (py2)
+    the number of gc tracked objects (instances/lists/dicts/tuples)
+    created by the benchmark and still referenced by its results is
+    counted (allocs_method in the results shows which was used)
+
+    Usage:
+
+    # python benchmarks/bench_codec.py --output=before.json
+    ...
+    # python benchmarks/bench_codec.py --compare=before.json
+
+"""
+
+import gc,json,optparse,os,platform,re,sys,time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from dnslib import A, MX, NAPTR, TXT, RR, DNSHeader, DNSQuestion, DNSRecord, QTYPE
+from dnslib.dns import test_unpack, RR as DNSRR
+from dnslib.label import DNSBuffer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def wireshark_corpus():
+    """
+        Packets from the test_unpack doctest
+    """
+    return [ h.decode('hex') for h in
+                    re.findall(r"unpack\('([0-9a-f]+)'\)",test_unpack.__doc__) ]
+
+def synthetic_corpus():
+    """
+        Large synthetic responses
+    """
+    corpus = {}
+    def response(qname,qtype):
+        return DNSRecord(DNSHeader(id=1,qr=1,aa=1,ra=1),
+                         q=DNSQuestion(qname,qtype))
+    d = response("many-a.example.com",QTYPE.A)
+    for i in range(100):
+        d.add_answer(RR("many-a.example.com",QTYPE.A,ttl=300,
+                        rdata=A("10.0.%d.%d" % (i // 256,i % 256))))
+    corpus['many_a'] = d.pack()
+    d = response("example.com",QTYPE.MX)
+    for i in range(50):
+        d.add_answer(RR("example.com",QTYPE.MX,ttl=300,
+                        rdata=MX("mx%d.mail.example.com" % i,i)))
+    corpus['many_mx'] = d.pack()
+    d = response("example.com",QTYPE.NAPTR)
+    for i in range(20):
+        d.add_answer(RR("example.com",QTYPE.NAPTR,ttl=300,
+                        rdata=NAPTR(i,100,"s","SIP+D2U","",
+                                    "_sip._udp.example.com")))
+    corpus['many_naptr'] = d.pack()
+    d = response("example.com",QTYPE.TXT)
+    for i in range(50):
+        d.add_answer(RR("example.com",QTYPE.TXT,ttl=300,
+                        rdata=TXT("v=spf1 include:_spf%d.example.com ~all" % i)))
+    corpus['many_txt'] = d.pack()
+    # Each name is a child of the previous one (every name is compressed
+    # against its parent)
+    d = response("example.com",QTYPE.A)
+    name = "example.com"
+    for i in range(60):
+        name = "l%d.%s" % (i,name)
+        d.add_answer(RR(name,QTYPE.A,ttl=300,rdata=A("192.0.2.1")))
+    corpus['deep_compression'] = d.pack()
+    return corpus
+
+def corpus():
+    result = { 'wireshark': wireshark_corpus() }
+    for k,v in synthetic_corpus().items():
+        result[k] = [v]
+    return result
+
+class OffsetBuffer(DNSBuffer):
+
+    """
+        DNSBuffer which records the offset of each name decoded (not
+        including names reached through compression pointers)
+    """
+
+    def __init__(self,data):
+        super(OffsetBuffer,self).__init__(data)
+        self.offsets = []
+        self.depth = 0
+
+    def decode_name(self):
+        if not self.depth:
+            self.offsets.append(self.offset)
+        self.depth += 1
+        try:
+            return super(OffsetBuffer,self).decode_name()
+        finally:
+            self.depth -= 1
+
+def name_offsets(packet):
+    """
+        Offsets of all names in packet - question names, RR owner names
+        and names in rdata
+    """
+    b = OffsetBuffer(packet)
+    header = DNSHeader.parse(b)
+    for i in range(header.q):
+        DNSQuestion.parse(b)
+    for i in range(header.a + header.ns + header.ar):
+        DNSRR.parse(b)
+    return b.offsets
+
+# Benchmark functions return their results so that they are still
+# referenced when allocations are counted
+
+def bench_parse(packets):
+    def run():
+        return [ DNSRecord.parse(p) for p in packets ]
+    return run
+
+def bench_parse_lazy(packets):
+    def run():
+        return [ DNSRecord.parse(p,lazy=True) for p in packets ]
+    return run
+
+def bench_pack(packets):
+    records = [DNSRecord.parse(p) for p in packets]
+    def run():
+        result = []
+        for r in records:
+            # Invalidate cached packed data
+            r._packed = None
+            result.append(r.pack())
+        return result
+    return run
+
+def bench_decode_name(packets):
+    names = [ (p,name_offsets(p)) for p in packets ]
+    def run():
+        result = []
+        for p,offsets in names:
+            b = DNSBuffer(p)
+            for offset in offsets:
+                b.offset = offset
+                result.append(b.decode_name())
+        return result
+    return run
+
+def bench_encode_name(packets):
+    names = []
+    for p in packets:
+        r = DNSRecord.parse(p)
+        names.append([q.qname for q in r.questions] +
+                     [rr.rname for rr in r.rr + r.ns + r.ar])
+    def run():
+        result = []
+        for n in names:
+            b = DNSBuffer()
+            for name in n:
+                b.encode_name(name)
+            result.append(b)
+        return result
+    return run
+
+BENCHMARKS = [ ('parse',bench_parse), ('parse_lazy',bench_parse_lazy),
+               ('pack',bench_pack), ('decode_name',bench_decode_name),
+               ('encode_name',bench_encode_name) ]
+
+def measure(run,count,mintime):
+    """
+        Return (packets/sec,allocations/packet) for benchmark function
+        processing count packets per call
+    """
+    run()
+    n = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < mintime:
+        run()
+        n += 1
+        elapsed = time.time() - start
+    pps = n * count / elapsed
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        result = run()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        diff = after.compare_to(before,'lineno')
+        allocs = sum([max(s.count_diff,0) for s in diff]) / float(count)
+    else:
+        enabled = gc.isenabled()
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            result = run()
+            # Exclude the result list itself
+            allocs = (len(gc.get_objects()) - before - 1) / float(count)
+        finally:
+            if enabled:
+                gc.enable()
+    del result
+    return pps,allocs
+
+def run_benchmarks(mintime,only=None):
+    results = {}
+    for corpus_name,packets in sorted(corpus().items()):
+        for bench_name,bench in BENCHMARKS:
+            if only and bench_name not in only:
+                continue
+            pps,allocs = measure(bench(packets),len(packets),mintime)
+            results["%s/%s" % (bench_name,corpus_name)] = {
+                            'pps': round(pps,1),
+                            'allocs_per_packet': allocs }
+    return results
+
+def compare(results,previous,threshold):
+    """
+        Return list of (name,previous pps,current pps) for benchmarks
+        slower than previous by more than threshold
+    """
+    regressions = []
+    for name,result in sorted(results.items()):
+        old = previous.get(name)
+        if old and result['pps'] < old['pps'] * (1 - threshold):
+            regressions.append((name,old['pps'],result['pps']))
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--output",help="Write JSON results to file (default: stdout)")
+    parser.add_option("--compare",help="Compare with previous JSON results")
+    parser.add_option("--threshold",type=float,default=0.1,
+                      help="Regression threshold (default: 0.1)")
+    parser.add_option("--time",type=float,default=1.0,
+                      help="Minimum time per benchmark in seconds (default: 1.0)")
+    parser.add_option("--bench",action="append",
+                      help="Run selected benchmark (may be repeated)")
+    options,args = parser.parse_args()
+
+    results = { 'python': platform.python_version(),
+                'dnslib': DNSRecord.version,
+                'timestamp': int(time.time()),
+                'allocs_method': tracemalloc and 'tracemalloc' or 'gc',
+                'results': run_benchmarks(options.time,options.bench) }
+
+    data = json.dumps(results,indent=2,sort_keys=True)
+    if options.output:
+        open(options.output,"w").write(data + "\n")
+    else:
+        print data
+
+    if options.compare:
+        previous = json.load(open(options.compare))['results']
+        regressions = compare(results['results'],previous,options.threshold)
+        for name,old,new in regressions:
+            print >>sys.stderr, "REGRESSION %-32s %10.1f -> %10.1f pps (%+.1f%%)" % (
+                                    name,old,new,(new - old) * 100.0 / old)
+        if regressions:
+            sys.exit(1)
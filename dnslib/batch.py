@@ -0,0 +1,173 @@
+
+"""
+    Vectorised header/question statistics over packet batches (requires
+    NumPy)
+
+    A batch is a contiguous buffer containing the packed messages and an
+    array of n+1 offsets (message i is data[offsets[i]:offsets[i+1]]).
+    HeaderBatch decodes the header fields of every message as NumPy
+    arrays in a single pass and locates the qtype/qclass of the first
+    question (the qname is skipped one label at a time for all messages
+    at once) - no DNSHeader/DNSQuestion objects are created.
+
+    >>> packets = []
+    >>> for i,(qname,qtype) in enumerate([("abc.com","A"),("www.abc.com","MX"),
+    ...                                   ("xyz.com","AAAA")]):
+    ...     q = DNSRecord(DNSHeader(id=i,rd=1),q=DNSQuestion(qname,getattr(QTYPE,qtype)))
+    ...     packets.append(q.pack())
+    ...     a = RR(qname,rdata=A("1.2.3.4"))
+    ...     packets.append(DNSRecord(DNSHeader(id=i,qr=1,rd=1),q=q.q,a=a).pack())
+    >>> r = DNSRecord(DNSHeader(id=9,qr=1,rcode=3,tc=1),q=DNSQuestion("abc.org"))
+    >>> packets.append(r.pack())
+    >>> packets.append("\\x00\\x01\\x00")
+    >>> b = HeaderBatch(*make_batch(packets))
+    >>> len(b)
+    8
+    >>> list(b.id)
+    [0, 0, 1, 1, 2, 2, 9, -1]
+    >>> list(b.qr), list(b.rd), list(b.tc)
+    ([0, 1, 0, 1, 0, 1, 1, -1], [1, 1, 1, 1, 1, 1, 1, -1], [0, 0, 0, 0, 0, 0, 1, -1])
+    >>> list(b.an)
+    [0, 1, 0, 1, 0, 1, 0, -1]
+    >>> list(b.qtype)
+    [1, 1, 15, 15, 28, 28, 1, -1]
+    >>> list(b.qclass)
+    [1, 1, 1, 1, 1, 1, 1, -1]
+    >>> sorted(b.rcode_counts().items())
+    [('Name Error', 1), ('None', 3)]
+    >>> sorted(b.qtype_counts().items())
+    [('A', 1), ('AAAA', 1), ('MX', 1)]
+    >>> sorted(b.qtype_counts(responses=True).items())
+    [('A', 2), ('AAAA', 1), ('MX', 1)]
+    >>> b.flag_rate('tc',responses=True)
+    0.25
+
+"""
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,RR,A,QTYPE,RCODE
+
+# Header fields as (name,word,shift,mask)
+FLAGS = [ ('qr',1,15,0x1), ('opcode',1,11,0xf), ('aa',1,10,0x1),
+          ('tc',1,9,0x1), ('rd',1,8,0x1), ('ra',1,7,0x1),
+          ('ad',1,5,0x1), ('cd',1,4,0x1), ('rcode',1,0,0xf) ]
+COUNTS = [ ('qd',2), ('an',3), ('ns',4), ('ar',5) ]
+
+def make_batch(packets):
+    """
+        Return (data,offsets) batch from list of packed messages
+    """
+    offsets = numpy.zeros(len(packets) + 1,dtype=numpy.int64)
+    numpy.cumsum([ len(p) for p in packets ],out=offsets[1:])
+    return "".join(packets),offsets
+
+class HeaderBatch(object):
+
+    """
+    Header fields (id, qr, opcode, aa, tc, rd, ra, ad, cd, rcode, qd, an,
+    ns, ar) and first question qtype/qclass for a batch of messages as
+    int32 arrays - messages which are too short to contain a header
+    (or question) have the corresponding fields set to -1.
+
+    Note that numpy.frombuffer does not copy data (so data may be an
+    mmap of a packet log).
+    """
+
+    def __init__(self,data,offsets):
+        self.offsets = offsets = numpy.asarray(offsets,dtype=numpy.int64)
+        self.data = buf = numpy.frombuffer(data,dtype=numpy.uint8)
+        starts = offsets[:-1]
+        ends = offsets[1:]
+        self.valid = valid = (ends - starts) >= 12
+        # Gather header bytes as (n,12) array (short messages read from
+        # offset 0 and are masked)
+        index = numpy.where(valid,starts,0)[:,None] + numpy.arange(12)
+        header = buf[numpy.minimum(index,max(len(buf) - 1,0))].astype(numpy.int32)
+        words = (header[:,0::2] << 8) | header[:,1::2]
+        words[~valid] = -1
+        self.id = words[:,0]
+        for name,word,shift,mask in FLAGS:
+            setattr(self,name,numpy.where(valid,(words[:,word] >> shift) & mask,-1))
+        for name,word in COUNTS:
+            setattr(self,name,words[:,word])
+        self._decode_question(buf,starts,ends)
+
+    def _decode_question(self,buf,starts,ends):
+        """
+            Skip first qname (vectorised over labels) and extract
+            qtype/qclass
+        """
+        last = max(len(buf) - 1,0)
+        pos = starts + 12
+        active = self.valid & (self.qd > 0) & (pos < ends)
+        ok = active.copy()
+        for i in xrange(128):
+            if not active.any():
+                break
+            length = buf[numpy.minimum(pos,last)].astype(numpy.int64)
+            # Root label - end of name
+            done = active & (length == 0)
+            pos = numpy.where(done,pos + 1,pos)
+            # Compression pointer - end of name
+            pointer = active & ((length & 0xc0) == 0xc0)
+            pos = numpy.where(pointer,pos + 2,pos)
+            # Reserved label types
+            bad = active & ((length & 0xc0) != 0) & ~pointer
+            ok &= ~bad
+            active &= ~(done | pointer | bad)
+            pos = numpy.where(active,pos + length + 1,pos)
+            overrun = active & (pos >= ends)
+            ok &= ~overrun
+            active &= ~overrun
+        ok &= ~active & (pos + 4 <= ends)
+        q = numpy.where(ok,pos,0)[:,None] + numpy.arange(4)
+        tail = buf[numpy.minimum(q,last)].astype(numpy.int32)
+        self.qtype = numpy.where(ok,(tail[:,0] << 8) | tail[:,1],-1)
+        self.qclass = numpy.where(ok,(tail[:,2] << 8) | tail[:,3],-1)
+
+    def __len__(self):
+        return len(self.id)
+
+    def select(self,responses):
+        """
+            Return mask selecting queries (responses=False) or
+            responses (responses=True)
+        """
+        return self.qr == (responses and 1 or 0)
+
+    def flag_rate(self,flag,responses=False):
+        """
+            Return fraction of queries/responses with flag set
+        """
+        mask = self.select(responses)
+        total = mask.sum()
+        return total and float(getattr(self,flag)[mask].sum()) / total or 0.0
+
+    def rcode_counts(self):
+        """
+            Return dict of rcode mnemonic -> count for responses
+        """
+        counts = numpy.bincount(self.rcode[self.select(True)],minlength=16)
+        return dict([ (RCODE.lookup(i,str(i)),int(c))
+                        for i,c in enumerate(counts) if c ])
+
+    def qtype_counts(self,responses=False):
+        """
+            Return dict of qtype mnemonic -> count for queries (or
+            responses)
+        """
+        qtype = self.qtype[self.select(responses) & (self.qtype >= 0)]
+        values,counts = numpy.unique(qtype,return_counts=True)
+        return dict([ (QTYPE.lookup(int(v),str(v)),int(c))
+                        for v,c in zip(values,counts) ])
+
+if __name__ == '__main__':
+    if numpy is not None:
+        import doctest
+        doctest.testmod()
@@ -0,0 +1,174 @@
+
+"""
+    Parallel bulk decoding of large captures
+
+    The capture (pcap/pcapng) is mmap'd and split into chunks in the
+    parent process (PcapReader.chunks() only reads the record headers) -
+    each chunk is a byte range of the capture (start,end,reader state)
+    and chunks are generated as they are passed to a process pool (the
+    parent never holds a per-frame index). Each worker maps the same
+    capture, reads the frames in its byte ranges and folds the DNS
+    messages into a reducer state.
+    Only the (compact) reducer states are returned to the parent where
+    they are merged - packet data and DNSRecord objects are never pickled.
+
+    A reducer defines:
+
+        start()                         - return empty state
+        add(state,ts,src,dst,message)   - fold raw DNS message into state
+                                          (and return state)
+        merge(a,b)                      - merge states (and return result)
+
+    The default reducer (QuestionCounter) counts queries by (qname,qtype)
+    using wire.parse_question (no DNSRecord is built).
+
+    >>> import StringIO
+    >>> from pcap import write_pcap, udp_packet
+    >>> client,server = ("10.0.0.1",1234),("10.0.0.2",53)
+    >>> packets = []
+    >>> for i,(qname,qtype) in enumerate([("abc.com","A"),("ABC.com","A"),
+    ...                                   ("abc.com","MX"),("xyz.com","A")]):
+    ...     q = DNSRecord(DNSHeader(id=i),q=DNSQuestion(qname,getattr(QTYPE,qtype)))
+    ...     packets.append((i,udp_packet(client,server,q.pack())))
+    ...     r = DNSRecord(DNSHeader(id=i,qr=1),q=q.q)
+    ...     packets.append((i,udp_packet(server,client,r.pack())))
+    >>> f = StringIO.StringIO()
+    >>> write_pcap(f,packets)
+    >>> counts = bulk_decode(data=f.getvalue(),processes=2,chunksize=3)
+    >>> sorted(counts.items())
+    [(('abc.com', 1), 2), (('abc.com', 15), 1), (('xyz.com', 1), 1)]
+
+    Custom reducer (must be picklable - ie. defined at module level):
+
+    >>> sorted(bulk_decode(reducer=RcodeCounter(),processes=1,data=f.getvalue()).items())
+    [(0, 4)]
+
+"""
+
+import itertools,struct
+
+from collections import Counter
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,DNSError,QTYPE
+from pcap import PcapReader,decode_ip,decode_link
+from wire import parse_question
+
+class Reducer(object):
+
+    """
+    Reducer base class - state is a Counter (subclasses implement
+    add to update counts)
+    """
+
+    def start(self):
+        return Counter()
+
+    def add(self,state,ts,src,dst,message):
+        return state
+
+    def merge(self,a,b):
+        a.update(b)
+        return a
+
+class QuestionCounter(Reducer):
+
+    """
+    Count queries (QR=0) by (lowercase qname,qtype)
+    """
+
+    def add(self,state,ts,src,dst,message):
+        try:
+            id,flags,wire,qname,qtype,qclass,end = parse_question(message)
+        except DNSError:
+            return state
+        if not flags & 0x8000:
+            state[(qname,qtype)] += 1
+        return state
+
+class RcodeCounter(Reducer):
+
+    """
+    Count responses (QR=1) by rcode
+    """
+
+    def add(self,state,ts,src,dst,message):
+        if len(message) >= 12:
+            (flags,) = struct.unpack("!H",message[2:4])
+            if flags & 0x8000:
+                state[flags & 0x000f] += 1
+        return state
+
+def decode_frames(data,frames,reducer,state=None):
+    """
+        Decode UDP DNS messages from frames - iterable of (timestamp,
+        linktype,offset,length) - in data and fold into reducer state
+
+        TCP segments are skipped (streams cannot be reassembled
+        independently in each chunk)
+    """
+    if state is None:
+        state = reducer.start()
+    add = reducer.add
+    for ts,linktype,offset,length in frames:
+        ip = decode_link(linktype,data[offset:offset + length])
+        if ip is None:
+            continue
+        decoded = decode_ip(ip)
+        if decoded is None:
+            continue
+        src,dst,proto,payload = decoded
+        if proto == 17 and len(payload) >= 8:
+            sport,dport = struct.unpack("!HH",payload[:4])
+            state = add(state,ts,(src,sport),(dst,dport),payload[8:])
+    return state
+
+# Per-worker state (set by _init_worker)
+_worker = {}
+
+def _init_worker(path,data,reducer):
+    _worker['reader'] = PcapReader(path,data=data)
+    _worker['reducer'] = reducer
+
+def _run_worker(chunk):
+    reader = _worker['reader']
+    return decode_frames(reader.data,reader.records(*chunk),_worker['reducer'])
+
+def bulk_decode(path=None,reducer=None,processes=None,chunksize=10000,
+                data=None):
+    """
+        Decode capture (file path or data buffer) using a pool of processes
+        (default: number of CPUs) and return merged reducer state
+        (default reducer: QuestionCounter)
+
+        Each worker task is a byte range of the capture containing
+        chunksize frames. With processes=1 (or a single chunk) the
+        capture is decoded in the calling process.
+    """
+    reducer = reducer or QuestionCounter()
+    reader = PcapReader(path,data=data)
+    try:
+        chunks = reader.chunks(chunksize)
+        first = list(itertools.islice(chunks,2))
+        if processes == 1 or len(first) <= 1:
+            return decode_frames(reader.data,reader.records(),reducer)
+        import multiprocessing
+        pool = multiprocessing.Pool(processes,_init_worker,
+                                    (path,data,reducer))
+        try:
+            result = reducer.start()
+            for state in pool.imap_unordered(_run_worker,
+                                             itertools.chain(first,chunks)):
+                result = reducer.merge(result,state)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return result
+    finally:
+        reader.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,790 @@
+
+"""
+    Simple response cache keyed by (qname,qtype) with support for the
+    EDNS Client Subnet option (RFC 7871) and serving stale data
+    (RFC 8767)
+
+    The cache can be saved to a snapshot file (and saved periodically by
+    CacheSnapshot) so that it can be reloaded after a restart. Each entry
+    is stored as a fixed header (absolute expiry time, TTL, qtype, ECS
+    prefix, lengths) followed by the key labels and the packed response -
+    loading a snapshot (using mmap) skips expired entries using the header
+    only and does not parse the packed responses.
+
+    Responses are cached without OPT RRs (the EDNS/ECS data belongs to
+    the request which caused the response) - the OPT RR for each client
+    is built from its request (response_opt) and appended when the cached
+    response is returned (CacheEntry.get_packet).
+"""
+
+import mmap,os,socket,struct,threading,time
+
+from collections import OrderedDict
+
+from buffer import Buffer
+from dns import DNSRecord,DNSHeader,DNSQuestion,DNSError,EDNSOption,RR,A,MX,QTYPE
+from label import DNSLabel,DNSBuffer
+from wire import DNSWire
+
+ECS_OPTION = 8
+
+FAMILY = { 1:(socket.AF_INET,4), 2:(socket.AF_INET6,16) }
+
+SNAPSHOT_MAGIC = "DNSCSNP1"
+# expires,ttl,qtype,family,prefixlen,key length,packet length
+SNAPSHOT_RECORD = struct.Struct("!dIHBBHH")
+
+class ClientSubnet(object):
+
+    """
+    EDNS Client Subnet option (RFC 7871)
+
+    The address is stored in packed (network) form with any bits beyond
+    the source prefix length cleared.
+
+    >>> ecs = ClientSubnet("192.0.2.99",24)
+    >>> ecs
+    <ClientSubnet: 192.0.2.0/24 scope=0>
+    >>> ecs.pack().encode('hex')
+    '00011800c00002'
+    >>> ClientSubnet.parse(ecs.pack())
+    <ClientSubnet: 192.0.2.0/24 scope=0>
+    >>> ClientSubnet("2001:db8::1",56,48)
+    <ClientSubnet: 2001:db8::/56 scope=48>
+
+    Extract option from a DNSRecord (returns None if not present):
+
+    >>> q = DNSRecord(q=DNSQuestion("abc.com"))
+    >>> ClientSubnet.from_record(q) is None
+    True
+    >>> q.add_ar(RR("",QTYPE.OPT,4096,rdata=[ecs.option()]))
+    >>> ClientSubnet.from_record(DNSRecord.parse(q.pack()))
+    <ClientSubnet: 192.0.2.0/24 scope=0>
+
+    """
+
+    @classmethod
+    def parse(cls,data):
+        """
+            Parse ECS option data
+        """
+        buffer = Buffer(data)
+        family,source,scope = buffer.unpack("!HBB")
+        if family not in FAMILY:
+            raise DNSError("Invalid ECS family: %d" % family)
+        af,length = FAMILY[family]
+        if source > length * 8 or scope > length * 8:
+            raise DNSError("Invalid ECS prefix length: %d/%d" % (source,scope))
+        address = buffer.get(buffer.remaining())
+        if len(address) != (source + 7) // 8:
+            raise DNSError("Invalid ECS address length: %d" % len(address))
+        return cls(address.ljust(length,'\x00'),source,scope,family)
+
+    @classmethod
+    def from_record(cls,record):
+        """
+            Return ClientSubnet from OPT record in additional section
+            of DNSRecord (or None)
+        """
+        for rr in record.ar:
+            if rr.rtype == QTYPE.OPT:
+                for option in rr.rdata:
+                    if option.code == ECS_OPTION:
+                        return cls.parse(option.data)
+        return None
+
+    def __init__(self,address,source=None,scope=0,family=None):
+        """
+            Create ClientSubnet from address (either as text or packed
+            if family is specified)
+        """
+        if family is None:
+            family = ':' in address and 2 or 1
+            address = socket.inet_pton(FAMILY[family][0],address)
+        af,length = FAMILY[family]
+        if source is None:
+            source = length * 8
+        self.family = family
+        self.source = source
+        self.scope = scope
+        self.address = mask(address,source)
+
+    def pack(self):
+        """
+            Pack option data
+        """
+        return struct.pack("!HBB",self.family,self.source,self.scope) + \
+               self.address[:(self.source + 7) // 8]
+
+    def option(self):
+        """
+            Return as EDNSOption
+        """
+        return EDNSOption(ECS_OPTION,self.pack())
+
+    def __repr__(self):
+        return "<ClientSubnet: %s/%d scope=%d>" % (
+                    socket.inet_ntop(FAMILY[self.family][0],self.address),
+                    self.source,self.scope)
+
+def mask(address,prefixlen):
+    """
+        Clear bits in packed address beyond prefixlen
+
+        >>> mask('\\xc0\\x00\\x02\\xff',20).encode('hex')
+        'c0000000'
+    """
+    full,partial = divmod(prefixlen,8)
+    result = address[:full]
+    if partial:
+        result += chr(ord(address[full]) & (0xff << (8 - partial)) & 0xff)
+    return result.ljust(len(address),'\x00')
+
+def pack_labels(labels):
+    """
+        Encode label tuple (length prefixed labels)
+
+        >>> unpack_labels(pack_labels(('www','abc','com')))
+        ('www', 'abc', 'com')
+    """
+    return "".join([ chr(len(l)) + l for l in labels ])
+
+def unpack_labels(data):
+    """
+        Decode label tuple encoded by pack_labels
+    """
+    labels = []
+    offset = 0
+    while offset < len(data):
+        length = ord(data[offset])
+        labels.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    return tuple(labels)
+
+def response_ttl(record):
+    """
+        Cache TTL for record - minimum TTL of answer/authority RRs
+        (for negative responses use SOA minimum - RFC2308)
+    """
+    ttls = [rr.ttl for rr in record.rr]
+    for rr in record.ns:
+        if rr.rtype == QTYPE.SOA and not record.rr:
+            ttls.append(min(rr.ttl,rr.rdata.times[-1]))
+        else:
+            ttls.append(rr.ttl)
+    return ttls and min(ttls) or 0
+
+def cache_packet(record):
+    """
+        Packed response for caching - OPT RRs are removed (the record
+        itself is not modified)
+
+        >>> r = DNSRecord(DNSHeader(qr=1),q=DNSQuestion("abc.com"),
+        ...               a=RR("abc.com",rdata=A("1.2.3.4"),ttl=60))
+        >>> r.add_ar(RR("",QTYPE.OPT,4096,rdata=[ClientSubnet("10.1.2.3",24).option()]))
+        >>> d = DNSRecord.parse(cache_packet(r))
+        >>> d.header.a, d.header.ar, d.ar
+        (1, 0, [])
+        >>> len(r.ar), r.header.ar
+        (1, 1)
+    """
+    ar = [ rr for rr in record.ar if rr.rtype != QTYPE.OPT ]
+    if len(ar) == len(record.ar):
+        return record.pack()
+    header = DNSHeader(id=record.header.id,bitmap=record.header.bitmap)
+    return DNSRecord(header,questions=list(record.questions),rr=list(record.rr),
+                     ns=list(record.ns),ar=ar).pack()
+
+def response_opt(request,scope=0,udp_size=4096):
+    """
+        Packed OPT RR for a response to request (or None if the request
+        has no OPT RR) - the request ECS option (if any) is echoed with
+        scope set (RFC 7871 7.2.1)
+
+        >>> q = DNSRecord(q=DNSQuestion("abc.com"))
+        >>> response_opt(q) is None
+        True
+        >>> q.add_ar(RR("",QTYPE.OPT,1232,rdata=[ClientSubnet("10.1.2.3",24).option()]))
+        >>> response_opt(q,16).encode('hex')
+        '000029100000000000000b00080007000118100a0102'
+    """
+    for rr in request.ar:
+        if rr.rtype == QTYPE.OPT:
+            break
+    else:
+        return None
+    options = []
+    subnet = ClientSubnet.from_record(request)
+    if subnet is not None:
+        subnet.scope = scope
+        options.append(subnet.option())
+    buffer = DNSBuffer()
+    RR("",QTYPE.OPT,udp_size,rdata=options).pack(buffer)
+    return buffer.data
+
+class PrefixTree(object):
+
+    """
+    Binary trie mapping address prefixes to values. Lookups return the
+    value stored against the longest prefix matching the address.
+
+    Nodes are stored as [zero,one,value] lists.
+
+    >>> t = PrefixTree()
+    >>> t.insert('\\x0a\\x00\\x00\\x00',8,'ten')
+    >>> t.insert('\\x0a\\x01\\x00\\x00',16,'ten-one')
+    >>> t.insert('\\x00\\x00\\x00\\x00',0,'default')
+    >>> t.lookup('\\x0a\\x01\\x02\\x03')
+    'ten-one'
+    >>> t.lookup('\\x0a\\x02\\x02\\x03')
+    'ten'
+    >>> t.lookup('\\x0b\\x00\\x00\\x00')
+    'default'
+    >>> t.matches('\\x0a\\x01\\x02\\x03')
+    ['ten-one', 'ten', 'default']
+    >>> len(t)
+    3
+    >>> t.remove('\\x0a\\x01\\x00\\x00',16)
+    True
+    >>> t.lookup('\\x0a\\x01\\x02\\x03')
+    'ten'
+    >>> len(t)
+    2
+
+    """
+
+    def __init__(self):
+        self.root = [None,None,None]
+        self.count = 0
+
+    def _bits(self,address,prefixlen):
+        n = int(address.encode('hex'),16)
+        shift = len(address) * 8 - 1
+        return [(n >> (shift - i)) & 1 for i in xrange(prefixlen)]
+
+    def insert(self,address,prefixlen,value):
+        """
+            Store value against address/prefixlen
+        """
+        node = self.root
+        for bit in self._bits(address,prefixlen):
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None,None,None]
+            node = child
+        if node[2] is None:
+            self.count += 1
+        node[2] = value
+
+    def lookup(self,address,prefixlen=None):
+        """
+            Return value for longest prefix matching address (limited to
+            prefixlen bits if specified) or None
+        """
+        if prefixlen is None:
+            prefixlen = len(address) * 8
+        node = self.root
+        match = node[2]
+        for bit in self._bits(address,prefixlen):
+            node = node[bit]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+        return match
+
+    def matches(self,address,prefixlen=None):
+        """
+            Return values for all prefixes matching address (limited to
+            prefixlen bits if specified) - longest prefix first
+        """
+        if prefixlen is None:
+            prefixlen = len(address) * 8
+        node = self.root
+        result = node[2] is not None and [node[2]] or []
+        for bit in self._bits(address,prefixlen):
+            node = node[bit]
+            if node is None:
+                break
+            if node[2] is not None:
+                result.append(node[2])
+        result.reverse()
+        return result
+
+    def remove(self,address,prefixlen):
+        """
+            Remove value stored against address/prefixlen (returns True
+            if found). Empty branches are pruned.
+        """
+        path = []
+        node = self.root
+        for bit in self._bits(address,prefixlen):
+            path.append((node,bit))
+            node = node[bit]
+            if node is None:
+                return False
+        if node[2] is None:
+            return False
+        node[2] = None
+        self.count -= 1
+        while path and node == [None,None,None]:
+            parent,bit = path.pop()
+            parent[bit] = None
+            node = parent
+        return True
+
+    def values(self):
+        """
+            Return all stored values
+        """
+        result = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node[2] is not None:
+                result.append(node[2])
+            stack.extend([n for n in node[:2] if n is not None])
+        return result
+
+    def __len__(self):
+        return self.count
+
+class CacheEntry(object):
+
+    """
+        Cached response (stored in packed form together with a DNSWire
+        view - created on first use - so that it can be rewritten
+        without a parse/pack)
+
+        hits counts lookups returning the entry, refreshing/failed are
+        used by CachingResolver to track background refresh and upstream
+        failures.
+    """
+
+    def __init__(self,packet,ttl,now,prefix=None):
+        self.packet = packet
+        self._wire = None
+        self.ttl = ttl
+        self.created = now
+        self.expires = now + ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.refreshing = False
+        self.failed = None
+
+    def get_wire(self):
+        if self._wire is None:
+            self._wire = DNSWire(self.packet)
+        return self._wire
+
+    wire = property(get_wire)
+
+    def valid(self,now,stale=0):
+        """
+            Entry has not expired (or expired less than stale seconds ago)
+        """
+        return now < self.expires + stale
+
+    def age(self,now):
+        """
+            Fraction of TTL elapsed
+        """
+        return float(now - self.created) / self.ttl
+
+    def get_scope(self):
+        """
+            ECS scope prefix length (0 for global entries)
+        """
+        return self.prefix and self.prefix[1] or 0
+
+    scope = property(get_scope)
+
+    def get_packet(self,now,id=None,rd=None,cd=None,stale_ttl=30,opt=None):
+        """
+            Return packet with TTLs reduced by the time spent in cache (or
+            set to stale_ttl if the entry has expired), header id/RD/CD
+            flags replaced if specified and the packed OPT RR opt (see
+            response_opt) appended if specified
+        """
+        if self.valid(now):
+            return self.wire.rewrite(id,int(now - self.created),rd,cd,
+                                     additional=opt)
+        return self.wire.rewrite(id,rd=rd,cd=cd,ttl=stale_ttl,additional=opt)
+
+class DNSCache(object):
+
+    """
+    Response cache keyed by (qname,qtype). Name matching is case
+    insensitive.
+
+    Responses carrying an ECS option with a non-zero scope prefix are
+    stored in a per-name PrefixTree (one per address family) so that
+    lookups for a client subnet are a longest-prefix match. Responses
+    without ECS (or with scope 0) apply to all clients.
+
+    The cache is bounded by the number of (qname,qtype) keys with LRU
+    eviction.
+
+    Expired entries are kept for max_stale seconds (default: 0) and can
+    be returned by lookup/get_packet with stale=True if there is no
+    fresh entry (RFC 8767) - stale responses are returned with TTLs set
+    to stale_ttl.
+
+    >>> cache = DNSCache()
+    >>> def response(ip,subnet=None):
+    ...     r = DNSRecord(DNSHeader(qr=1),q=DNSQuestion("www.abc.com"),
+    ...                   a=RR("www.abc.com",rdata=A(ip),ttl=60))
+    ...     if subnet:
+    ...         r.add_ar(RR("",QTYPE.OPT,4096,rdata=[subnet.option()]))
+    ...     return r
+
+    >>> cache.put(response("1.1.1.1",ClientSubnet("10.1.0.0",24,16)),now=0)
+    >>> cache.put(response("2.2.2.2",ClientSubnet("10.0.0.0",8,8)),now=0)
+    >>> cache.put(response("3.3.3.3"),now=0)
+
+    >>> print cache.get("WWW.abc.com",QTYPE.A,ClientSubnet("10.1.2.3",24),now=10).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='1.1.1.1'>
+    >>> print cache.get("www.abc.com",QTYPE.A,ClientSubnet("10.9.2.3",24),now=10).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='2.2.2.2'>
+    >>> print cache.get("www.abc.com",QTYPE.A,ClientSubnet("192.0.2.1",24),now=10).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='3.3.3.3'>
+    >>> print cache.get("www.abc.com",QTYPE.A,now=10).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='3.3.3.3'>
+    >>> cache.get("www.abc.com",QTYPE.A,now=60) is None
+    True
+    >>> cache.get("www.abc.com",QTYPE.MX,now=10) is None
+    True
+
+    If the longest matching prefix has expired shorter prefixes are
+    checked before the global entry:
+
+    >>> cache.put(response("2.2.2.2",ClientSubnet("10.0.0.0",8,8)),now=30)
+    >>> print cache.get("www.abc.com",QTYPE.A,ClientSubnet("10.1.2.3",24),now=70).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=20 rdata='2.2.2.2'>
+
+    Cached responses can be returned in packed form with the header
+    id from the request (without a parse/pack):
+
+    >>> p = cache.get_packet("www.abc.com",QTYPE.A,now=10,id=1234)
+    >>> print DNSRecord.parse(str(p))
+    <DNS Header: id=0x4d2 type=RESPONSE opcode=QUERY flags=RD rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Question: 'www.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='3.3.3.3'>
+
+    Stale entries:
+
+    >>> cache = DNSCache(max_stale=3600)
+    >>> cache.put(response("3.3.3.3"),now=0)
+    >>> cache.get_packet("www.abc.com",QTYPE.A,now=100) is None
+    True
+    >>> p = cache.get_packet("www.abc.com",QTYPE.A,now=100,stale=True)
+    >>> print DNSRecord.parse(str(p)).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=30 rdata='3.3.3.3'>
+    >>> cache.purge(now=3660)
+    >>> len(cache)
+    0
+
+    Snapshots (expired entries are skipped when loading):
+
+    >>> import os,tempfile
+    >>> cache = DNSCache(clock=lambda:0)
+    >>> cache.put(response("1.1.1.1",ClientSubnet("10.1.0.0",24,16)))
+    >>> cache.put(response("3.3.3.3"))
+    >>> cache.put(DNSRecord(DNSHeader(qr=1),q=DNSQuestion("mx.abc.com",QTYPE.MX),
+    ...                     a=RR("mx.abc.com",QTYPE.MX,rdata=MX("mail.abc.com"),ttl=10)))
+    >>> path = os.path.join(tempfile.mkdtemp(),"cache")
+    >>> cache.save(path)
+    3
+    >>> cache = DNSCache(clock=lambda:20)
+    >>> cache.load(path)
+    2
+    >>> print cache.get("www.abc.com",QTYPE.A,ClientSubnet("10.1.2.3",24)).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=40 rdata='1.1.1.1'>
+    >>> print cache.get("www.abc.com",QTYPE.A).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=40 rdata='3.3.3.3'>
+    >>> cache.get("mx.abc.com",QTYPE.MX) is None
+    True
+
+    Snapshots can be taken while the cache is in use:
+
+    >>> cache = DNSCache(maxsize=50)
+    >>> snapshot = CacheSnapshot(cache,path,interval=0)
+    >>> names = [ "host%d.abc.com" % i for i in range(100) ]
+    >>> for name in names:
+    ...     cache.put(DNSRecord(DNSHeader(qr=1),q=DNSQuestion(name),
+    ...                         a=RR(name,rdata=A("1.2.3.4"),ttl=60)))
+    >>> def use():
+    ...     for i in range(20000):
+    ...         cache.lookup(names[i % 100],QTYPE.A)
+    >>> t = threading.Thread(target=use)
+    >>> t.start()
+    >>> while t.is_alive():
+    ...     n = snapshot.save()
+    >>> t.join()
+    >>> snapshot.errors
+    0
+    >>> os.unlink(path)
+
+    """
+
+    def __init__(self,maxsize=10000,clock=time.time,max_stale=0,stale_ttl=30):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.max_stale = max_stale
+        self.stale_ttl = stale_ttl
+        # key -> [global_entry,{family:PrefixTree}]
+        self.data = OrderedDict()
+        # Guards self.data (lookups reorder the LRU and snapshots are
+        # taken from another thread)
+        self.lock = threading.Lock()
+
+    def key(self,qname,qtype):
+        """
+            Cache key - (lowercase label tuple,qtype)
+        """
+        if not isinstance(qname,DNSLabel):
+            qname = DNSLabel(qname)
+        return (tuple([l.lower() for l in qname.label]),qtype)
+
+    def ttl(self,record):
+        return response_ttl(record)
+
+    def put(self,record,subnet=None,now=None):
+        """
+            Store response. The ECS scope is taken from the response
+            (or from the subnet argument if specified).
+        """
+        if now is None:
+            now = self.clock()
+        ttl = self.ttl(record)
+        if ttl <= 0:
+            return
+        if subnet is None:
+            subnet = ClientSubnet.from_record(record)
+        key = self.key(record.q.qname,record.q.qtype)
+        if subnet is None or subnet.scope == 0:
+            self.store(key,CacheEntry(cache_packet(record),ttl,now))
+        else:
+            prefix = (subnet.address,min(subnet.scope,subnet.source))
+            self.store(key,CacheEntry(cache_packet(record),ttl,now,prefix),
+                       subnet.family)
+
+    def store(self,key,entry,family=None):
+        """
+            Add CacheEntry (for ECS entries family is the address family)
+        """
+        with self.lock:
+            node = self.data.pop(key,None) or [None,{}]
+            if entry.prefix is None:
+                node[0] = entry
+            else:
+                tree = node[1].setdefault(family,PrefixTree())
+                tree.insert(entry.prefix[0],entry.prefix[1],entry)
+            self.data[key] = node
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def lookup(self,qname,qtype,subnet=None,now=None,stale=False):
+        """
+            Return matching CacheEntry (or None) - if stale is True and
+            there is no fresh entry an entry which expired less than
+            max_stale seconds ago is returned
+        """
+        if now is None:
+            now = self.clock()
+        key = self.key(qname,qtype)
+        with self.lock:
+            node = self.data.pop(key,None)
+            if node is None:
+                return None
+            self.data[key] = node
+            entries = []
+            if subnet is not None and subnet.family in node[1]:
+                entries.extend(node[1][subnet.family].matches(subnet.address,
+                                                              subnet.source))
+            entries.append(node[0])
+        for limit in (stale and (0,self.max_stale) or (0,)):
+            for entry in entries:
+                if entry is not None and entry.valid(now,limit):
+                    entry.hits += 1
+                    return entry
+        return None
+
+    def get_packet(self,qname,qtype,subnet=None,now=None,id=None,
+                   rd=None,cd=None,stale=False):
+        """
+            Return cached response in packed form (as bytearray) with
+            TTLs reduced by the time spent in cache and the header
+            id/RD/CD flags replaced if specified (or None)
+        """
+        if now is None:
+            now = self.clock()
+        entry = self.lookup(qname,qtype,subnet,now,stale)
+        if entry is None:
+            return None
+        return entry.get_packet(now,id,rd,cd,self.stale_ttl)
+
+    def get(self,qname,qtype,subnet=None,now=None):
+        """
+            Return cached response as DNSRecord with TTLs reduced by
+            the time spent in cache (or None)
+        """
+        packet = self.get_packet(qname,qtype,subnet,now)
+        if packet is None:
+            return None
+        return DNSRecord.parse(str(packet))
+
+    def purge(self,now=None):
+        """
+            Remove expired entries (older than max_stale)
+        """
+        if now is None:
+            now = self.clock()
+        with self.lock:
+            for key,node in self.data.items():
+                if node[0] is not None and not node[0].valid(now,self.max_stale):
+                    node[0] = None
+                for family,tree in node[1].items():
+                    for entry in tree.values():
+                        if not entry.valid(now,self.max_stale):
+                            tree.remove(*entry.prefix)
+                    if not len(tree):
+                        del node[1][family]
+                if node[0] is None and not node[1]:
+                    del self.data[key]
+
+    def save(self,path):
+        """
+            Write snapshot of cache entries (excluding expired entries)
+            to path - the snapshot is written to a temporary file and
+            renamed. Returns number of entries written.
+
+            The entries are copied under the cache lock (entries are
+            immutable) and written without holding it.
+        """
+        now = self.clock()
+        with self.lock:
+            items = []
+            for key,node in self.data.iteritems():
+                entries = [ (0,node[0]) ]
+                for family,tree in node[1].iteritems():
+                    entries.extend([ (family,entry) for entry in tree.values() ])
+                items.append((key,entries))
+        count = 0
+        tmp = path + ".tmp"
+        with open(tmp,"wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            for (labels,qtype),entries in items:
+                name = pack_labels(labels)
+                for family,entry in entries:
+                    if entry is None or not entry.valid(now,self.max_stale):
+                        continue
+                    address,prefixlen = entry.prefix or ("",0)
+                    f.write(SNAPSHOT_RECORD.pack(entry.expires,entry.ttl,qtype,
+                                                 family,prefixlen,len(name),
+                                                 len(entry.packet)))
+                    f.write(address)
+                    f.write(name)
+                    f.write(entry.packet)
+                    count += 1
+        os.rename(tmp,path)
+        return count
+
+    def load(self,path):
+        """
+            Add entries from snapshot (mapped using mmap) - expired
+            entries are skipped. Returns number of entries loaded.
+        """
+        now = self.clock()
+        count = 0
+        with open(path,"rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(SNAPSHOT_MAGIC):
+                raise DNSError("Invalid cache snapshot: %s" % path)
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise DNSError("Invalid cache snapshot: %s" % path)
+            unpack_from = SNAPSHOT_RECORD.unpack_from
+            offset = len(SNAPSHOT_MAGIC)
+            while offset < size:
+                if offset + SNAPSHOT_RECORD.size > size:
+                    raise DNSError("Truncated cache snapshot: %s" % path)
+                (expires,ttl,qtype,family,prefixlen,
+                    namelen,packetlen) = unpack_from(data,offset)
+                offset += SNAPSHOT_RECORD.size
+                if family and family not in FAMILY:
+                    raise DNSError("Invalid ECS family: %d" % family)
+                length = family and FAMILY[family][1] or 0
+                end = offset + length + namelen + packetlen
+                if end > size:
+                    raise DNSError("Truncated cache snapshot: %s" % path)
+                if now < expires + self.max_stale:
+                    prefix = family and (data[offset:offset + length],
+                                         prefixlen) or None
+                    offset += length
+                    key = (unpack_labels(data[offset:offset + namelen]),qtype)
+                    offset += namelen
+                    self.store(key,CacheEntry(data[offset:end],ttl,
+                                              expires - ttl,prefix),family)
+                    count += 1
+                offset = end
+        finally:
+            data.close()
+        return count
+
+    def __len__(self):
+        return len(self.data)
+
+class CacheSnapshot(object):
+
+    """
+    Save DNSCache to path every interval seconds (in a background
+    thread) - the snapshot is loaded (if present) when started and saved
+    when stopped
+    """
+
+    def __init__(self,cache,path,interval=300):
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+            Load snapshot (if present) and start background thread -
+            returns number of entries loaded
+        """
+        count = 0
+        if os.path.exists(self.path):
+            try:
+                count = self.cache.load(self.path)
+            except (DNSError,IOError):
+                self.errors += 1
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return count
+
+    def save(self):
+        try:
+            return self.cache.save(self.path)
+        except (IOError,OSError):
+            self.errors += 1
+            return 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self.save()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,160 @@
+
+"""
+    Pooled UDP DNS client
+
+    DNSClient keeps a pool of connected UDP sockets to a server so that
+    concurrent callers (threads/greenlets) can send queries without
+    creating a socket per query. Responses are matched by id (late
+    responses to earlier queries on a pooled socket are discarded).
+
+    Consecutive failures (timeouts or socket errors) are counted - once
+    max_failures is reached the server is marked down for down_interval
+    seconds (callers can test client.down and fail over without waiting
+    for a timeout).
+
+    >>> server = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> server.bind(("127.0.0.1",0))
+    >>> def answer(n):
+    ...     for i in range(n):
+    ...         data,peer = server.recvfrom(512)
+    ...         request = DNSRecord.parse(data)
+    ...         reply = DNSRecord(DNSHeader(id=request.header.id,qr=1),
+    ...                           q=request.q,a=RR(request.q.qname,rdata=A("1.2.3.4")))
+    ...         server.sendto(reply.pack(),peer)
+    >>> t = threading.Thread(target=answer,args=(2,))
+    >>> t.start()
+    >>> client = DNSClient(*server.getsockname(),timeout=1)
+    >>> print client.send(DNSRecord(q=DNSQuestion("abc.com"))).a
+    <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='1.2.3.4'>
+    >>> response = client.query(DNSRecord(DNSHeader(id=1234),q=DNSQuestion("xyz.com")).pack())
+    >>> DNSRecord.parse(response).header.id
+    1234
+    >>> t.join()
+    >>> len(client.idle)
+    1
+
+    Timeouts mark the server down after max_failures:
+
+    >>> client = DNSClient(*server.getsockname(),timeout=0.1,retries=0,
+    ...                    max_failures=2)
+    >>> for i in range(2):
+    ...     try:
+    ...         client.query(DNSRecord(q=DNSQuestion("abc.com")).pack())
+    ...     except socket.timeout:
+    ...         print "timeout", client.down
+    timeout False
+    timeout True
+
+"""
+
+import socket,threading,time
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,RR,A
+
+class DNSClient(object):
+
+    """
+    UDP DNS client with a pool of connected sockets
+
+        address/port    - server
+        timeout         - response timeout (seconds)
+        retries         - number of times query is resent after a timeout
+        poolsize        - maximum number of idle sockets kept
+        max_failures    - consecutive failures before server is marked down
+        down_interval   - time (seconds) before a server marked down is
+                          retried
+    """
+
+    def __init__(self,address,port=53,timeout=2.0,retries=1,poolsize=16,
+                      max_failures=3,down_interval=10,clock=time.time):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.poolsize = poolsize
+        self.max_failures = max_failures
+        self.down_interval = down_interval
+        self.clock = clock
+        self.idle = []
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.down_until = 0
+
+    def get_down(self):
+        return self.failures >= self.max_failures and \
+               self.clock() < self.down_until
+
+    down = property(get_down)
+
+    def get_socket(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        family = ":" in self.address and socket.AF_INET6 or socket.AF_INET
+        sock = socket.socket(family,socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        sock.connect((self.address,self.port))
+        return sock
+
+    def put_socket(self,sock):
+        with self.lock:
+            if len(self.idle) < self.poolsize:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.down_until = self.clock() + self.down_interval
+
+    def query(self,data):
+        """
+            Send packed request and return packed response - raises
+            socket.timeout (no response after retries) or socket.error
+        """
+        id = data[:2]
+        sock = self.get_socket()
+        try:
+            for attempt in xrange(self.retries + 1):
+                sock.send(data)
+                deadline = time.time() + self.timeout
+                try:
+                    while True:
+                        response = sock.recv(65535)
+                        if response[:2] == id and len(response) >= 12 and \
+                                ord(response[2]) & 0x80:
+                            self.failures = 0
+                            sock.settimeout(self.timeout)
+                            self.put_socket(sock)
+                            return response
+                        # Discard late/unexpected response
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise socket.timeout("timed out")
+                        sock.settimeout(remaining)
+                except socket.timeout:
+                    sock.settimeout(self.timeout)
+                    if attempt == self.retries:
+                        raise
+        except socket.error:
+            # Socket is not returned to pool (may receive late response)
+            sock.close()
+            self.failed()
+            raise
+
+    def send(self,record):
+        """
+            Send DNSRecord and return response as DNSRecord
+        """
+        return DNSRecord.parse(self.query(record.pack()))
+
+    def close(self):
+        with self.lock:
+            for sock in self.idle:
+                sock.close()
+            self.idle = []
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
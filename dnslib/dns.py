@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import random,socket,struct 
+import base64,itertools,random,socket,struct 
 
 from bit import get_bits,set_bits
 from bimap import Bimap
@@ -14,7 +14,7 @@ QTYPE =  Bimap({1:'A', 2:'NS', 5:'CNAME', 6:'SOA', 12:'PTR', 15:'MX',
                 44:'SSHFP', 45:'IPSECKEY', 46:'RRSIG', 47:'NSEC',
                 48:'DNSKEY', 49:'DHCID', 50:'NSEC3', 51:'NSEC3PARAM',
                 55:'HIP', 99:'SPF', 249:'TKEY', 250:'TSIG', 251:'IXFR',
-                252:'AXFR', 255:'*', 32768:'TA', 32769:'DLV'})
+                252:'AXFR', 255:'*', 257:'CAA', 32768:'TA', 32769:'DLV'})
 CLASS =  Bimap({ 1:'IN', 2:'CS', 3:'CH', 4:'Hesiod', 254:'None', 255:'*'})
 QR =     Bimap({ 0:'QUERY', 1:'RESPONSE' })
 RCODE =  Bimap({ 0:'None', 1:'Format Error', 2:'Server failure', 
@@ -25,6 +25,42 @@ OPCODE = Bimap({ 0:'QUERY', 1:'IQUERY', 2:'STATUS', 5:'UPDATE' })
 class DNSError(Exception):
     pass
 
+class Component(object):
+
+    """
+        Base class for record components (header/question/RR/RD/EDNS
+        option)
+    """
+
+    @classmethod
+    def create(cls,**attrs):
+        """
+            Create instance directly from attributes (bypassing __init__)
+            - used by the parse methods
+        """
+        obj = cls.__new__(cls)
+        obj.__dict__.update(attrs)
+        return obj
+
+def snapshot(obj):
+    """
+        Copy of the attributes of a record component (names and lists are
+        copied by value so that in-place changes are detected) - used by
+        DNSRecord to check whether cached packed data is still valid
+    """
+    if type(obj) is list:
+        return [ (o,snapshot(o)) for o in obj ]
+    attrs = getattr(obj,'__dict__',None)
+    if attrs is None:
+        return obj
+    state = attrs.copy()
+    for k,v in attrs.iteritems():
+        if isinstance(v,DNSLabel):
+            state[k] = (v,v.label)
+        elif type(v) is list:
+            state[k] = (v,tuple(v))
+    return state
+
 class DNSRecord(object):
 
     """
@@ -40,7 +76,8 @@ class DNSRecord(object):
         * DNSHeader 
         * DNSQuestion
         * RR (resource records)
-        * RD (resource data - superclass for TXT,A,AAAA,MX,CNAME,PRT,SOA,NAPTR)
+        * RD (resource data - superclass for TXT,A,AAAA,MX,CNAME,PRT,SOA,NAPTR,
+              SRV,DS,SSHFP,RRSIG,NSEC,DNSKEY,CAA)
         * DNSLabel (envelope for a DNS label)
 
     The library has (in theory) very rudimentary support for EDNS0 options
@@ -155,9 +192,12 @@ class DNSRecord(object):
     version = "0.8.3"
 
     @classmethod
-    def parse(cls,packet):
+    def parse(cls,packet,lazy=False):
         """
             Parse DNS packet data and return DNSRecord instance
+
+            If lazy is True the rdata for each RR is only decoded when
+            accessed (see RR)
         """
         buffer = DNSBuffer(packet)
         header = DNSHeader.parse(buffer)
@@ -168,12 +208,19 @@ class DNSRecord(object):
         for i in range(header.q):
             questions.append(DNSQuestion.parse(buffer))
         for i in range(header.a):
-            rr.append(RR.parse(buffer))
+            rr.append(RR.parse(buffer,lazy))
         for i in range(header.ns):
-            ns.append(RR.parse(buffer))
+            ns.append(RR.parse(buffer,lazy))
         for i in range(header.ar):
-            ar.append(RR.parse(buffer))
-        return cls(header,questions,rr,ns=ns,ar=ar)
+            ar.append(RR.parse(buffer,lazy))
+        record = cls.__new__(cls)
+        record.__dict__.update(header=header,questions=questions,rr=rr,
+                               ns=ns,ar=ar)
+        return record
+
+    # Cached packed data and snapshot of contents when packed (see pack)
+    _packed = None
+    _state = None
 
     def __init__(self,header=None,questions=None,rr=None,q=None,a=None,ns=None,ar=None):
         """
@@ -192,7 +239,7 @@ class DNSRecord(object):
         self.set_header_qa()
 
     def reply(self,data="",ra=1,aa=1):
-        answer = RDMAP.get(QTYPE[self.q.qtype],RD)(data)
+        answer = RDTYPE.get(self.q.qtype,RD)(data)
         return DNSRecord(DNSHeader(id=self.header.id,bitmap=self.header.bitmap,qr=1,ra=ra,aa=aa),
                          q=self.q,
                          a=RR(self.q.qname,self.q.qtype,rdata=answer))
@@ -230,18 +277,82 @@ class DNSRecord(object):
         return self.rr[0]
     a = property(get_a)
 
+    def state(self):
+        """
+            Snapshot of record contents (see snapshot)
+        """
+        return [ snapshot(self.header),
+                 [ (q,snapshot(q)) for q in self.questions ],
+                 [ rr.state() for rr in self.rr ],
+                 [ rr.state() for rr in self.ns ],
+                 [ rr.state() for rr in self.ar ] ]
+
+    def modified(self):
+        """
+            Check if record has been modified since last packed
+        """
+        return self._packed is None or self.state() != self._state
+
     def pack(self):
+        """
+            Pack record - the packed data is cached and returned directly
+            from subsequent calls unless the record (or any contained
+            header/question/RR/RD) has been modified
+
+            >>> d = DNSRecord(DNSHeader(id=1),q=DNSQuestion("abc.com"))
+            >>> d.pack() is d.pack()
+            True
+            >>> d.add_answer(RR("abc.com",rdata=A("1.2.3.4")))
+            >>> print DNSRecord.parse(d.pack()).a
+            <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='1.2.3.4'>
+            >>> d.a.rdata.data = "5.6.7.8"
+            >>> print DNSRecord.parse(d.pack()).a
+            <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='5.6.7.8'>
+            >>> d.header.id = 2
+            >>> DNSRecord.parse(d.pack()).header.id
+            2
+            >>> d.q.qname = "xyz.com"
+            >>> print DNSRecord.parse(d.pack()).q
+            <DNS Question: 'xyz.com' qtype=A qclass=IN>
+
+            Changes to section contents and names are detected:
+
+            >>> d.add_answer(RR("abc.com",rdata=A("1.1.1.1")))
+            >>> p = d.pack()
+            >>> d.rr[0],d.rr[1] = d.rr[1],d.rr[0]
+            >>> print DNSRecord.parse(d.pack()).a
+            <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='1.1.1.1'>
+            >>> d.rr[0] = RR("abc.com",rdata=A("2.2.2.2"))
+            >>> print DNSRecord.parse(d.pack()).a
+            <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='2.2.2.2'>
+            >>> d.rr[0].rname.label = ("def","com")
+            >>> print DNSRecord.parse(d.pack()).a
+            <DNS RR: 'def.com' rtype=A rclass=IN ttl=0 rdata='2.2.2.2'>
+        """
+        if self._packed is not None and self.state() == self._state:
+            return self._packed
         self.set_header_qa()
         buffer = DNSBuffer()
         self.header.pack(buffer)
         for q in self.questions:
             q.pack(buffer)
+        # If the questions match the packet the RRs were (lazily) parsed
+        # from RRs can be copied verbatim while the output still matches
+        # (compression pointers remain valid) - see RR.pack
+        for rr in itertools.chain(self.rr,self.ns,self.ar):
+            if rr._raw is not None:
+                source = rr._raw[0]
+                if source[12:buffer.offset] == buffer.data[12:]:
+                    buffer.source,buffer.verbatim = source,buffer.offset
+                break
         for rr in self.rr:
             rr.pack(buffer)
         for ns in self.ns:
             ns.pack(buffer)
         for ar in self.ar:
             ar.pack(buffer)
+        self._packed = buffer.data
+        self._state = self.state()
         return buffer.data
 
     def send(self,dest,port=53):
@@ -259,12 +370,12 @@ class DNSRecord(object):
         sections.extend([str(rr) for rr in self.ar])
         return "\n".join(sections)
 
-class DNSHeader(object):
+class DNSHeader(Component):
 
     @classmethod
     def parse(cls,buffer):
         (id,bitmap,q,a,ns,ar) = buffer.unpack("!HHHHHH")
-        return cls(id,bitmap,q,a,ns,ar)
+        return cls.create(id=id,bitmap=bitmap,q=q,a=a,ns=ns,ar=ar)
 
     def __init__(self,id=None,bitmap=None,q=0,a=0,ns=0,ar=0,**args):
         if id is None:
@@ -379,13 +490,13 @@ class DNSHeader(object):
                     RCODE[self.rcode],
                     f1, self.q, f2, self.a, f3, self.ns, f4, self.ar )
 
-class DNSQuestion(object):
+class DNSQuestion(Component):
     
     @classmethod
     def parse(cls,buffer):
         qname = buffer.decode_name()
         qtype,qclass = buffer.unpack("!HH")
-        return cls(qname,qtype,qclass)
+        return cls.create(_qname=qname,qtype=qtype,qclass=qclass)
 
     def __init__(self,qname=[],qtype=1,qclass=1):
         self.qname = qname
@@ -411,19 +522,89 @@ class DNSQuestion(object):
         return "<DNS Question: %r qtype=%s qclass=%s>" % (
                     self.qname, QTYPE[self.qtype], CLASS[self.qclass])
             
-class EDNSOption(object):
+class EDNSOption(Component):
 
     def __init__(self,code,data):
         self.code = code
         self.data = data
 
+    def pack(self,buffer):
+        buffer.pack("!HH",self.code,len(self.data))
+        buffer.append(self.data)
+
     def __str__(self):
         return "<EDNS Option: Code=%d Data=%s>" % (self.code,self.data)
 
-class RR(object):
+class RR(Component):
+
+    """
+    Resource record
+
+    When parsed with lazy=True the raw rdata is kept and only decoded
+    into the appropriate RD class when the rdata attribute is accessed.
+    RRs whose rdata has not been changed are copied verbatim when packed (RR types which can
+    contain compressed names are only copied if the packet contents
+    before the RR - apart from the header - are unchanged, otherwise the
+    rdata is decoded and re-encoded).
+
+    >>> packet = '95378180000100040000000006676f6f676c6503636f6d00000f0001c00c000f000100000005000a000a05736d747032c00cc00c000f000100000005000a000a05736d747033c00cc00c000f000100000005000a000a05736d747034c00cc00c000f000100000005000a000a05736d747031c00c'.decode('hex')
+    >>> d = DNSRecord.parse(packet,lazy=True)
+    >>> d.rr[0].decoded
+    False
+    >>> d.pack() == packet
+    True
+    >>> print d.rr[0]
+    <DNS RR: 'google.com' rtype=MX rclass=IN ttl=5 rdata='10:smtp2.google.com'>
+    >>> d.rr[0].decoded
+    True
+    >>> d.modified()
+    False
+    >>> d.rr[0].rdata.preference = 20
+    >>> d.rr[0].get_raw() is None
+    True
+    >>> print DNSRecord.parse(d.pack()).rr[0]
+    <DNS RR: 'google.com' rtype=MX rclass=IN ttl=5 rdata='20:smtp2.google.com'>
+
+    The header does not affect compression pointers:
+
+    >>> d = DNSRecord.parse(packet,lazy=True)
+    >>> d.header.id = 1
+    >>> d.pack()[2:] == packet[2:]
+    True
+
+    Where pointers cannot be preserved names are re-encoded:
+
+    >>> d = DNSRecord.parse(packet,lazy=True)
+    >>> d.questions[0].qname = "abc.google.com"
+    >>> print DNSRecord.parse(d.pack()).rr[3]
+    <DNS RR: 'google.com' rtype=MX rclass=IN ttl=5 rdata='10:smtp1.google.com'>
+
+    Unknown RR types are passed through unchanged (RFC 3597):
+
+    >>> r = RR("abc.com",999,rdata=RD("\x01\x02\x03"))
+    >>> d = DNSRecord(DNSHeader(qr=1),q=DNSQuestion("abc.com",999),a=r)
+    >>> packet = d.pack()
+    >>> DNSRecord.parse(packet,lazy=True).pack() == packet
+    True
+
+    Empty rdata:
+
+    >>> d = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("abc.com",QTYPE.SOA))
+    >>> d.add_ns(RR("www.abc.com",QTYPE.CNAME,rclass=255,rdata=''))
+    >>> d = DNSRecord.parse(d.pack(),lazy=True)
+    >>> d.questions[0].qname = "xyz.com"
+    >>> print DNSRecord.parse(d.pack()).ns[0]
+    <DNS RR: 'www.abc.com' rtype=CNAME rclass=* ttl=0 rdata=''>
+
+    """
+
+    # RR types which may contain (compressed) names in rdata
+    name_types = frozenset([QTYPE.NS,QTYPE.CNAME,QTYPE.SOA,QTYPE.PTR,
+                            QTYPE.MX,QTYPE.NAPTR,QTYPE.SRV,QTYPE.RRSIG,
+                            QTYPE.NSEC])
 
     @classmethod
-    def parse(cls,buffer):
+    def parse(cls,buffer,lazy=False):
         rname = buffer.decode_name()
         rtype,rclass,ttl,rdlength = buffer.unpack("!HHIH")
         if rtype == QTYPE.OPT:
@@ -434,12 +615,18 @@ class RR(object):
                 data = option_buffer.get(length)
                 options.append(EDNSOption(code,data))
             rdata = options
+        elif lazy:
+            raw = (buffer.data,buffer.offset,rdlength)
+            buffer.offset += rdlength
+            return cls.create(_rname=rname,rtype=rtype,rclass=rclass,ttl=ttl,
+                              _rdata=None,_raw=raw)
         else:
             if rdlength:
-                rdata = RDMAP.get(QTYPE[rtype],RD).parse(buffer,rdlength)
+                rdata = RDTYPE.get(rtype,RD).parse(buffer,rdlength)
             else:
                 rdata = ''
-        return cls(rname,rtype,rclass,ttl,rdata)
+        return cls.create(_rname=rname,rtype=rtype,rclass=rclass,ttl=ttl,
+                          _rdata=rdata,_raw=None)
 
     def __init__(self,rname=[],rtype=1,rclass=1,ttl=0,rdata=None):
         self.rname = rname
@@ -448,6 +635,55 @@ class RR(object):
         self.ttl = ttl
         self.rdata = rdata
 
+    def get_rdata(self):
+        if self._rdata is None and self._raw is not None:
+            data,offset,length = self._raw
+            if length:
+                buffer = DNSBuffer(data)
+                buffer.offset = offset
+                rdata = RDTYPE.get(self.rtype,RD).parse(buffer,length)
+            else:
+                rdata = ''
+            # Keep raw rdata (and a snapshot of the decoded rdata) so that
+            # the RR is still copied verbatim if the rdata is not changed
+            self._rdata = rdata
+            self._raw_state = snapshot(rdata)
+        return self._rdata
+
+    def set_rdata(self,rdata):
+        self._rdata = rdata
+        self._raw = None
+
+    rdata = property(get_rdata,set_rdata)
+
+    def get_decoded(self):
+        return self._rdata is not None or self._raw is None
+
+    decoded = property(get_decoded)
+
+    def get_raw(self):
+        """
+            Raw rdata (data,offset,length) if the RR was parsed lazily and
+            the rdata has not been changed (otherwise None)
+        """
+        raw = self._raw
+        if raw is not None and self._rdata is not None and \
+                snapshot(self._rdata) != self._raw_state:
+            return None
+        return raw
+
+    def state(self):
+        """
+            Snapshot of RR contents (see DNSRecord.modified)
+        """
+        raw = self.get_raw()
+        if raw is None:
+            rdata = (self._rdata,snapshot(self._rdata))
+        else:
+            rdata = raw
+        return (self,self._rname,self._rname.label,self.rtype,self.rclass,
+                self.ttl,rdata)
+
     def set_rname(self,rname):
         if isinstance(rname,DNSLabel):
             self._rname = rname
@@ -460,12 +696,34 @@ class RR(object):
     rname = property(get_rname,set_rname)
 
     def pack(self,buffer):
+        start = buffer.offset
         buffer.encode_name(self.rname)
         buffer.pack("!HHI",self.rtype,self.rclass,self.ttl)
+        raw = self.get_raw()
+        if raw is not None:
+            data,offset,length = raw
+            # Output matches source up to (and including) this RR
+            verbatim = data is getattr(buffer,'source',None) and \
+                       buffer.verbatim == start and \
+                       buffer.offset + 2 == offset and \
+                       data[start:buffer.offset] == buffer.data[start:]
+            if verbatim or not length or self.rtype not in self.name_types:
+                buffer.pack("!H",length)
+                buffer.append(data[offset:offset+length])
+                if verbatim:
+                    buffer.verbatim = buffer.offset
+                return
         rdlength_ptr = buffer.offset
         buffer.pack("!H",0)
         start = buffer.offset
-        self.rdata.pack(buffer)
+        if self.rtype == QTYPE.OPT:
+            for option in self.rdata:
+                option.pack(buffer)
+        elif self.rdata == '':
+            # Empty rdata (rdlength 0 - eg. UPDATE delete)
+            pass
+        else:
+            self.rdata.pack(buffer)
         end = buffer.offset
         buffer.update(rdlength_ptr,"!H",end-start)
 
@@ -474,12 +732,12 @@ class RR(object):
                     self.rname, QTYPE[self.rtype], CLASS[self.rclass], 
                     self.ttl, self.rdata)
 
-class RD(object):
+class RD(Component):
 
     @classmethod
     def parse(cls,buffer,length):
         data = buffer.get(length)
-        return cls(data)
+        return cls.create(data=data)
 
     def __init__(self,data=""):
         self.data = data
@@ -501,7 +759,7 @@ class TXT(RD):
         else:
             raise DNSError("Invalid TXT record: length (%d) > RD length (%d)" % 
                                     (txtlength,length))
-        return cls(data)
+        return cls.create(data=data)
 
     def pack(self,buffer):
         if len(self.data) > 255:
@@ -515,7 +773,7 @@ class A(RD):
     def parse(cls,buffer,length):
         ip = buffer.unpack("!BBBB")
         data = "%d.%d.%d.%d" % ip
-        return cls(data)
+        return cls.create(data=data)
 
     def pack(self,buffer):
         buffer.pack("!BBBB",*map(int,self.data.split(".")))
@@ -530,7 +788,7 @@ class AAAA(RD):
     @classmethod
     def parse(cls,buffer,length):
         data = buffer.unpack("!16B")
-        return cls(data)
+        return cls.create(data=data)
  
     def pack(self,buffer):
         buffer.pack("!16B",*self.data)
@@ -545,7 +803,7 @@ class MX(RD):
     def parse(cls,buffer,length):
         (preference,) = buffer.unpack("!H")
         mx = buffer.decode_name()
-        return cls(mx,preference)
+        return cls.create(_mx=mx,preference=preference)
 
     def __init__(self,mx=[],preference=10):
         self.mx = mx
@@ -574,7 +832,7 @@ class CNAME(RD):
     @classmethod
     def parse(cls,buffer,length):
         label = buffer.decode_name()
-        return cls(label)
+        return cls.create(_label=label)
 
     def __init__(self,label=[]):
         self.label = label
@@ -609,7 +867,7 @@ class SOA(RD):
         mname = buffer.decode_name()
         rname = buffer.decode_name()
         times = buffer.unpack("!IIIII")
-        return cls(mname,rname,times)
+        return cls.create(_mname=mname,_rname=rname,times=times)
 
     def __init__(self,mname=[],rname=[],times=None):
         self.mname = mname
@@ -666,7 +924,9 @@ class NAPTR(RD):
         (length,) = buffer.unpack('!B')
         regexp = buffer.get(length)
         replacement = buffer.decode_name()
-        return cls(order, preference, flags, service, regexp, replacement)
+        return cls.create(order=order,preference=preference,flags=flags,
+                          service=service,regexp=regexp,
+                          replacement=replacement)
 
     def pack(self, buffer):
         buffer.pack('!HH', self.order, self.preference)
@@ -676,7 +936,8 @@ class NAPTR(RD):
         buffer.append(self.service)
         buffer.pack('!B', len(self.regexp))
         buffer.append(self.regexp)
-        buffer.encode_name(self.replacement)
+        # Compression not permitted in NAPTR rdata (RFC 3403 4.1)
+        buffer.encode_name_nocompress(self.replacement)
 
     def __str__(self):
         return '%d %d "%s" "%s" "%s" %s' %(
@@ -684,8 +945,178 @@ class NAPTR(RD):
             self.service,self.regexp,self.replacement or '.'
         )
 
-RDMAP = { 'CNAME':CNAME, 'A':A, 'AAAA':AAAA, 'TXT':TXT, 'MX':MX, 
-          'PTR':PTR, 'SOA':SOA, 'NS':NS, 'NAPTR': NAPTR}
+class RDSpec(RD):
+
+    """
+    Base class for RD types specified declaratively as a sequence of
+    (attribute,kind) fields in wire order. The __init__/parse/pack
+    methods are generated (once, at import time) by compile_rd.
+
+    Field kinds:
+
+        B/H/I       - unsigned 8/16/32 bit integer (adjacent integer
+                      fields are packed/unpacked with a single struct call)
+        type        - 16 bit RR type (displayed as mnemonic)
+        name        - domain name (never compressed on output - RFC 3597)
+        string      - <character-string> (length byte + data)
+        bytes       - remainder of rdata (displayed as is)
+        hex         - remainder of rdata (displayed as hex)
+        base64      - remainder of rdata (displayed as base64)
+
+    >>> srv = SRV(10,20,5060,"sip.abc.com")
+    >>> print srv
+    10 20 5060 sip.abc.com
+    >>> r = DNSRecord(q=DNSQuestion("_sip._udp.abc.com",QTYPE.SRV))
+    >>> r.add_answer(RR("_sip._udp.abc.com",QTYPE.SRV,rdata=srv))
+    >>> print DNSRecord.parse(r.pack()).a
+    <DNS RR: '_sip._udp.abc.com' rtype=SRV rclass=IN ttl=0 rdata='10 20 5060 sip.abc.com'>
+
+    >>> print SRV()
+    0 0 0 .
+    >>> print CAA(0,"issue","ca.example.net")
+    0 issue "ca.example.net"
+    >>> print DS(60485,5,1,'2bb183af5f22588179a53b0a98631fad1a292118'.decode('hex'))
+    60485 5 1 2bb183af5f22588179a53b0a98631fad1a292118
+
+    Rdata must be consumed exactly:
+
+    >>> b = DNSBuffer('\\x00\\x0a\\x00\\x14\\x13\\xc4\\x00\\x00')
+    >>> SRV.parse(b,9)
+    Traceback (most recent call last):
+    ...
+    DNSError: Invalid SRV rdata length
+    >>> b = DNSBuffer('\\x00\\x01\\x05\\x01\\x01\\x02')
+    >>> DS.parse(b,3)
+    Traceback (most recent call last):
+    ...
+    DNSError: Invalid DS rdata length
+
+    """
+
+    fields = ()
+
+    def __str__(self):
+        result = []
+        for attr,kind in self.fields:
+            value = getattr(self,attr)
+            if kind == 'type':
+                result.append(QTYPE.lookup(value,"TYPE%d" % value))
+            elif kind == 'name':
+                result.append(str(value) or '.')
+            elif kind == 'string':
+                result.append('"%s"' % value)
+            elif kind == 'hex':
+                result.append(value.encode('hex'))
+            elif kind == 'base64':
+                result.append(base64.b64encode(value))
+            else:
+                result.append(str(value))
+        return " ".join(result)
+
+def compile_rd(cls):
+    """
+        Generate __init__/parse/pack methods for RDSpec subclass from
+        cls.fields
+    """
+    attrs = [attr for attr,kind in cls.fields]
+    # Defaults - 0 (integers), '' (strings/data) or the root name
+    defaults = { 'B':'0', 'H':'0', 'I':'0', 'type':'0', 'name':'()' }
+    init = [ "def __init__(self,%s):" % ",".join(["%s=%s" % 
+                        (attr,defaults.get(kind,"''")) for attr,kind in cls.fields]) ]
+    parse = [ "def parse(cls,buffer,length):",
+              "    end = buffer.offset + length" ]
+    pack = [ "def pack(self,buffer):" ]
+    ints = []
+
+    def flush():
+        if ints:
+            fmt = "!" + "".join([kind for attr,kind in ints])
+            names = [attr for attr,kind in ints]
+            parse.append("    (%s,) = buffer.unpack(%r)" % (",".join(names),fmt))
+            pack.append("    buffer.pack(%r,%s)" % 
+                            (fmt,",".join(["self." + n for n in names])))
+            del ints[:]
+
+    for attr,kind in cls.fields:
+        if kind == 'name':
+            init.append("    if not isinstance(%s,DNSLabel):" % attr)
+            init.append("        %s = DNSLabel(%s)" % (attr,attr))
+        init.append("    self.%s = %s" % (attr,attr))
+        if kind in ('B','H','I','type'):
+            ints.append((attr,kind == 'type' and 'H' or kind))
+            continue
+        flush()
+        if kind == 'name':
+            parse.append("    %s = buffer.decode_name()" % attr)
+            pack.append("    buffer.encode_name_nocompress(self.%s)" % attr)
+        elif kind == 'string':
+            parse.append("    (n,) = buffer.unpack('!B')")
+            parse.append("    %s = buffer.get(n)" % attr)
+            pack.append("    if len(self.%s) > 255:" % attr)
+            pack.append("        raise DNSError('%s.%s too long')" % 
+                                                (cls.__name__,attr))
+            pack.append("    buffer.pack('!B',len(self.%s))" % attr)
+            pack.append("    buffer.append(self.%s)" % attr)
+        elif kind in ('bytes','hex','base64'):
+            parse.append("    if buffer.offset > end:")
+            parse.append("        raise DNSError('Invalid %s rdata length')" % 
+                                                            cls.__name__)
+            parse.append("    %s = buffer.get(end - buffer.offset)" % attr)
+            pack.append("    buffer.append(self.%s)" % attr)
+        else:
+            raise DNSError("Invalid field kind: %s" % kind)
+    flush()
+    parse.append("    if buffer.offset != end:")
+    parse.append("        raise DNSError('Invalid %s rdata length')" % cls.__name__)
+    parse.append("    return cls.create(%s)" % 
+                        ",".join(["%s=%s" % (a,a) for a in attrs]))
+    namespace = { 'DNSLabel':DNSLabel, 'DNSError':DNSError }
+    exec "\n".join(init + parse + pack) in namespace
+    cls.__init__ = namespace['__init__']
+    cls.parse = classmethod(namespace['parse'])
+    cls.pack = namespace['pack']
+    return cls
+
+class SRV(RDSpec):
+    fields = (('priority','H'),('weight','H'),('port','H'),('target','name'))
+
+class DS(RDSpec):
+    fields = (('key_tag','H'),('algorithm','B'),('digest_type','B'),
+              ('digest','hex'))
+
+class SSHFP(RDSpec):
+    fields = (('algorithm','B'),('fp_type','B'),('fingerprint','hex'))
+
+class RRSIG(RDSpec):
+    fields = (('covered','type'),('algorithm','B'),('labels','B'),
+              ('orig_ttl','I'),('expiration','I'),('inception','I'),
+              ('key_tag','H'),('signer','name'),('signature','base64'))
+
+class NSEC(RDSpec):
+    fields = (('next','name'),('bitmap','hex'))
+
+class DNSKEY(RDSpec):
+    fields = (('flags','H'),('protocol','B'),('algorithm','B'),
+              ('key','base64'))
+
+class CAA(RDSpec):
+    fields = (('flags','B'),('tag','string'),('value','bytes'))
+
+    def __str__(self):
+        return '%d %s "%s"' % (self.flags,self.tag,self.value)
+
+for cls in (SRV,DS,SSHFP,RRSIG,NSEC,DNSKEY,CAA):
+    compile_rd(cls)
+
+# RD classes by RR type code
+RDTYPE = { QTYPE.A:A, QTYPE.NS:NS, QTYPE.CNAME:CNAME, QTYPE.SOA:SOA,
+           QTYPE.PTR:PTR, QTYPE.MX:MX, QTYPE.TXT:TXT, QTYPE.AAAA:AAAA,
+           QTYPE.SRV:SRV, QTYPE.NAPTR:NAPTR, QTYPE.DS:DS, QTYPE.SSHFP:SSHFP,
+           QTYPE.RRSIG:RRSIG, QTYPE.NSEC:NSEC, QTYPE.DNSKEY:DNSKEY,
+           QTYPE.CAA:CAA, QTYPE.DLV:DS }
+
+# RD classes by mnemonic (for compatibility)
+RDMAP = dict([(QTYPE[k],v) for (k,v) in RDTYPE.items()])
 
 def test_unpack(s):
     """
@@ -0,0 +1,361 @@
+
+"""
+    Columnar export of DNS messages
+
+    Messages are decoded into column batches for three tables:
+
+        messages    - one row per message (header fields)
+        questions   - one row per question (qname/qtype/qclass)
+        rrs         - one row per RR (section/owner/type/class/ttl/rdata)
+
+    Rows are linked by msg (the message sequence number). Names (qname and
+    RR owner) are dictionary encoded within each batch - the batch stores
+    an index into a per-batch list of distinct names (and Parquet files
+    store the names as dictionary columns). Names are exported in
+    presentation form (label.escape_name) and rdata as text with
+    non-printable bytes escaped (EDNS options as CODE:HEXDATA) so that
+    all strings are ASCII.
+
+    Batches are written incrementally (every batch_size messages) to
+    Parquet or Arrow IPC files (requires pyarrow) or to CSV/NDJSON files
+    (pure Python fallback).
+
+    >>> import os,shutil,tempfile
+    >>> q = DNSRecord(DNSHeader(id=1),q=DNSQuestion("abc.com"))
+    >>> r = q.reply("1.2.3.4")
+    >>> r.add_answer(RR("abc.com",rdata=A("5.6.7.8"),ttl=60))
+    >>> d = tempfile.mkdtemp()
+    >>> e = Exporter(d,format="csv",batch_size=1)
+    >>> e.add(q,timestamp=1.0)
+    >>> e.add(r,timestamp=1.5)
+    >>> e.close()
+    >>> print open(os.path.join(d,"messages.csv")).read(),
+    msg,timestamp,id,qr,opcode,aa,tc,rd,ra,rcode,qd,an,ns,ar
+    0,1.0,1,0,0,0,0,1,0,0,1,0,0,0
+    1,1.5,1,1,0,1,0,1,1,0,1,2,0,0
+    >>> print open(os.path.join(d,"rrs.csv")).read(),
+    msg,section,owner,rtype,rclass,ttl,rdata
+    1,1,abc.com,1,1,0,1.2.3.4
+    1,1,abc.com,1,1,60,5.6.7.8
+    >>> e = Exporter(d,format="ndjson")
+    >>> e.add(r)
+    >>> e.close()
+    >>> print open(os.path.join(d,"questions.ndjson")).read(),
+    {"msg": 0, "qname": "abc.com", "qtype": 1, "qclass": 1}
+
+    Binary labels and EDNS options:
+
+    >>> q = DNSRecord(DNSHeader(id=2),q=DNSQuestion(["\\xff\\x00","abc","com"]))
+    >>> q.add_ar(RR("",QTYPE.OPT,4096,rdata=[EDNSOption(10,"\\x01\\x02")]))
+    >>> e = Exporter(d,format="ndjson")
+    >>> e.add(q)
+    >>> e.close()
+    >>> print open(os.path.join(d,"questions.ndjson")).read(),
+    {"msg": 0, "qname": "\\\\255\\\\000.abc.com", "qtype": 1, "qclass": 1}
+    >>> print open(os.path.join(d,"rrs.ndjson")).read(),
+    {"msg": 0, "section": 3, "owner": "", "rtype": 41, "rclass": 4096, "ttl": 0, "rdata": "10:0102"}
+    >>> shutil.rmtree(d)
+
+"""
+
+import csv,json,os,re
+
+from collections import OrderedDict
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,EDNSOption,RR,A,TXT,QTYPE
+from label import escape_name
+
+# Table schemas - (column,type) where type is one of u8/u16/u32/u64/
+# f64/name (dictionary encoded)/str
+TABLES = OrderedDict([
+    ('messages', [ ('msg','u64'), ('timestamp','f64'), ('id','u16'),
+                   ('qr','u8'), ('opcode','u8'), ('aa','u8'), ('tc','u8'),
+                   ('rd','u8'), ('ra','u8'), ('rcode','u8'), ('qd','u16'),
+                   ('an','u16'), ('ns','u16'), ('ar','u16') ]),
+    ('questions', [ ('msg','u64'), ('qname','name'), ('qtype','u16'),
+                    ('qclass','u16') ]),
+    ('rrs', [ ('msg','u64'), ('section','u8'), ('owner','name'),
+              ('rtype','u16'), ('rclass','u16'), ('ttl','u32'),
+              ('rdata','str') ]),
+])
+
+FORMATS = ('parquet','arrow','csv','ndjson')
+
+# Rdata text which does not need escaping (printable ASCII except '\\')
+SAFE_TEXT = re.compile(r'^[\x20-\x5b\x5d-\x7e]*$')
+
+def rdata_text(rr):
+    """
+        Text form of rdata - EDNS options as CODE:HEXDATA (space
+        separated), otherwise str(rdata) with bytes outside printable
+        ASCII escaped as \\DDD (and '\\' as \\\\)
+
+        >>> rdata_text(RR("abc.com",QTYPE.TXT,rdata=TXT("a\\\\b\\xff")))
+        'a\\\\\\\\b\\\\255'
+    """
+    if rr.rtype == QTYPE.OPT:
+        return " ".join([ "%d:%s" % (o.code,o.data.encode('hex'))
+                                for o in rr.rdata ])
+    text = str(rr.rdata)
+    if not SAFE_TEXT.match(text):
+        text = "".join([ c == "\\" and "\\\\" or
+                         (c < " " or c > "~") and "\\%03d" % ord(c) or c
+                                for c in text ])
+    return text
+
+class ColumnBatch(object):
+
+    """
+    Batch of rows stored as columns (lists) - 'name' columns store
+    indices into self.names
+
+    >>> b = ColumnBatch(TABLES['questions'])
+    >>> b.append((0,"abc.com",1,1))
+    >>> b.append((1,"abc.com",28,1))
+    >>> b.columns['qname'], b.names
+    ([0, 0], ['abc.com'])
+    >>> list(b.rows())
+    [(0, 'abc.com', 1, 1), (1, 'abc.com', 28, 1)]
+    """
+
+    def __init__(self,schema):
+        self.schema = schema
+        self.clear()
+
+    def clear(self):
+        self.columns = OrderedDict([ (name,[]) for name,t in self.schema ])
+        self.names = []
+        self.index = {}
+
+    def append(self,row):
+        for (name,t),value in zip(self.schema,row):
+            if t == 'name':
+                i = self.index.get(value)
+                if i is None:
+                    i = self.index[value] = len(self.names)
+                    self.names.append(value)
+                value = i
+            self.columns[name].append(value)
+
+    def rows(self):
+        """
+            Yield rows (with names decoded)
+        """
+        names = self.names
+        columns = [ t == 'name' and [ names[i] for i in c ] or c
+                    for (name,t),c in zip(self.schema,self.columns.values()) ]
+        return zip(*columns)
+
+    def __len__(self):
+        return len(self.columns[self.schema[0][0]])
+
+class CSVWriter(object):
+
+    """
+    Write batches to CSV file (with header row)
+    """
+
+    def __init__(self,path,schema):
+        self.f = open(path,"wb")
+        self.writer = csv.writer(self.f,lineterminator="\n")
+        self.writer.writerow([ name for name,t in schema ])
+
+    def write(self,batch):
+        self.writer.writerows([ [ v is None and "" or v for v in row ]
+                                    for row in batch.rows() ])
+
+    def close(self):
+        self.f.close()
+
+class NDJSONWriter(object):
+
+    """
+    Write batches to newline delimited JSON file
+    """
+
+    def __init__(self,path,schema):
+        self.f = open(path,"wb")
+        self.columns = [ name for name,t in schema ]
+
+    def write(self,batch):
+        for row in batch.rows():
+            self.f.write(json.dumps(OrderedDict(zip(self.columns,row))))
+            self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+
+class ArrowWriter(object):
+
+    """
+    Write batches to Parquet (format='parquet') or Arrow IPC stream
+    (format='arrow')
+
+    Names are written to Parquet as dictionary arrays (each batch is a
+    row group with its own dictionary). Arrow IPC streams cannot replace
+    a dictionary between batches so names are written as strings.
+    """
+
+    def __init__(self,path,schema,format='parquet'):
+        self.path = path
+        self.format = format
+        self.fields = schema
+        self.writer = None
+
+    @staticmethod
+    def arrow_type(t):
+        return { 'u8': pyarrow.uint8(), 'u16': pyarrow.uint16(),
+                 'u32': pyarrow.uint32(), 'u64': pyarrow.uint64(),
+                 'f64': pyarrow.float64(), 'str': pyarrow.string(),
+                 'name': pyarrow.dictionary(pyarrow.int32(),pyarrow.string()),
+               }[t]
+
+    def write(self,batch):
+        arrays = []
+        for name,t in self.fields:
+            column = batch.columns[name]
+            if t == 'name' and self.format == 'arrow':
+                names = batch.names
+                arrays.append(pyarrow.array([ names[i] for i in column ],
+                                            pyarrow.string()))
+            elif t == 'name':
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                                    pyarrow.array(column,pyarrow.int32()),
+                                    pyarrow.array(batch.names,pyarrow.string())))
+            else:
+                arrays.append(pyarrow.array(column,self.arrow_type(t)))
+        rb = pyarrow.RecordBatch.from_arrays(arrays,[ n for n,t in self.fields ])
+        if self.writer is None:
+            # Writer schema is taken from the first batch
+            if self.format == 'parquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.path,rb.schema)
+            else:
+                self.writer = pyarrow.RecordBatchStreamWriter(self.path,rb.schema)
+        if self.format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_batches([rb]))
+        else:
+            self.writer.write_batch(rb)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class Exporter(object):
+
+    """
+    Export DNSRecords to column tables (messages/questions/rrs) in
+    directory - format is 'parquet' or 'arrow' (requires pyarrow) or
+    'csv'/'ndjson' (default: parquet if pyarrow is available, otherwise
+    csv)
+
+    Messages skipped by export_capture (malformed RDATA) are counted in
+    self.errors
+
+    Each table is written to <directory>/<table>.<format>
+    """
+
+    def __init__(self,directory,format=None,batch_size=10000):
+        if format is None:
+            format = pyarrow and 'parquet' or 'csv'
+        if format not in FORMATS:
+            raise ValueError("Invalid format: %s" % format)
+        if format in ('parquet','arrow') and pyarrow is None:
+            raise ValueError("Format %s requires pyarrow" % format)
+        self.format = format
+        self.batch_size = batch_size
+        self.count = 0
+        self.errors = 0
+        self.batches = {}
+        self.writers = {}
+        for table,schema in TABLES.items():
+            path = os.path.join(directory,"%s.%s" % (table,format))
+            self.batches[table] = ColumnBatch(schema)
+            if format == 'csv':
+                self.writers[table] = CSVWriter(path,schema)
+            elif format == 'ndjson':
+                self.writers[table] = NDJSONWriter(path,schema)
+            else:
+                self.writers[table] = ArrowWriter(path,schema,format)
+
+    def add(self,record,timestamp=None):
+        """
+            Add DNSRecord (lazily parsed records are fine - RDATA is
+            only decoded when rrs are exported). If the RDATA cannot be
+            decoded the parse error is raised and nothing is added.
+        """
+        msg = self.count
+        h = record.header
+        questions = [ (msg,escape_name(q.qname),q.qtype,q.qclass)
+                                for q in record.questions ]
+        rrs = [ (msg,section,escape_name(rr.rname),rr.rtype,rr.rclass,
+                 rr.ttl,rdata_text(rr))
+                    for section,rrlist in ((1,record.rr),(2,record.ns),(3,record.ar))
+                        for rr in rrlist ]
+        self.batches['messages'].append((msg,timestamp,h.id,h.qr,h.opcode,
+                                         h.aa,h.tc,h.rd,h.ra,h.rcode,
+                                         len(record.questions),len(record.rr),
+                                         len(record.ns),len(record.ar)))
+        for row in questions:
+            self.batches['questions'].append(row)
+        for row in rrs:
+            self.batches['rrs'].append(row)
+        self.count += 1
+        if len(self.batches['messages']) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table,batch in self.batches.items():
+            if len(batch):
+                self.writers[table].write(batch)
+                batch.clear()
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+def export_capture(path,directory,format=None,batch_size=10000,data=None):
+    """
+        Export DNS messages from pcap/pcapng capture (file path - or
+        data buffer if path is None)
+        - returns number of messages exported (messages with malformed
+        RDATA are skipped)
+
+        >>> import shutil,tempfile,StringIO
+        >>> from pcap import write_pcap,udp_packet
+        >>> r = DNSRecord(DNSHeader(id=1,qr=1),q=DNSQuestion("abc.com"),
+        ...               a=RR("abc.com",rdata=A("1.2.3.4")))
+        >>> bad = r.pack()[:-6] + "\\x00\\x02\\x01\\x02"
+        >>> f = StringIO.StringIO()
+        >>> write_pcap(f,[ (1.0,udp_packet(("10.0.0.1",53),("10.0.0.2",1234),data))
+        ...                     for data in (r.pack(),bad,r.pack()) ])
+        >>> d = tempfile.mkdtemp()
+        >>> export_capture(None,d,format="csv",data=f.getvalue())
+        2
+        >>> print open(os.path.join(d,"rrs.csv")).read(),
+        msg,section,owner,rtype,rclass,ttl,rdata
+        0,1,abc.com,1,1,0,1.2.3.4
+        1,1,abc.com,1,1,0,1.2.3.4
+        >>> shutil.rmtree(d)
+    """
+    from pcap import read_dns,PARSE_ERRORS
+    exporter = Exporter(directory,format,batch_size)
+    try:
+        for ts,src,dst,record in read_dns(path,data=data):
+            try:
+                exporter.add(record,ts)
+            except PARSE_ERRORS:
+                exporter.errors += 1
+    finally:
+        exporter.close()
+    return exporter.count
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,5 +1,5 @@
 
-import types
+import re,types
 from bit import get_bits,set_bits
 from buffer import Buffer
 
@@ -22,8 +22,23 @@ class DNSLabel(object):
     aaa.bbb.ccc
     >>> l1
     'aaa.bbb.ccc'
+    >>> DNSLabel("aaa.bbb.ccc.") == l1
+    True
+    >>> DNSLabel(".").label
+    ()
+    >>> l1.suffixes()
+    [('aaa', 'bbb', 'ccc'), ('bbb', 'ccc'), ('ccc',)]
+    >>> l1.suffixes() is l1.suffixes()
+    True
+    >>> l1.label = ("Xyz","com")
+    >>> l1.suffixes()
+    [('xyz', 'com'), ('com',)]
 
     """
+
+    # (label,suffixes) - see suffixes()
+    _suffixes = None
+
     def __init__(self,label):
         """
             Create label instance from elements in list/tuple. If label
@@ -32,7 +47,25 @@ class DNSLabel(object):
         if type(label) in (types.ListType,types.TupleType):
             self.label = tuple(label)
         else:
-            self.label = tuple(label.split("."))
+            # Root ('' or '.') is the empty label
+            label = label.rstrip(".")
+            if label:
+                self.label = tuple(label.split("."))
+            else:
+                self.label = ()
+
+    def suffixes(self):
+        """
+            Lowercased suffixes of label (longest first) - used as name
+            compression keys and cached until label is changed
+        """
+        label = self.label
+        cached = self._suffixes
+        if cached is None or cached[0] is not label:
+            lower = tuple([ element.lower() for element in label ])
+            cached = (label,[ lower[i:] for i in xrange(len(lower)) ])
+            self._suffixes = cached
+        return cached[1]
 
     def __str__(self):
         return ".".join(self.label)
@@ -49,6 +82,62 @@ class DNSLabel(object):
     def __len__(self):
         return len(".".join(self.label))
 
+# Label bytes which do not need escaping (printable ASCII except '.'/'\\')
+SAFE_LABEL = re.compile(r'^[\x21-\x2d\x2f-\x5b\x5d-\x7e]*$')
+
+def escape_name(name):
+    """
+        Presentation form of name (RFC 1035 5.1) - label bytes outside
+        printable ASCII are escaped as \\DDD and '.'/'\\' within labels
+        as \\./\\\\ so that the result is ASCII and can be converted
+        back to the original labels
+
+        >>> print escape_name(DNSLabel(["a.b","\\xff\\x00x","com"]))
+        a\\.b.\\255\\000x.com
+        >>> escape_name("www.abc.com")
+        'www.abc.com'
+    """
+    if not isinstance(name,DNSLabel):
+        name = DNSLabel(name)
+    labels = []
+    for label in name.label:
+        if not SAFE_LABEL.match(label):
+            label = "".join([ c in ".\\" and "\\" + c or
+                              (c < "!" or c > "~") and "\\%03d" % ord(c) or c
+                                    for c in label ])
+        labels.append(label)
+    return ".".join(labels)
+
+ESCAPE_TOKEN = re.compile(r'\\(\d{3}|.)|(\.)|([^\\.]+)',re.S)
+
+def unescape_name(name):
+    """
+        Convert presentation form of name (see escape_name) back to
+        DNSLabel
+
+        >>> unescape_name(r"a\\.b.\\255\\000x.com").label
+        ('a.b', '\\xff\\x00x', 'com')
+        >>> unescape_name(escape_name(["\\\\.","com."])).label
+        ('\\\\.', 'com.')
+        >>> unescape_name("www.abc.com.").label
+        ('www', 'abc', 'com')
+        >>> unescape_name(".").label
+        ()
+    """
+    if name in ("","."):
+        return DNSLabel(())
+    labels = [""]
+    for escape,dot,text in ESCAPE_TOKEN.findall(name):
+        if dot:
+            labels.append("")
+        elif escape:
+            labels[-1] += len(escape) == 3 and chr(int(escape) & 0xff) or escape
+        else:
+            labels[-1] += text
+    if labels[-1] == "":
+        labels.pop()
+    return DNSLabel(labels)
+
 class DNSBuffer(Buffer):
 
     """
@@ -71,6 +160,32 @@ class DNSBuffer(Buffer):
     >>> b.decode_name()
     'aaa.xxx.bbb.ccc'
 
+    Compression is case-insensitive but preserves case:
+
+    >>> b = DNSBuffer()
+    >>> b.encode_name("www.Example.com")
+    >>> b.encode_name("WWW.EXAMPLE.COM")
+    >>> b.encode_name("mail.example.COM")
+    >>> b.data.encode("hex")
+    '03777777074578616d706c6503636f6d00c000046d61696cc004'
+    >>> b.offset = 0
+    >>> b.decode_name()
+    'www.Example.com'
+    >>> b.decode_name()
+    'www.Example.com'
+    >>> b.decode_name()
+    'mail.Example.com'
+
+    Names can be encoded without compression:
+
+    >>> b = DNSBuffer()
+    >>> b.encode_name("aaa.bbb.ccc")
+    >>> b.encode_name_nocompress("aaa.bbb.ccc")
+    >>> b.data.encode("hex")
+    '0361616103626262036363630003616161036262620363636300'
+    >>> len(b.names)
+    3
+
     >>> b = DNSBuffer()
     >>> b.encode_name(['a.aa','b.bb','c.cc'])
     >>> b.offset = 0
@@ -84,6 +199,10 @@ class DNSBuffer(Buffer):
         """
         super(DNSBuffer,self).__init__(data)
         self.names = {}
+        # Source packet and offset up to which data matches it (set by
+        # DNSRecord.pack - see RR.pack)
+        self.source = None
+        self.verbatim = 0
 
     def decode_name(self):
         """
@@ -115,26 +234,48 @@ class DNSBuffer(Buffer):
             Encode label and store at end of buffer (compressing
             cached elements where needed) and store elements
             in 'names' dict
+
+            Matching is case-insensitive (RFC 1035 2.3.3) but the
+            case of the first occurrence is preserved. Only offsets
+            which fit in a 14-bit pointer are stored.
         """
         if not isinstance(name,DNSLabel):
             name = DNSLabel(name)
         if len(name) > 253:
             raise DNSLabelError("Domain label too long: %r" % name)
-        name = list(name.label)
-        while name:
-            if self.names.has_key(tuple(name)):
+        label = name.label
+        names = self.names
+        for i,key in enumerate(name.suffixes()):
+            pointer = names.get(key)
+            if pointer is not None:
                 # Cached - set pointer
-                pointer = self.names[tuple(name)]
-                pointer = set_bits(pointer,3,14,2)
-                self.pack("!H",pointer)
+                self.pack("!H",set_bits(pointer,3,14,2))
                 return
-            else:
-                self.names[tuple(name)] = self.offset
-                element = name.pop(0)
-                if len(element) > 63:
-                    raise DNSLabelError("Label component too long: %r" % element)
-                self.pack("!B",len(element))
-                self.append(element)
+            if self.offset < 0x4000:
+                names[key] = self.offset
+            element = label[i]
+            if len(element) > 63:
+                raise DNSLabelError("Label component too long: %r" % element)
+            self.pack("!B",len(element))
+            self.append(element)
+        self.append("\x00")
+
+    def encode_name_nocompress(self,name):
+        """
+            Encode label and store at end of buffer without using
+            compression pointers (or storing elements for later
+            compression) - for rdata fields where compression is not
+            permitted (RFC 3597 4)
+        """
+        if not isinstance(name,DNSLabel):
+            name = DNSLabel(name)
+        if len(name) > 253:
+            raise DNSLabelError("Domain label too long: %r" % name)
+        for element in name.label:
+            if len(element) > 63:
+                raise DNSLabelError("Label component too long: %r" % element)
+            self.pack("!B",len(element))
+            self.append(element)
         self.append("\x00")
 
 if __name__ == '__main__':
@@ -0,0 +1,492 @@
+
+"""
+    Streaming pcap/pcapng reader for DNS traffic
+
+    Captures are accessed through mmap (files are never read into memory)
+    and decoded incrementally - link layer (Ethernet/VLAN, Linux SLL,
+    raw IP, loopback), IPv4/IPv6 and UDP/TCP headers are stripped and
+    TCP DNS streams (RFC 1035 4.2.2 length-prefixed messages) are
+    reassembled with bounded per-flow state. Only traffic to/from the
+    DNS ports (default: 53) is decoded as DNS.
+
+    >>> import StringIO
+    >>> q = DNSRecord(DNSHeader(id=1),q=DNSQuestion("abc.com"))
+    >>> r = q.reply("1.2.3.4")
+    >>> client,server = ("10.0.0.1",1234),("10.0.0.2",53)
+    >>> f = StringIO.StringIO()
+    >>> write_pcap(f,[(1.0,udp_packet(client,server,q.pack())),
+    ...               (1.5,udp_packet(server,client,r.pack()))])
+    >>> for ts,src,dst,msg in read_dns(data=f.getvalue()):
+    ...     print ts,src,dst,msg.q
+    1.0 ('10.0.0.1', 1234) ('10.0.0.2', 53) <DNS Question: 'abc.com' qtype=A qclass=IN>
+    1.5 ('10.0.0.2', 53) ('10.0.0.1', 1234) <DNS Question: 'abc.com' qtype=A qclass=IN>
+
+    TCP messages are reassembled across segments:
+
+    >>> msg = r.pack()
+    >>> stream = struct.pack("!H",len(msg)) + msg
+    >>> f = StringIO.StringIO()
+    >>> write_pcap(f,[(2.0,tcp_packet(server,client,1000,"",SYN)),
+    ...               (2.1,tcp_packet(server,client,1011,stream[10:])),
+    ...               (2.2,tcp_packet(server,client,1001,stream[:10]))])
+    >>> for ts,src,dst,msg in read_dns(data=f.getvalue()):
+    ...     print ts,src,dst
+    ...     print msg.a
+    2.2 ('10.0.0.2', 53) ('10.0.0.1', 1234)
+    <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='1.2.3.4'>
+
+    The capture can be split into byte ranges which are read
+    independently:
+
+    >>> reader = PcapReader(data=f.getvalue())
+    >>> chunks = list(reader.chunks(2))
+    >>> [ (start,end) for start,end,state in chunks ]
+    [(None, 169), (169, None)]
+    >>> sum([ list(reader.records(*c)) for c in chunks ],[]) == list(reader.records())
+    True
+
+    Other ports are skipped (unless ports=None) and runt frames are
+    ignored:
+
+    >>> f = StringIO.StringIO()
+    >>> write_pcap(f,[(3.0,udp_packet(client,("10.0.0.2",443),q.pack()))])
+    >>> len(list(read_dns(data=f.getvalue()))), len(list(read_dns(data=f.getvalue(),ports=None)))
+    (0, 1)
+    >>> f = StringIO.StringIO()
+    >>> write_pcap(f,[(4.0,"\\x00" * 10)],linktype=LINKTYPE_ETHERNET)
+    >>> list(read_dns(data=f.getvalue()))
+    []
+
+"""
+
+import mmap,socket,struct
+
+from collections import OrderedDict
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,DNSError
+
+# Link types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+
+# Ports decoded as DNS (by default)
+DNS_PORTS = frozenset([53])
+
+# Exceptions raised when parsing (or lazily decoding) malformed messages
+PARSE_ERRORS = (DNSError,struct.error,IndexError,ValueError)
+
+PCAP_MAGIC = (0xa1b2c3d4,0xa1b23c4d)
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BOM = 0x1a2b3c4d
+
+class PcapError(Exception):
+    pass
+
+def udp_packet(src,dst,payload):
+    """
+        Build IPv4/UDP packet (src/dst are (address,port) tuples) -
+        checksums are not calculated
+    """
+    udp = struct.pack("!HHHH",src[1],dst[1],len(payload) + 8,0) + payload
+    return ip_packet(src[0],dst[0],17,udp)
+
+def tcp_packet(src,dst,seq,payload,flags=0x18):
+    """
+        Build IPv4/TCP packet (default flags PSH/ACK) - checksums are
+        not calculated
+    """
+    tcp = struct.pack("!HHIIBBHHH",src[1],dst[1],seq,0,5 << 4,flags,
+                      65535,0,0) + payload
+    return ip_packet(src[0],dst[0],6,tcp)
+
+def ip_packet(src,dst,proto,payload):
+    return struct.pack("!BBHHHBBH4s4s",0x45,0,len(payload) + 20,0,0,64,
+                       proto,0,socket.inet_aton(src),
+                       socket.inet_aton(dst)) + payload
+
+def write_pcap(f,packets,linktype=LINKTYPE_RAW):
+    """
+        Write packets - list of (timestamp,data) - to pcap file
+    """
+    f.write(struct.pack("<IHHiIII",0xa1b2c3d4,2,4,0,0,65535,linktype))
+    for ts,data in packets:
+        sec = int(ts)
+        usec = int(round((ts - sec) * 1000000))
+        f.write(struct.pack("<IIII",sec,usec,len(data),len(data)))
+        f.write(data)
+
+def decode_ip(data):
+    """
+        Decode IPv4/IPv6 packet and return (src,dst,protocol,payload)
+        or None (for fragments/unsupported packets)
+    """
+    if not data:
+        return None
+    version = ord(data[0]) >> 4
+    if version == 4 and len(data) >= 20:
+        ihl = (ord(data[0]) & 0x0f) * 4
+        (length,frag,proto) = struct.unpack("!H2xHxB",data[2:10])
+        if frag & 0x3fff:
+            # Fragment
+            return None
+        return (socket.inet_ntoa(data[12:16]),socket.inet_ntoa(data[16:20]),
+                proto,data[ihl:length])
+    elif version == 6 and len(data) >= 40:
+        (length,proto) = struct.unpack("!HB",data[4:7])
+        payload = data[40:40 + length]
+        # Skip hop-by-hop/routing/destination options headers
+        while proto in (0,43,60) and len(payload) >= 8:
+            proto,hlen = ord(payload[0]),(ord(payload[1]) + 1) * 8
+            payload = payload[hlen:]
+        if proto == 44:
+            # Fragment
+            return None
+        return (socket.inet_ntop(socket.AF_INET6,data[8:24]),
+                socket.inet_ntop(socket.AF_INET6,data[24:40]),
+                proto,payload)
+    return None
+
+def decode_link(linktype,data):
+    """
+        Strip link layer header and return IP packet (or None)
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            # Runt frame
+            return None
+        (ethertype,) = struct.unpack("!H",data[12:14])
+        offset = 14
+        while ethertype in (0x8100,0x88a8) and len(data) >= offset + 4:
+            # VLAN tag
+            (ethertype,) = struct.unpack("!H",data[offset + 2:offset + 4])
+            offset += 4
+        if ethertype not in (0x0800,0x86dd):
+            return None
+        return data[offset:]
+    elif linktype == LINKTYPE_RAW or linktype == 12:
+        return data
+    elif linktype == LINKTYPE_LINUX_SLL:
+        return data[16:]
+    elif linktype == LINKTYPE_NULL:
+        return data[4:]
+    raise PcapError("Unsupported link type: %d" % linktype)
+
+class TCPStream(object):
+
+    """
+    Reassemble one direction of a TCP DNS connection and extract
+    length-prefixed messages. Out-of-order segments are held (up to
+    max_pending) until the gap is filled.
+
+    >>> s = TCPStream(100)
+    >>> s.add(104,"cd")
+    []
+    >>> s.add(100,"\\x00\\x04ab")
+    ['abcd']
+    >>> s.add(100,"\\x00\\x04ab")
+    []
+    >>> s.add(106,"\\x00\\x01x\\x00")
+    ['x']
+    >>> s.add(110,"\\x02yz")
+    ['yz']
+
+    """
+
+    def __init__(self,seq,max_pending=64):
+        self.next_seq = seq
+        self.buffer = ""
+        self.pending = {}
+        self.max_pending = max_pending
+
+    def add(self,seq,data):
+        """
+            Add segment and return list of completed messages
+        """
+        delta = (seq - self.next_seq) & 0xffffffff
+        if delta >= 0x80000000:
+            # Retransmission/overlap
+            overlap = (self.next_seq - seq) & 0xffffffff
+            if overlap >= len(data):
+                return []
+            data = data[overlap:]
+            delta = 0
+        if delta:
+            if len(self.pending) < self.max_pending:
+                self.pending[seq] = data
+            return []
+        self.buffer += data
+        self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        while self.next_seq in self.pending:
+            data = self.pending.pop(self.next_seq)
+            self.buffer += data
+            self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        messages = []
+        while len(self.buffer) >= 2:
+            (length,) = struct.unpack("!H",self.buffer[:2])
+            if len(self.buffer) < length + 2:
+                break
+            messages.append(self.buffer[2:length + 2])
+            self.buffer = self.buffer[length + 2:]
+        return messages
+
+class PcapReader(object):
+
+    """
+    Read pcap/pcapng capture - either from the file path (which is
+    mmap'd) or from data (a string/mmap buffer)
+
+    records() yields (timestamp,linktype,offset,length) for each captured
+    frame (the frame data is source.data[offset:offset+length]) - this
+    allows captures to be indexed and sharded without copying data.
+    chunks() splits the capture into byte ranges which can be read
+    independently with records(start,end,state).
+
+    packets() yields (timestamp,src,dst,protocol,payload) for each UDP
+    datagram/TCP segment (for TCP payload is (seq,flags,data))
+
+    messages() yields (timestamp,src,dst,message) for each DNS message
+    (UDP datagrams and TCP streams with a source or destination port in
+    ports - ports=None decodes all traffic as DNS)
+
+    """
+
+    def __init__(self,path=None,max_flows=10000,ports=DNS_PORTS,data=None):
+        if (path is None) == (data is None):
+            raise ValueError("Either path or data must be specified")
+        if path is not None:
+            f = open(path,"rb")
+            try:
+                self.data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        else:
+            self.data = data
+        self.max_flows = max_flows
+        self.ports = ports
+        self.errors = 0
+
+    def close(self):
+        if isinstance(self.data,mmap.mmap):
+            self.data.close()
+
+    def records(self,start=None,end=None,state=None):
+        """
+            Yield (timestamp,linktype,offset,length) for each frame -
+            optionally only for the frames in byte range start-end of the
+            capture (state is the reader state at start - see chunks)
+        """
+        return ( r[:4] for r in self._scan(start,end,state) )
+
+    def chunks(self,size):
+        """
+            Yield (start,end,state) byte ranges of the capture containing
+            up to size frames each (for records) - only the record
+            headers are read
+        """
+        start = state = None
+        count = 0
+        for ts,linktype,offset,length,next,current in self._scan():
+            count += 1
+            if count == size:
+                yield (start,next,state)
+                start,state,count = next,current,0
+        if count:
+            yield (start,None,state)
+
+    def _scan(self,start=None,end=None,state=None):
+        """
+            Return generator yielding (timestamp,linktype,offset,length,
+            next,state) for each frame - next is the offset of the
+            following record/block and state the reader state (needed to
+            resume reading at next)
+        """
+        data = self.data
+        if len(data) < 24:
+            raise PcapError("Invalid capture header")
+        (magic,) = struct.unpack_from("<I",data)
+        if magic == PCAPNG_SHB:
+            return self._pcapng_records(start,end,state)
+        return self._pcap_records(start,end)
+
+    def _pcap_records(self,start=None,end=None):
+        data = self.data
+        for endian in ("<",">"):
+            (magic,) = struct.unpack_from(endian + "I",data)
+            if magic in PCAP_MAGIC:
+                break
+        else:
+            raise PcapError("Invalid pcap magic: %r" % data[:4])
+        scale = magic == 0xa1b23c4d and 1e-9 or 1e-6
+        (linktype,) = struct.unpack_from(endian + "I",data,20)
+        record = struct.Struct(endian + "IIII")
+        offset = start or 24
+        size = len(data)
+        if end is None:
+            end = size
+        while offset + 16 <= end:
+            sec,frac,caplen,length = record.unpack_from(data,offset)
+            offset += 16
+            if offset + caplen > size:
+                break
+            yield (sec + frac * scale,linktype,offset,caplen,
+                   offset + caplen,None)
+            offset += caplen
+
+    def _pcapng_records(self,start=None,end=None,state=None):
+        data = self.data
+        size = len(data)
+        if end is None:
+            end = size
+        offset = start or 0
+        # Byte order and interfaces (linktype,scale) of current section
+        endian,interfaces = state or ("<",())
+        while offset + 12 <= end:
+            (btype,) = struct.unpack_from(endian + "I",data,offset)
+            if btype == PCAPNG_SHB:
+                (bom,) = struct.unpack_from("<I",data,offset + 8)
+                endian = bom == PCAPNG_BOM and "<" or ">"
+                interfaces = ()
+            (btype,blen) = struct.unpack_from(endian + "II",data,offset)
+            if blen < 12 or offset + blen > size:
+                break
+            body = offset + 8
+            if btype == 1:
+                # Interface Description Block
+                (linktype,) = struct.unpack_from(endian + "H",data,body)
+                scale = 1e-6
+                opt = body + 8
+                while opt + 4 <= offset + blen - 4:
+                    code,olen = struct.unpack_from(endian + "HH",data,opt)
+                    if code == 0:
+                        break
+                    if code == 9 and olen >= 1:
+                        # if_tsresol
+                        res = ord(data[opt + 4])
+                        scale = res & 0x80 and 2.0 ** -(res & 0x7f) or \
+                                               10.0 ** -res
+                    opt += 4 + ((olen + 3) & ~3)
+                interfaces += ((linktype,scale),)
+            elif btype == 6:
+                # Enhanced Packet Block
+                iface,high,low,caplen,length = \
+                        struct.unpack_from(endian + "IIIII",data,body)
+                if iface < len(interfaces):
+                    linktype,scale = interfaces[iface]
+                    yield (((high << 32) | low) * scale,linktype,
+                           body + 20,caplen,offset + blen,(endian,interfaces))
+            elif btype == 3:
+                # Simple Packet Block (no timestamp)
+                (length,) = struct.unpack_from(endian + "I",data,body)
+                if interfaces:
+                    yield (0.0,interfaces[0][0],body + 4,
+                           min(length,blen - 16),offset + blen,
+                           (endian,interfaces))
+            offset += blen
+
+    def packets(self):
+        data = self.data
+        for ts,linktype,offset,length in self.records():
+            ip = decode_link(linktype,data[offset:offset + length])
+            if ip is None:
+                continue
+            decoded = decode_ip(ip)
+            if decoded is None:
+                continue
+            src,dst,proto,payload = decoded
+            if proto == 17 and len(payload) >= 8:
+                sport,dport = struct.unpack("!HH",payload[:4])
+                yield (ts,(src,sport),(dst,dport),17,payload[8:])
+            elif proto == 6 and len(payload) >= 20:
+                sport,dport,seq,ack,hlen,flags = \
+                            struct.unpack("!HHIIBB",payload[:14])
+                yield (ts,(src,sport),(dst,dport),6,
+                       (seq,flags,payload[(hlen >> 4) * 4:]))
+
+    def messages(self,parser=None):
+        """
+            Yield (timestamp,src,dst,message) for DNS messages - message
+            is passed through parser if specified (messages which fail
+            to parse are skipped and counted in self.errors)
+        """
+        flows = OrderedDict()
+        ports = self.ports
+        def add_flow(key,stream):
+            # Bound per-flow state (oldest flow is evicted)
+            flows.pop(key,None)
+            flows[key] = stream
+            if len(flows) > self.max_flows:
+                flows.popitem(last=False)
+            return stream
+        for ts,src,dst,proto,payload in self.packets():
+            if ports is not None and src[1] not in ports and \
+                    dst[1] not in ports:
+                continue
+            if proto == 17:
+                messages = [payload]
+            else:
+                seq,flags,segment = payload
+                key = (src,dst)
+                if flags & SYN:
+                    add_flow(key,TCPStream((seq + 1) & 0xffffffff))
+                    continue
+                stream = flows.get(key)
+                if stream is None:
+                    if not segment:
+                        continue
+                    # Joined mid-stream - assume segment starts a message
+                    stream = add_flow(key,TCPStream(seq))
+                messages = segment and stream.add(seq,segment) or []
+                if flags & (FIN|RST):
+                    flows.pop(key,None)
+            for message in messages:
+                if parser is not None:
+                    try:
+                        message = parser(message)
+                    except PARSE_ERRORS:
+                        self.errors += 1
+                        continue
+                yield (ts,src,dst,message)
+
+def lazy_parse(data):
+    return DNSRecord.parse(data,lazy=True)
+
+def read_dns(path=None,parser=lazy_parse,ports=DNS_PORTS,data=None):
+    """
+        Read capture (file path or data buffer) and yield (timestamp,src,dst,
+        message) for each DNS message (UDP or TCP on ports). By default
+        messages are returned as lazily parsed DNSRecords (parser=None
+        returns the raw message data)
+    """
+    reader = PcapReader(path,ports=ports,data=data)
+    try:
+        for m in reader.messages(parser):
+            yield m
+    finally:
+        reader.close()
+
+def read_pcap(f):
+    """
+        Read pcap file object and yield (timestamp,(src,sport),(dst,dport),
+        payload) for each UDP packet
+    """
+    try:
+        reader = PcapReader(data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+    except (AttributeError,IOError,ValueError,EnvironmentError):
+        reader = PcapReader(data=f.read())
+    try:
+        for ts,src,dst,proto,payload in reader.packets():
+            if proto == 17:
+                yield (ts,src,dst,payload)
+    finally:
+        reader.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
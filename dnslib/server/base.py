@@ -0,0 +1,561 @@
+
+"""
+    DNS server framework
+
+    DNSServer receives UDP requests and passes each request through the
+    following stages:
+
+        parse   - DNSRecord.parse
+        resolve - resolver.resolve(request,client) returns the reply as a
+                  DNSRecord or in packed form (eg. from DNSCache) - or
+                  None to drop the request
+        pack    - reply.pack() (replies larger than the client UDP
+                  payload size are truncated)
+                  If response rate limiting is enabled (see rrl.RRL) the
+                  reply is checked before it is packed and may be
+                  dropped or replaced by a truncated reply
+        send    - socket.sendto (responses to requests read in the same
+                  wakeup are sent as a batch - see mmsg.BatchSocket)
+
+    Resolvers subclass BaseResolver and implement resolve.
+
+    Instrumentation is optional - if a hooks object (see ServerHooks) is
+    passed to the server it is called around each stage (when no hooks
+    are configured the only cost is a test per stage). Responses can
+    also be logged to a querylog (see querylog.QueryLog).
+
+    >>> class TestResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         reply = make_reply(request)
+    ...         if request.q.qtype == QTYPE.A:
+    ...             for i in range(int(request.q.qname.label[0])):
+    ...                 reply.add_answer(RR(request.q.qname,rdata=A("1.2.3.4")))
+    ...         return reply
+    >>> class PrintHooks(ServerHooks):
+    ...     def query(self,request):
+    ...         print "query", request.q.qname, QTYPE[request.q.qtype]
+    ...     def response(self,request,rcode,truncated):
+    ...         print "response", RCODE[rcode], truncated
+    ...     def drop(self,reason):
+    ...         print "drop", reason
+    >>> server = DNSServer(TestResolver(),("127.0.0.1",0),hooks=PrintHooks())
+    >>> reply = DNSRecord.parse(server.handle(DNSRecord(q=DNSQuestion("2.abc.com")).pack(),None))
+    query 2.abc.com A
+    response None False
+    >>> len(reply.rr)
+    2
+    >>> reply = DNSRecord.parse(server.handle(DNSRecord(q=DNSQuestion("40.abc.com")).pack(),None))
+    query 40.abc.com A
+    response None True
+    >>> print reply.header
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,TC,RD,RA rcode=None q=1 a=0 ns=0 ar=0>
+    >>> server.handle("xxx",None) is None
+    drop malformed
+    True
+
+    Replies which cannot be packed are answered with SERVFAIL:
+
+    >>> class BadResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         reply = make_reply(request)
+    ...         reply.add_answer(RR(request.q.qname,QTYPE.TXT,rdata=TXT("x" * 300)))
+    ...         return reply
+    >>> bad = DNSServer(BadResolver(),("127.0.0.1",0),hooks=PrintHooks())
+    >>> print DNSRecord.parse(bad.handle(DNSRecord(q=DNSQuestion("abc.com")).pack(),None)).header
+    query abc.com A
+    drop pack
+    response Server failure False
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=Server failure q=1 a=0 ns=0 ar=0>
+    >>> bad.hooks = None
+    >>> bad.start_thread()
+    >>> print RCODE[DNSRecord(q=DNSQuestion("abc.com")).send(*bad.address).header.rcode]
+    Server failure
+    >>> bad.stop()
+
+    Run server in background thread:
+
+    >>> server.hooks = None
+    >>> server.start_thread()
+    >>> print DNSRecord(q=DNSQuestion("1.abc.com")).send(*server.address).a
+    <DNS RR: '1.abc.com' rtype=A rclass=IN ttl=0 rdata='1.2.3.4'>
+    >>> server.stop()
+
+"""
+
+import select,socket,struct,threading,time
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, RR, A, TXT, QTYPE, RCODE
+from dnslib.bit import get_bits, set_bits
+from dnslib.dns import DNSError
+from dnslib.cache import ClientSubnet, DNSCache, response_opt
+from dnslib.server.mmsg import BatchSocket
+
+# Exceptions raised by DNSRecord.parse for malformed packets
+PARSE_ERRORS = (DNSError,struct.error,IndexError,ValueError)
+
+timer = time.time
+
+def make_reply(request,rcode=0):
+    """
+        Return empty reply (AA/RA set) for request
+    """
+    header = DNSHeader(id=request.header.id,bitmap=request.header.bitmap,
+                       qr=1,aa=1,ra=1,rcode=rcode)
+    return DNSRecord(header,questions=list(request.questions))
+
+def reply_bitmap(reply):
+    """
+        Header flags from reply (DNSRecord or packed)
+    """
+    if isinstance(reply,DNSRecord):
+        return reply.header.bitmap
+    return struct.unpack_from("!H",str(reply[2:4]))[0]
+
+def udp_size(request):
+    """
+        Maximum UDP response size for request (EDNS payload size or 512)
+    """
+    for rr in request.ar:
+        if rr.rtype == QTYPE.OPT:
+            return max(rr.rclass,512)
+    return 512
+
+class ServerHooks(object):
+
+    """
+    Server instrumentation hooks (no-op base class)
+
+    stage(name,start) is called at the end of each stage (parse, resolve,
+    pack, send) with the timer value at the start of the stage and
+    returns the current timer value (the start of the next stage)
+
+    drop(reason) is called when a request is dropped or fails - reason
+    is one of malformed, resolver, rrl, pack (reply could not be packed
+    and SERVFAIL was sent), send, shed or error (unexpected exception)
+    """
+
+    def stage(self,name,start):
+        return timer()
+
+    def query(self,request):
+        pass
+
+    def response(self,request,rcode,truncated):
+        pass
+
+    def drop(self,reason):
+        pass
+
+    def cache(self,hit):
+        pass
+
+class BaseResolver(object):
+
+    """
+    Base resolver - returns NXDOMAIN for all requests (subclasses
+    implement resolve)
+    """
+
+    def resolve(self,request,client):
+        return make_reply(request,RCODE.lookup('Name Error'))
+
+def start_thread(func,*args):
+    """
+        Run func(*args) in daemon thread
+    """
+    t = threading.Thread(target=func,args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+class CachingResolver(BaseResolver):
+
+    """
+    Answer requests from DNSCache (in packed form) - cache misses are
+    passed to resolver and the reply cached. Cache hits/misses are
+    reported to hooks (if specified)
+
+        prefetch        - refresh entries in the background (using spawn)
+                          once this fraction of the TTL has elapsed (eg.
+                          0.9 - default: no prefetch)
+        prefetch_hits   - only refresh entries which have been returned
+                          at least this many times
+        recheck         - after an upstream failure stale entries are
+                          served without retrying upstream for recheck
+                          seconds
+
+    If the cache keeps stale entries (DNSCache max_stale) these are
+    returned when the resolver fails (raises an exception, returns None
+    or SERVFAIL) - RFC 8767
+
+    >>> class CountResolver(BaseResolver):
+    ...     count = 0
+    ...     fail = False
+    ...     def resolve(self,request,client):
+    ...         if self.fail:
+    ...             raise IOError("Upstream failed")
+    ...         self.count += 1
+    ...         reply = make_reply(request)
+    ...         reply.add_answer(RR(request.q.qname,rdata=A("1.2.3.4"),ttl=60))
+    ...         return reply
+    >>> upstream = CountResolver()
+    >>> resolver = CachingResolver(upstream)
+    >>> for i in range(3):
+    ...     reply = resolver.resolve(DNSRecord(q=DNSQuestion("abc.com")),None)
+    >>> upstream.count
+    1
+    >>> print DNSRecord.parse(str(reply)).a
+    <DNS RR: 'abc.com' rtype=A rclass=IN ttl=60 rdata='1.2.3.4'>
+
+    Prefetch and serve stale:
+
+    >>> now = [0]
+    >>> upstream = CountResolver()
+    >>> cache = DNSCache(clock=lambda:now[0],max_stale=3600)
+    >>> resolver = CachingResolver(upstream,cache,prefetch=0.8,
+    ...                            spawn=lambda f,*args:f(*args))
+    >>> def ttl():
+    ...     reply = resolver.resolve(DNSRecord(q=DNSQuestion("abc.com")),None)
+    ...     if not isinstance(reply,DNSRecord):
+    ...         reply = DNSRecord.parse(str(reply))
+    ...     return reply.a.ttl
+    >>> [ ttl() for i in range(3) ], upstream.count
+    ([60, 60, 60], 1)
+    >>> now[0] = 50
+    >>> ttl(), upstream.count
+    (10, 2)
+    >>> now[0] = 70
+    >>> ttl(), upstream.count
+    (40, 2)
+    >>> upstream.fail = True
+    >>> now[0] = 200
+    >>> ttl(), ttl(), resolver.stale
+    (30, 30, 2)
+
+    Answers tailored to the client subnet (ECS) are cached with the
+    scope returned by the upstream and the RD/CD flags of cached answers
+    are taken from the request:
+
+    >>> class ECSResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         subnet = ClientSubnet.from_record(request)
+    ...         reply = make_reply(request)
+    ...         ip = ".".join([str(ord(subnet.address[0]))] * 4)
+    ...         reply.add_answer(RR(request.q.qname,rdata=A(ip),ttl=60))
+    ...         subnet.scope = 8
+    ...         reply.add_ar(RR("",QTYPE.OPT,4096,rdata=[subnet.option()]))
+    ...         return reply
+    >>> resolver = CachingResolver(ECSResolver())
+    >>> def query(address,cd=0):
+    ...     request = DNSRecord(q=DNSQuestion("abc.com"))
+    ...     request.header.bitmap = set_bits(request.header.bitmap,cd,4)
+    ...     request.add_ar(RR("",QTYPE.OPT,4096,
+    ...                       rdata=[ClientSubnet(address,24).option()]))
+    ...     reply = resolver.resolve(request,None)
+    ...     if not isinstance(reply,DNSRecord):
+    ...         reply = DNSRecord.parse(str(reply))
+    ...     return str(reply.a.rdata), get_bits(reply.header.bitmap,4)
+    >>> query("10.1.2.3"), query("20.1.2.3"), query("10.9.9.9",cd=1)
+    (('10.10.10.10', 0), ('20.20.20.20', 0), ('10.10.10.10', 1))
+
+    Cached responses are returned with an OPT RR built from the request
+    (the ECS option of the client which caused the response to be cached
+    is not replayed and clients without EDNS get no OPT RR):
+
+    >>> class EchoResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         reply = make_reply(request)
+    ...         reply.add_answer(RR(request.q.qname,rdata=A("1.2.3.4"),ttl=60))
+    ...         for rr in request.ar:
+    ...             reply.add_ar(rr)
+    ...         return reply
+    >>> resolver = CachingResolver(EchoResolver())
+    >>> def query(address=None):
+    ...     request = DNSRecord(q=DNSQuestion("abc.com"))
+    ...     if address:
+    ...         request.add_ar(RR("",QTYPE.OPT,4096,
+    ...                           rdata=[ClientSubnet(address,24).option()]))
+    ...     reply = resolver.resolve(request,None)
+    ...     if not isinstance(reply,DNSRecord):
+    ...         reply = DNSRecord.parse(str(reply))
+    ...     return len(reply.ar), ClientSubnet.from_record(reply)
+    >>> query("10.1.2.3")
+    (1, <ClientSubnet: 10.1.2.0/24 scope=0>)
+    >>> query()
+    (0, None)
+    >>> query("20.1.2.3")
+    (1, <ClientSubnet: 20.1.2.0/24 scope=0>)
+    """
+
+    def __init__(self,resolver,cache=None,hooks=None,prefetch=None,
+                      prefetch_hits=2,recheck=30,spawn=start_thread):
+        self.resolver = resolver
+        if cache is None:
+            cache = DNSCache()
+        self.cache = cache
+        self.hooks = hooks
+        self.prefetch = prefetch
+        self.prefetch_hits = prefetch_hits
+        self.recheck = recheck
+        self.spawn = spawn
+        self.prefetches = 0
+        self.stale = 0
+
+    def resolve(self,request,client):
+        q = request.q
+        subnet = ClientSubnet.from_record(request)
+        now = self.cache.clock()
+        entry = self.cache.lookup(q.qname,q.qtype,subnet,now,
+                                  stale=self.cache.max_stale > 0)
+        fresh = entry is not None and entry.valid(now)
+        if self.hooks is not None:
+            self.hooks.cache(fresh)
+        if fresh:
+            if self.prefetch and not entry.refreshing and \
+                    entry.hits >= self.prefetch_hits and \
+                    entry.age(now) >= self.prefetch:
+                entry.refreshing = True
+                self.prefetches += 1
+                self.spawn(self.refresh,entry,request,client,subnet)
+            return self.get_packet(entry,request,now)
+        if entry is not None and entry.failed is not None and \
+                now - entry.failed < self.recheck:
+            return self.serve_stale(entry,request,now)
+        try:
+            reply = self.resolver.resolve(request,client)
+        except Exception:
+            if entry is None:
+                raise
+            reply = None
+        if reply is not None:
+            if not isinstance(reply,DNSRecord):
+                reply = DNSRecord.parse(str(reply))
+            if entry is None or reply.header.rcode != RCODE.lookup('Server failure'):
+                # ECS source/scope are taken from the reply
+                self.cache.put(reply)
+                return reply
+        if entry is None:
+            return reply
+        entry.failed = now
+        return self.serve_stale(entry,request,now)
+
+    def get_packet(self,entry,request,now):
+        """
+            Cached response for request (header id/RD/CD and OPT RR are
+            taken from the request)
+        """
+        return entry.get_packet(now,request.header.id,request.header.rd,
+                                get_bits(request.header.bitmap,4),
+                                self.cache.stale_ttl,
+                                response_opt(request,entry.scope))
+
+    def serve_stale(self,entry,request,now):
+        self.stale += 1
+        return self.get_packet(entry,request,now)
+
+    def refresh(self,entry,request,client,subnet):
+        """
+            Resolve request and replace cache entry (called in background)
+        """
+        try:
+            reply = self.resolver.resolve(request,client)
+            if reply is not None:
+                if not isinstance(reply,DNSRecord):
+                    reply = DNSRecord.parse(str(reply))
+                if reply.header.rcode != RCODE.lookup('Server failure'):
+                    self.cache.put(reply)
+        except Exception:
+            pass
+        finally:
+            entry.refreshing = False
+
+class DNSServer(object):
+
+    """
+    UDP DNS server - resolver is a BaseResolver instance, hooks
+    (optional) a ServerHooks instance, querylog (optional) a QueryLog
+    instance and rrl (optional) an RRL instance - batch is the maximum
+    number of datagrams read/sent per system call
+    """
+
+    def __init__(self,resolver,address=("",53),hooks=None,querylog=None,
+                      rrl=None,batch=64):
+        self.resolver = resolver
+        self.batch = batch
+        self.hooks = hooks
+        self.querylog = querylog
+        self.rrl = rrl
+        self.socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.address = self.socket.getsockname()
+        self.running = False
+        self.thread = None
+
+    def handle(self,data,client):
+        """
+            Process request data and return response data (or None if the
+            request is dropped)
+        """
+        hooks = self.hooks
+        querylog = self.querylog
+        if hooks is not None or querylog is not None:
+            start = t = timer()
+        try:
+            request = DNSRecord.parse(data)
+        except PARSE_ERRORS:
+            if hooks is not None:
+                hooks.drop('malformed')
+            return None
+        if not request.questions or request.header.qr:
+            if hooks is not None:
+                hooks.drop('malformed')
+            return None
+        if hooks is not None:
+            t = hooks.stage('parse',t)
+            hooks.query(request)
+        try:
+            reply = self.resolver.resolve(request,client)
+        except Exception:
+            reply = make_reply(request,RCODE.lookup('Server failure'))
+        if reply is None:
+            if hooks is not None:
+                hooks.drop('resolver')
+            return None
+        if hooks is not None:
+            t = hooks.stage('resolve',t)
+        try:
+            if self.rrl is not None and client is not None:
+                action = self.rrl.check(client,request,reply)
+                if action == self.rrl.DROP:
+                    if hooks is not None:
+                        hooks.drop('rrl')
+                    return None
+                elif action == self.rrl.SLIP:
+                    response,truncated = self.truncate(request,reply_bitmap(reply)),True
+                else:
+                    response,truncated = self.pack(request,reply)
+            else:
+                response,truncated = self.pack(request,reply)
+        except PARSE_ERRORS:
+            # Reply could not be packed (eg. invalid rdata) - SERVFAIL
+            if hooks is not None:
+                hooks.drop('pack')
+            response = make_reply(request,RCODE.lookup('Server failure')).pack()
+            truncated = False
+        if hooks is not None or querylog is not None:
+            bitmap = reply_bitmap(response)
+            if hooks is not None:
+                hooks.stage('pack',t)
+                hooks.response(request,bitmap & 0xf,truncated)
+            if querylog is not None:
+                querylog.log(start,client,request,bitmap & 0xf,timer() - start)
+        return response
+
+    def pack(self,request,reply):
+        """
+            Pack reply (if not already packed) and truncate if larger
+            than the client UDP payload size - returns (data,truncated)
+        """
+        if isinstance(reply,DNSRecord):
+            data = reply.pack()
+        else:
+            data = reply
+        if len(data) <= udp_size(request):
+            return data,False
+        return self.truncate(request,reply_bitmap(data)),True
+
+    def truncate(self,request,bitmap):
+        """
+            Return packed truncated (TC=1) reply with header flags from
+            bitmap and question section from request
+        """
+        truncated = DNSRecord(DNSHeader(id=request.header.id,bitmap=bitmap,tc=1),
+                              questions=list(request.questions))
+        return truncated.pack()
+
+    def send(self,data,client):
+        hooks = self.hooks
+        if hooks is not None:
+            t = timer()
+        try:
+            self.socket.sendto(data,client)
+        except socket.error:
+            if hooks is not None:
+                hooks.drop('send')
+            return
+        if hooks is not None:
+            hooks.stage('send',t)
+
+    def process(self,data,client):
+        response = self.handle(data,client)
+        if response is not None:
+            self.send(response,client)
+
+    def send_batch(self,responses):
+        """
+            Send list of (data,client) - the send stage is timed per
+            batch
+        """
+        hooks = self.hooks
+        if hooks is not None:
+            t = timer()
+        sent = self.batch_socket.send(responses)
+        if hooks is not None:
+            hooks.stage('send',t)
+            for i in xrange(len(responses) - sent):
+                hooks.drop('send')
+
+    def serve_forever(self,pool=None):
+        """
+            Serve requests - all datagrams which are ready are read per
+            wakeup (see mmsg.BatchSocket) and the responses sent as a
+            batch (or if pool - a pool.WorkerPool - is specified the
+            requests are queued to the pool so that resolvers which block
+            do not stop the server reading requests)
+        """
+        self.running = True
+        self.batch_socket = sock = BatchSocket(self.socket,self.batch)
+        handle = self.handle
+        while self.running:
+            try:
+                r,w,x = select.select([sock],[],[],0.5)
+                if not r:
+                    continue
+                messages = sock.recv()
+            except (select.error,socket.error):
+                if not self.running:
+                    break
+                continue
+            if pool is not None:
+                for data,client in messages:
+                    pool.submit(data,client)
+                continue
+            responses = []
+            for data,client in messages:
+                try:
+                    response = handle(data,client)
+                except Exception:
+                    # Never let a single request stop the server
+                    if self.hooks is not None:
+                        self.hooks.drop('error')
+                    continue
+                if response is not None:
+                    responses.append((response,client))
+            if responses:
+                self.send_batch(responses)
+
+    def start_thread(self,pool=None):
+        self.thread = threading.Thread(target=self.serve_forever,args=(pool,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.socket.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -1,51 +1,100 @@
 #!/usr/bin/env python
 
-import gevent
-from gevent import socket
+"""
+    Simple test DNS server using gevent (requests are handled by a bounded
+    pool of greenlets - see dnslib.server.pool)
+
+    Options:
+
+      --port=PORT           Server port (default: 53)
+      --bind=BIND           Server bind address (default: all)
+      --metrics=PORT        Export Prometheus metrics on 127.0.0.1:PORT
+      --querylog=FILE       Write query log (NDJSON) to FILE
+      --sample=RATE         Query log sample rate (default: 1.0)
+      --rrl=RATE            Enable response rate limiting (responses/sec)
+      --workers=N           Number of worker greenlets (default: 100)
+      --queue=N             Maximum queued requests (default: 1000)
+      --shed=MODE           Overload action - servfail/drop (default: servfail)
+      --threads=N           Run resolver in thread pool of N threads
+
+"""
+
+import gevent,gevent.threadpool
 
 from gevent import monkey
 monkey.patch_socket()
 
-from dnslib import A, AAAA, CNAME, MX, RR, TXT
-from dnslib import DNSHeader, DNSRecord, QTYPE
-
-AF_INET = 2
-SOCK_DGRAM = 2
+import optparse
 
-s = socket.socket(AF_INET, SOCK_DGRAM)
-s.bind(('', 53))
+from dnslib import A, AAAA, CNAME, MX, RR, TXT
+from dnslib import QTYPE
+from dnslib.server.base import BaseResolver, DNSServer, make_reply
+from dnslib.server.metrics import Metrics, MetricsServer
+from dnslib.server.pool import ThreadPoolResolver, WorkerPool
+from dnslib.server.querylog import QueryLog
+from dnslib.server.rrl import RRL
 
 IP = "127.0.0.1"
 IPV6 = (0,) * 16
 MSG = "gevent_server.py"
 
+class TestResolver(BaseResolver):
+
+    def resolve(self,request,client):
+        reply = make_reply(request)
+        qname = request.q.qname
+        qtype = request.q.qtype
+        if qtype == QTYPE.A:
+            reply.add_answer(RR(qname, qtype,       rdata=A(IP)))
+        if qtype == QTYPE.AAAA:
+            reply.add_answer(RR(qname, qtype,       rdata=AAAA(IPV6)))
+        elif qtype == QTYPE['*']:
+            reply.add_answer(RR(qname, QTYPE.A,     rdata=A(IP)))
+            reply.add_answer(RR(qname, QTYPE.MX,    rdata=MX(IP)))
+            reply.add_answer(RR(qname, QTYPE.TXT,   rdata=TXT(MSG)))
+        else:
+            reply.add_answer(RR(qname, QTYPE.CNAME, rdata=CNAME(MSG)))
+        return reply
+
+parser = optparse.OptionParser(usage="Usage: %prog [options]")
+parser.add_option("--port",type=int,default=53,help="Server port (default: 53)")
+parser.add_option("--bind",default="",help="Server bind address (default: all)")
+parser.add_option("--metrics",type=int,help="Export Prometheus metrics on 127.0.0.1:PORT")
+parser.add_option("--querylog",help="Write query log (NDJSON) to FILE")
+parser.add_option("--sample",type=float,default=1.0,help="Query log sample rate (default: 1.0)")
+parser.add_option("--rrl",type=float,help="Enable response rate limiting (responses/sec)")
+parser.add_option("--workers",type=int,default=100,help="Number of worker greenlets (default: 100)")
+parser.add_option("--queue",type=int,default=1000,help="Maximum queued requests (default: 1000)")
+parser.add_option("--shed",choices=("servfail","drop"),default="servfail",help="Overload action - servfail/drop (default: servfail)")
+parser.add_option("--threads",type=int,help="Run resolver in thread pool of N threads")
+options,args = parser.parse_args()
+
+hooks = None
+if options.metrics:
+    hooks = Metrics()
+    MetricsServer(hooks.registry,("127.0.0.1",options.metrics)).start_thread()
+
+querylog = None
+if options.querylog:
+    querylog = QueryLog(options.querylog,sample=options.sample)
+
+rrl = None
+if options.rrl:
+    rrl = RRL(rate=options.rrl)
+
+resolver = TestResolver()
+if options.threads:
+    resolver = ThreadPoolResolver(resolver,
+                                  gevent.threadpool.ThreadPool(options.threads))
+
+server = DNSServer(resolver,(options.bind,options.port),hooks=hooks,
+                   querylog=querylog,rrl=rrl)
 
-def dns_handler(s, peer, data):
-    request = DNSRecord.parse(data)
-    id = request.header.id
-    qname = request.q.qname
-    qtype = request.q.qtype
-    print "------ Request (%s): %r (%s)" % (str(peer),
-            qname.label, QTYPE[qtype])
-    print request
-
-    reply = DNSRecord(DNSHeader(id=id, qr=1, aa=1, ra=1), q=request.q)
-    if qtype == QTYPE.A:
-        reply.add_answer(RR(qname, qtype,       rdata=A(IP)))
-    if qtype == QTYPE.AAAA:
-        reply.add_answer(RR(qname, qtype,       rdata=AAAA(IPV6)))
-    elif qtype == QTYPE['*']:
-        reply.add_answer(RR(qname, QTYPE.A,     rdata=A(IP)))
-        reply.add_answer(RR(qname, QTYPE.MX,    rdata=MX(IP)))
-        reply.add_answer(RR(qname, QTYPE.TXT,   rdata=TXT(MSG)))
-    else:
-        reply.add_answer(RR(qname, QTYPE.CNAME, rdata=CNAME(MSG)))
-
-    print "------ Reply"
-    print reply 
-
-    s.sendto(reply.pack(), peer)
+pool = WorkerPool(server,workers=options.workers,queue_size=options.queue,
+                  shed=options.shed,use_gevent=True)
+if hooks:
+    pool.register(hooks.registry)
 
 while True:
-    data, peer = s.recvfrom(8192)
-    gevent.spawn(dns_handler, s, peer, data)
+    data, peer = server.socket.recvfrom(8192)
+    pool.submit(data, peer)
@@ -0,0 +1,299 @@
+
+"""
+    Server metrics in Prometheus text format
+
+    Metrics implements the DNSServer hooks (see base.ServerHooks) and
+    records:
+
+        dns_queries_total{qtype}            - queries by qtype
+        dns_responses_total{rcode}          - responses by rcode
+        dns_truncated_total                 - truncated responses
+        dns_dropped_total{reason}           - dropped requests
+        dns_cache_total{result}             - cache hits/misses
+        dns_stage_seconds{stage}            - latency histogram per stage
+                                              (parse/resolve/pack/send)
+
+    Further metrics can be added to metrics.registry. MetricsServer
+    exports the registry over HTTP (GET /metrics).
+
+    >>> m = Metrics()
+    >>> request = DNSRecord(q=DNSQuestion("abc.com",QTYPE.MX))
+    >>> m.query(request)
+    >>> m.response(request,3,True)
+    >>> m.cache(False)
+    >>> m.stage_seconds.observe(0.0003,('parse',))
+    >>> print m.registry.render(),
+    # HELP dns_queries_total DNS queries by qtype
+    # TYPE dns_queries_total counter
+    dns_queries_total{qtype="MX"} 1
+    # HELP dns_responses_total DNS responses by rcode
+    # TYPE dns_responses_total counter
+    dns_responses_total{rcode="NXDOMAIN"} 1
+    # HELP dns_truncated_total Truncated DNS responses
+    # TYPE dns_truncated_total counter
+    dns_truncated_total 1
+    # HELP dns_dropped_total Dropped DNS requests by reason
+    # TYPE dns_dropped_total counter
+    # HELP dns_cache_total DNS cache lookups by result
+    # TYPE dns_cache_total counter
+    dns_cache_total{result="miss"} 1
+    # HELP dns_stage_seconds DNS request processing time by stage
+    # TYPE dns_stage_seconds histogram
+    dns_stage_seconds_bucket{stage="parse",le="0.0001"} 0
+    dns_stage_seconds_bucket{stage="parse",le="0.00025"} 0
+    dns_stage_seconds_bucket{stage="parse",le="0.0005"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.001"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.0025"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.005"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.01"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.025"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.05"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.1"} 1
+    dns_stage_seconds_bucket{stage="parse",le="0.25"} 1
+    dns_stage_seconds_bucket{stage="parse",le="1"} 1
+    dns_stage_seconds_bucket{stage="parse",le="+Inf"} 1
+    dns_stage_seconds_sum{stage="parse"} 0.0003
+    dns_stage_seconds_count{stage="parse"} 1
+
+    >>> server = MetricsServer(m.registry,("127.0.0.1",0))
+    >>> server.start_thread()
+    >>> import urllib2
+    >>> body = urllib2.urlopen("http://%s:%d/metrics" % server.address).read()
+    >>> 'dns_queries_total{qtype="MX"} 1' in body
+    True
+    >>> server.stop()
+
+"""
+
+import bisect,threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from dnslib import DNSRecord, DNSQuestion, QTYPE
+from dnslib.server.base import ServerHooks, timer
+
+# Prometheus rcode names
+RCODE_NAMES = { 0:'NOERROR', 1:'FORMERR', 2:'SERVFAIL', 3:'NXDOMAIN',
+                4:'NOTIMP', 5:'REFUSED', 6:'YXDOMAIN', 7:'YXRRSET',
+                8:'NXRRSET', 9:'NOTAUTH', 10:'NOTZONE' }
+
+DEFAULT_BUCKETS = (0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,
+                   0.025,0.05,0.1,0.25,1)
+
+def format_value(v):
+    """
+        >>> format_value(1), format_value(0.5), format_value(float('inf'))
+        ('1', '0.5', '+Inf')
+    """
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v,float) and v.is_integer():
+        return str(int(v))
+    return repr(v)
+
+def format_labels(names,values,extra=""):
+    labels = [ '%s="%s"' % (n,str(v).replace('\\','\\\\').replace('"','\\"'))
+                    for n,v in zip(names,values) ]
+    if extra:
+        labels.append(extra)
+    return labels and "{%s}" % ",".join(labels) or ""
+
+class Metric(object):
+
+    """
+    Base class - values are stored per label value tuple
+    """
+
+    type = 'untyped'
+
+    def __init__(self,name,help,labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def header(self):
+        return [ "# HELP %s %s" % (self.name,self.help),
+                 "# TYPE %s %s" % (self.name,self.type) ]
+
+    def render(self):
+        lines = self.header()
+        for key,value in sorted(self.values.items()):
+            lines.append("%s%s %s" % (self.name,format_labels(self.labels,key),
+                                      format_value(value)))
+        return lines
+
+class Counter(Metric):
+
+    """
+    Counter - either incremented explicitly or (if callback is specified)
+    read from callback() when rendered (for counts kept elsewhere)
+    """
+
+    type = 'counter'
+
+    def __init__(self,name,help,labels=(),callback=None):
+        Metric.__init__(self,name,help,labels)
+        self.callback = callback
+
+    def inc(self,labels=(),value=1):
+        self.values[labels] = self.values.get(labels,0) + value
+
+    def render(self):
+        if self.callback is not None:
+            self.values[()] = self.callback()
+        return Metric.render(self)
+
+class Gauge(Metric):
+
+    """
+    Gauge - either set explicitly or (if callback is specified) read
+    from callback() when rendered
+    """
+
+    type = 'gauge'
+
+    def __init__(self,name,help,labels=(),callback=None):
+        Metric.__init__(self,name,help,labels)
+        self.callback = callback
+
+    def set(self,value,labels=()):
+        self.values[labels] = value
+
+    def render(self):
+        if self.callback is not None:
+            self.values[()] = self.callback()
+        return Metric.render(self)
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self,name,help,labels=(),buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self,name,help,labels)
+        self.buckets = buckets
+
+    def observe(self,value,labels=()):
+        h = self.values.get(labels)
+        if h is None:
+            # [bucket counts...,sum]
+            h = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        h[bisect.bisect_left(self.buckets,value)] += 1
+        h[-1] += value
+
+    def render(self):
+        lines = self.header()
+        for key,h in sorted(self.values.items()):
+            total = 0
+            for le,count in zip(self.buckets + (float('inf'),),h):
+                total += count
+                lines.append("%s_bucket%s %d" % (self.name,
+                        format_labels(self.labels,key,'le="%s"' % format_value(le)),
+                        total))
+            lines.append("%s_sum%s %s" % (self.name,format_labels(self.labels,key),
+                                          format_value(h[-1])))
+            lines.append("%s_count%s %d" % (self.name,format_labels(self.labels,key),
+                                            total))
+        return lines
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self,metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+class Metrics(ServerHooks):
+
+    """
+    DNSServer hooks recording Prometheus metrics
+    """
+
+    def __init__(self,registry=None):
+        if registry is None:
+            registry = Registry()
+        self.registry = registry
+        self.queries = registry.add(Counter("dns_queries_total",
+                                "DNS queries by qtype",("qtype",)))
+        self.responses = registry.add(Counter("dns_responses_total",
+                                "DNS responses by rcode",("rcode",)))
+        self.truncated = registry.add(Counter("dns_truncated_total",
+                                "Truncated DNS responses"))
+        self.dropped = registry.add(Counter("dns_dropped_total",
+                                "Dropped DNS requests by reason",("reason",)))
+        self.cache_lookups = registry.add(Counter("dns_cache_total",
+                                "DNS cache lookups by result",("result",)))
+        self.stage_seconds = registry.add(Histogram("dns_stage_seconds",
+                                "DNS request processing time by stage",("stage",)))
+
+    def stage(self,name,start):
+        now = timer()
+        self.stage_seconds.observe(now - start,(name,))
+        return now
+
+    def query(self,request):
+        self.queries.inc((QTYPE[request.q.qtype],))
+
+    def response(self,request,rcode,truncated):
+        self.responses.inc((RCODE_NAMES.get(rcode,rcode),))
+        if truncated:
+            self.truncated.inc()
+
+    def drop(self,reason):
+        self.dropped.inc((reason,))
+
+    def cache(self,hit):
+        self.cache_lookups.inc((hit and "hit" or "miss",))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/","/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+class MetricsServer(object):
+
+    """
+    HTTP server exporting registry in Prometheus text format
+    (default address 127.0.0.1:9153)
+    """
+
+    def __init__(self,registry,address=("127.0.0.1",9153)):
+        self.httpd = HTTPServer(address,MetricsHandler)
+        self.httpd.registry = registry
+        self.address = self.httpd.server_address
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,290 @@
+
+"""
+    Batched UDP socket I/O
+
+    BatchSocket reads all datagrams which are ready (up to batch) per
+    call and sends responses in batches. On Linux recvmmsg/sendmmsg are
+    called through ctypes (one system call per batch) using preallocated
+    receive buffers - elsewhere (or if the calls are not available) a
+    non-blocking recvfrom/sendto loop is used.
+
+    Datagrams larger than bufsize are dropped (rather than returned
+    truncated) and counted in BatchSocket.truncated.
+
+    >>> import select
+    >>> server = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> server.bind(("127.0.0.1",0))
+    >>> client = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> client.bind(("127.0.0.1",0))
+    >>> for mmsg in (True,False):
+    ...     s = BatchSocket(server,batch=4,mmsg=mmsg)
+    ...     for i in range(6):
+    ...         n = client.sendto("message %d" % i,server.getsockname())
+    ...     r,w,x = select.select([s],[],[],1)
+    ...     batch = s.recv()
+    ...     print [ data for data,address in batch ]
+    ...     print [ data for data,address in s.recv() ]
+    ...     print s.recv()
+    ...     n = s.send([ (data.upper(),address) for data,address in batch ])
+    ...     print [ client.recvfrom(100)[0] for i in range(4) ]
+    ['message 0', 'message 1', 'message 2', 'message 3']
+    ['message 4', 'message 5']
+    []
+    ['MESSAGE 0', 'MESSAGE 1', 'MESSAGE 2', 'MESSAGE 3']
+    ['message 0', 'message 1', 'message 2', 'message 3']
+    ['message 4', 'message 5']
+    []
+    ['MESSAGE 0', 'MESSAGE 1', 'MESSAGE 2', 'MESSAGE 3']
+
+    IPv6:
+
+    >>> server6 = socket.socket(socket.AF_INET6,socket.SOCK_DGRAM)
+    >>> server6.bind(("::1",0))
+    >>> client6 = socket.socket(socket.AF_INET6,socket.SOCK_DGRAM)
+    >>> client6.bind(("::1",0))
+    >>> s = BatchSocket(server6)
+    >>> n = client6.sendto("abc",server6.getsockname()[:2])
+    >>> r,w,x = select.select([s],[],[],1)
+    >>> data,address = s.recv()[0]
+    >>> data, address == client6.getsockname()
+    ('abc', True)
+    >>> s.send([("xyz",address)])
+    1
+    >>> client6.recvfrom(100)[0]
+    'xyz'
+
+    Oversized datagrams:
+
+    >>> for mmsg in (True,False):
+    ...     s = BatchSocket(server,bufsize=16,mmsg=mmsg)
+    ...     for data in ("short","x" * 17,"x" * 16):
+    ...         n = client.sendto(data,server.getsockname())
+    ...     r,w,x = select.select([s],[],[],1)
+    ...     print [ data for data,address in s.recv() ], s.truncated
+    ['short', 'xxxxxxxxxxxxxxxx'] 1
+    ['short', 'xxxxxxxxxxxxxxxx'] 1
+
+"""
+
+import ctypes,ctypes.util,errno,socket,struct
+
+MSG_TRUNC = 0x20
+MSG_DONTWAIT = 0x40
+SOCKADDR_SIZE = 128
+
+class iovec(ctypes.Structure):
+    _fields_ = [ ("iov_base",ctypes.c_void_p),
+                 ("iov_len",ctypes.c_size_t) ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [ ("msg_name",ctypes.c_void_p),
+                 ("msg_namelen",ctypes.c_uint32),
+                 ("msg_iov",ctypes.POINTER(iovec)),
+                 ("msg_iovlen",ctypes.c_size_t),
+                 ("msg_control",ctypes.c_void_p),
+                 ("msg_controllen",ctypes.c_size_t),
+                 ("msg_flags",ctypes.c_int) ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [ ("msg_hdr",msghdr),
+                 ("msg_len",ctypes.c_uint) ]
+
+def load_libc():
+    """
+        Return (recvmmsg,sendmmsg) from libc (or (None,None) if not
+        available)
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError,AttributeError,TypeError):
+        return None,None
+    recvmmsg.argtypes = [ ctypes.c_int,ctypes.c_void_p,ctypes.c_uint,
+                          ctypes.c_int,ctypes.c_void_p ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ ctypes.c_int,ctypes.c_void_p,ctypes.c_uint,
+                          ctypes.c_int ]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg,sendmmsg
+
+recvmmsg,sendmmsg = load_libc()
+
+def decode_sockaddr(data):
+    """
+        Decode sockaddr_in/sockaddr_in6 to address tuple
+    """
+    (family,) = struct.unpack_from("=H",data)
+    if family == socket.AF_INET:
+        (port,) = struct.unpack_from("!H",data,2)
+        return (socket.inet_ntoa(data[4:8]),port)
+    elif family == socket.AF_INET6:
+        port,flowinfo = struct.unpack_from("!HI",data,2)
+        (scope,) = struct.unpack_from("=I",data,24)
+        return (socket.inet_ntop(socket.AF_INET6,data[8:24]),port,flowinfo,scope)
+    raise ValueError("Unsupported address family: %d" % family)
+
+def encode_sockaddr(address):
+    """
+        Encode address tuple as sockaddr_in/sockaddr_in6
+
+        >>> decode_sockaddr(encode_sockaddr(("192.0.2.1",53)))
+        ('192.0.2.1', 53)
+        >>> decode_sockaddr(encode_sockaddr(("2001:db8::1",53,0,0)))
+        ('2001:db8::1', 53, 0, 0)
+    """
+    if ":" in address[0]:
+        flowinfo = len(address) > 2 and address[2] or 0
+        scope = len(address) > 3 and address[3] or 0
+        return struct.pack("=H",socket.AF_INET6) + \
+               struct.pack("!HI",address[1],flowinfo) + \
+               socket.inet_pton(socket.AF_INET6,address[0]) + \
+               struct.pack("=I",scope)
+    return struct.pack("=H",socket.AF_INET) + struct.pack("!H",address[1]) + \
+           socket.inet_aton(address[0]) + "\x00" * 8
+
+class BatchSocket(object):
+
+    """
+    Batched I/O wrapper for UDP socket (the socket is set non-blocking)
+
+        batch   - maximum datagrams per recv/sendmmsg call
+        bufsize - receive buffer size per datagram
+        mmsg    - use recvmmsg/sendmmsg if available (default: True)
+    """
+
+    def __init__(self,sock,batch=64,bufsize=4096,mmsg=True):
+        self.sock = sock
+        self.batch = batch
+        self.bufsize = bufsize
+        self.mmsg = mmsg and recvmmsg is not None
+        self.truncated = 0
+        sock.setblocking(0)
+        if self.mmsg:
+            self.fd = sock.fileno()
+            # Preallocated receive buffers/headers
+            self.buffers = ctypes.create_string_buffer(batch * bufsize)
+            self.names = ctypes.create_string_buffer(batch * SOCKADDR_SIZE)
+            self.iovecs = (iovec * batch)()
+            self.rmsgs = (mmsghdr * batch)()
+            base = ctypes.addressof(self.buffers)
+            names = ctypes.addressof(self.names)
+            for i in range(batch):
+                self.iovecs[i].iov_base = base + i * bufsize
+                self.iovecs[i].iov_len = bufsize
+                hdr = self.rmsgs[i].msg_hdr
+                hdr.msg_name = names + i * SOCKADDR_SIZE
+                hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                hdr.msg_iovlen = 1
+            self.siovecs = (iovec * batch)()
+            self.smsgs = (mmsghdr * batch)()
+            for i in range(batch):
+                hdr = self.smsgs[i].msg_hdr
+                hdr.msg_iov = ctypes.pointer(self.siovecs[i])
+                hdr.msg_iovlen = 1
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self):
+        """
+            Return list of (data,address) for datagrams ready to be read
+            (up to batch) - does not block
+        """
+        if self.mmsg:
+            return self._recvmmsg()
+        messages = []
+        recvfrom = self.sock.recvfrom
+        bufsize = self.bufsize
+        try:
+            for i in xrange(self.batch):
+                # Read an extra byte to detect oversized datagrams
+                data,address = recvfrom(bufsize + 1)
+                if len(data) > bufsize:
+                    self.truncated += 1
+                    continue
+                messages.append((data,address))
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                raise
+        return messages
+
+    def _recvmmsg(self):
+        rmsgs = self.rmsgs
+        for i in xrange(self.batch):
+            rmsgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        n = recvmmsg(self.fd,ctypes.addressof(rmsgs),self.batch,MSG_DONTWAIT,None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                return []
+            raise socket.error(err,errno.errorcode.get(err,"recvmmsg"))
+        base = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        bufsize = self.bufsize
+        string_at = ctypes.string_at
+        messages = []
+        for i in xrange(n):
+            hdr = rmsgs[i]
+            if hdr.msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+                continue
+            data = string_at(base + i * bufsize,hdr.msg_len)
+            address = decode_sockaddr(string_at(names + i * SOCKADDR_SIZE,
+                                                hdr.msg_hdr.msg_namelen))
+            messages.append((data,address))
+        return messages
+
+    def send(self,messages):
+        """
+            Send list of (data,address) - datagrams which cannot be sent
+            (socket buffer full) are dropped. Returns number sent.
+        """
+        if self.mmsg:
+            sent = 0
+            for i in xrange(0,len(messages),self.batch):
+                sent += self._sendmmsg(messages[i:i + self.batch])
+            return sent
+        sent = 0
+        sendto = self.sock.sendto
+        for data,address in messages:
+            try:
+                sendto(data,address)
+                sent += 1
+            except socket.error:
+                pass
+        return sent
+
+    def _sendmmsg(self,messages):
+        smsgs = self.smsgs
+        siovecs = self.siovecs
+        # Keep references to data/address buffers until sent
+        refs = []
+        for i,(data,address) in enumerate(messages):
+            data = str(data)
+            name = encode_sockaddr(address)
+            refs.append((data,name))
+            siovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(data),ctypes.c_void_p)
+            siovecs[i].iov_len = len(data)
+            hdr = smsgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(ctypes.c_char_p(name),ctypes.c_void_p)
+            hdr.msg_namelen = len(name)
+        base = ctypes.addressof(smsgs)
+        size = ctypes.sizeof(mmsghdr)
+        offset = sent = 0
+        while offset < len(messages):
+            n = sendmmsg(self.fd,base + offset * size,
+                         len(messages) - offset,0)
+            if n < 0:
+                if ctypes.get_errno() == errno.EINTR:
+                    continue
+                # Skip datagram which failed (eg. buffer full/unreachable)
+                offset += 1
+                continue
+            offset += n
+            sent += n
+        return sent
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
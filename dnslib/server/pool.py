@@ -0,0 +1,233 @@
+
+"""
+    Bounded worker pool with load shedding
+
+    WorkerPool runs a fixed number of workers (threads or greenlets)
+    taking requests from a bounded queue - DNSServer.process is called
+    for each request. When the queue is full further requests are shed
+    (either dropped or answered with SERVFAIL built directly from the
+    request data - no DNSRecord is parsed or packed) so that memory use
+    and latency stay bounded under overload.
+
+    Resolvers which block (eg. calling external services) can be run in
+    a thread pool using ThreadPoolResolver (with gevent this keeps the
+    hub responsive).
+
+    >>> import threading
+    >>> release = threading.Event()
+    >>> class SlowResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         release.wait()
+    ...         return request.reply("1.2.3.4")
+    >>> server = DNSServer(SlowResolver(),("127.0.0.1",0))
+    >>> pool = WorkerPool(server,workers=1,queue_size=2)
+    >>> client = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> client.bind(("127.0.0.1",0))
+    >>> client.settimeout(2)
+    >>> requests = [ DNSRecord(DNSHeader(id=i),q=DNSQuestion("abc.com")) for i in range(5) ]
+    >>> pool.submit(requests[0].pack(),client.getsockname())
+    >>> while not pool.active:
+    ...     time.sleep(0.01)
+    >>> for r in requests[1:]:
+    ...     pool.submit(r.pack(),client.getsockname())
+    >>> pool.depth, pool.shed
+    (2, 2)
+    >>> for i in range(2):
+    ...     r = DNSRecord.parse(client.recv(512))
+    ...     print r.header.id, RCODE[r.header.rcode]
+    3 Server failure
+    4 Server failure
+    >>> release.set()
+    >>> sorted([ DNSRecord.parse(client.recv(512)).header.id for i in range(3) ])
+    [0, 1, 2]
+    >>> pool.close()
+    >>> registry = Registry()
+    >>> pool.register(registry)
+    >>> print registry.render(),
+    # HELP dns_queue_depth Queued DNS requests
+    # TYPE dns_queue_depth gauge
+    dns_queue_depth 0
+    # HELP dns_workers_active Busy workers
+    # TYPE dns_workers_active gauge
+    dns_workers_active 0
+    # HELP dns_shed_total Requests shed
+    # TYPE dns_shed_total counter
+    dns_shed_total 2
+    # HELP dns_worker_errors_total Requests which raised an exception
+    # TYPE dns_worker_errors_total counter
+    dns_worker_errors_total 0
+
+    Workers continue after a request raises an exception:
+
+    >>> class FailServer(object):
+    ...     hooks = None
+    ...     def __init__(self):
+    ...         self.processed = []
+    ...     def process(self,data,client):
+    ...         if data == "bad":
+    ...             raise RuntimeError("bad request")
+    ...         self.processed.append(data)
+    >>> pool = WorkerPool(FailServer(),workers=1)
+    >>> for data in ("bad","ok","bad","ok"):
+    ...     pool.submit(data,None)
+    >>> pool.close()
+    >>> pool.server.processed, pool.errors
+    (['ok', 'ok'], 2)
+    >>> server.socket.close()
+
+    Blocking resolver run in thread pool:
+
+    >>> from multiprocessing.pool import ThreadPool
+    >>> resolver = ThreadPoolResolver(SlowResolver(),ThreadPool(2))
+    >>> print resolver.resolve(requests[0],None).a
+    <DNS RR: 'abc.com' rtype=A rclass=IN ttl=0 rdata='1.2.3.4'>
+
+"""
+
+import Queue,socket,struct,threading,time
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, RCODE
+from dnslib.dns import DNSError
+from dnslib.wire import parse_question
+from dnslib.server.base import BaseResolver, DNSServer
+from dnslib.server.metrics import Counter, Gauge, Registry
+
+def error_response(data,rcode):
+    """
+        Build error response (question only) directly from request data
+        - returns None if the request is malformed
+
+        >>> q = DNSRecord(DNSHeader(id=1234),q=DNSQuestion("abc.com"))
+        >>> print DNSRecord.parse(error_response(q.pack(),2))
+        <DNS Header: id=0x4d2 type=RESPONSE opcode=QUERY flags=RD rcode=Server failure q=1 a=0 ns=0 ar=0>
+        <DNS Question: 'abc.com' qtype=A qclass=IN>
+    """
+    try:
+        id,flags,wire,qname,qtype,qclass,end = parse_question(data)
+    except DNSError:
+        return None
+    if flags & 0x8000:
+        return None
+    # Keep opcode/RD/CD, set QR and rcode
+    flags = (flags & 0x7910) | 0x8000 | rcode
+    return struct.pack("!HHHHHH",id,flags,1,0,0,0) + data[12:end]
+
+class ThreadPoolResolver(BaseResolver):
+
+    """
+    Run resolver in thread pool - threadpool is any object with an
+    apply(func,args) method (eg. multiprocessing.pool.ThreadPool or
+    gevent.threadpool.ThreadPool)
+    """
+
+    def __init__(self,resolver,threadpool):
+        self.resolver = resolver
+        self.threadpool = threadpool
+
+    def resolve(self,request,client):
+        return self.threadpool.apply(self.resolver.resolve,(request,client))
+
+class WorkerPool(object):
+
+    """
+    Bounded worker pool for DNSServer
+
+        workers     - number of workers
+        queue_size  - maximum queued requests
+        shed        - 'servfail' or 'drop' when queue is full
+        use_gevent  - use greenlets/gevent queue (default: threads)
+
+    The current queue depth (depth), number of busy workers (active),
+    number of shed requests (shed) and number of requests which raised
+    an exception (errors) are exposed as attributes (and can be
+    registered as metrics - see register).
+    """
+
+    def __init__(self,server,workers=100,queue_size=1000,shed='servfail',
+                      use_gevent=False):
+        if shed not in ('servfail','drop'):
+            raise ValueError("Invalid shed mode: %s" % shed)
+        self.server = server
+        self.workers = workers
+        self.shed_mode = shed
+        self.shed = 0
+        self.active = 0
+        self.errors = 0
+        # Guards active/shed/errors (updated from workers and server thread)
+        self.lock = threading.Lock()
+        if use_gevent:
+            import gevent,gevent.queue
+            self.queue = gevent.queue.Queue(queue_size)
+            self.threads = [ gevent.spawn(self.worker) for i in range(workers) ]
+        else:
+            self.queue = Queue.Queue(queue_size)
+            self.threads = []
+            for i in range(workers):
+                t = threading.Thread(target=self.worker)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def get_depth(self):
+        return self.queue.qsize()
+
+    depth = property(get_depth)
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            with self.lock:
+                self.active += 1
+            try:
+                self.server.process(*item)
+            except Exception:
+                # A failed request must not stop the worker
+                with self.lock:
+                    self.errors += 1
+                if self.server.hooks is not None:
+                    self.server.hooks.drop('error')
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def submit(self,data,client):
+        """
+            Queue request (without blocking) - shed request if queue full
+        """
+        try:
+            self.queue.put_nowait((data,client))
+        except Queue.Full:
+            with self.lock:
+                self.shed += 1
+            if self.server.hooks is not None:
+                self.server.hooks.drop('shed')
+            if self.shed_mode == 'servfail':
+                response = error_response(data,RCODE.lookup('Server failure'))
+                if response is not None:
+                    self.server.send(response,client)
+
+    def register(self,registry):
+        """
+            Add queue depth/active workers gauges and shed/error counters
+            to metrics registry
+        """
+        registry.add(Gauge("dns_queue_depth","Queued DNS requests",
+                           callback=self.get_depth))
+        registry.add(Gauge("dns_workers_active","Busy workers",
+                           callback=lambda: self.active))
+        registry.add(Counter("dns_shed_total","Requests shed",
+                             callback=lambda: self.shed))
+        registry.add(Counter("dns_worker_errors_total","Requests which raised an exception",
+                             callback=lambda: self.errors))
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
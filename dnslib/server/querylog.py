@@ -0,0 +1,270 @@
+
+"""
+    Asynchronous query logging
+
+    QueryLog.log() is called by DNSServer for each response and only
+    appends a tuple (timestamp,client,qname,qtype,rcode,latency) to a
+    bounded queue - requests can be sampled (sample=0.1 logs ~10% of
+    requests) and records are dropped (and counted) if the queue is full
+    rather than blocking the server.
+
+    A background thread drains the queue every flush_interval seconds
+    and writes the records in batches - either in NDJSON format or in a
+    compact binary format (see BinaryWriter). Log files are rotated when
+    they exceed max_bytes (file -> file.1 -> ... -> file.<backups>).
+
+    Names are logged in presentation form (label.escape_name) so that
+    binary labels are logged losslessly as ASCII. Records which cannot be
+    written are skipped and counted in QueryLog.errors (as are failed
+    flushes) - errors never stop the background thread.
+
+    >>> import os,shutil,tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> path = os.path.join(d,"query.log")
+    >>> log = QueryLog(path,format="ndjson")
+    >>> request = DNSRecord(q=DNSQuestion("abc.com",QTYPE.MX))
+    >>> log.log(1000.0,("10.0.0.1",1234),request,3,0.00025)
+    >>> log.close()
+    >>> print open(path).read(),
+    {"ts": 1000.0, "client": "10.0.0.1", "port": 1234, "qname": "abc.com", "qtype": "MX", "rcode": "NXDOMAIN", "latency": 0.00025}
+
+    Binary format:
+
+    >>> path = os.path.join(d,"query.bin")
+    >>> log = QueryLog(path,format="binary",max_bytes=150,backups=2)
+    >>> for i in range(10):
+    ...     log.log(1000.0 + i,("2001:db8::1",53),request,0,0.001)
+    ...     log.flush()
+    >>> log.close()
+    >>> sorted(os.listdir(d))
+    ['query.bin', 'query.bin.1', 'query.bin.2', 'query.log']
+    >>> for r in read_binary(open(path,"rb")):
+    ...     print r
+    (1008.0, '2001:db8::1', 53, 'abc.com', 15, 0, 0.001)
+    (1009.0, '2001:db8::1', 53, 'abc.com', 15, 0, 0.001)
+
+    Binary labels:
+
+    >>> path = os.path.join(d,"binary.log")
+    >>> log = QueryLog(path,format="ndjson")
+    >>> log.log(1000.0,None,DNSRecord(q=DNSQuestion(["\\xff\\x00.","com"])),0,0.001)
+    >>> log.log(1001.0,None,request,0,0.001)
+    >>> log.log(1002.0,("not an address",53),request,0,0.001)
+    >>> log.close()
+    >>> print open(path).read(),
+    {"ts": 1000.0, "client": "", "port": 0, "qname": "\\\\255\\\\000\\\\..com", "qtype": "A", "rcode": "NOERROR", "latency": 0.001}
+    {"ts": 1001.0, "client": "", "port": 0, "qname": "abc.com", "qtype": "MX", "rcode": "NOERROR", "latency": 0.001}
+    {"ts": 1002.0, "client": "not an address", "port": 53, "qname": "abc.com", "qtype": "MX", "rcode": "NOERROR", "latency": 0.001}
+    >>> path = os.path.join(d,"binary.bin")
+    >>> log = QueryLog(path,format="binary")
+    >>> log.log(1000.0,None,DNSRecord(q=DNSQuestion(["\\xff\\x00.","com"])),0,0.001)
+    >>> log.log(1001.0,("not an address",53),request,0,0.001)
+    >>> log.close()
+    >>> [ r[3] for r in read_binary(open(path,"rb")) ], log.errors, log.written
+    (['\\\\255\\\\000\\\\..com'], 1, 1)
+
+    >>> shutil.rmtree(d)
+
+"""
+
+import json,os,random,socket,struct,threading
+
+from collections import OrderedDict, deque
+
+from dnslib import DNSRecord, DNSQuestion, QTYPE
+from dnslib.label import escape_name
+from dnslib.server.metrics import RCODE_NAMES
+
+BINARY_MAGIC = "DNSQLOG1"
+# timestamp,latency (us),port,qtype,rcode,family,qname length
+BINARY_RECORD = struct.Struct("!dIHHBBH")
+
+class NDJSONWriter(object):
+
+    def __init__(self,f):
+        self.f = f
+
+    def header(self):
+        pass
+
+    def encode(self,record):
+        ts,client,qname,qtype,rcode,latency = record
+        address,port = client or ("",0)
+        return json.dumps(OrderedDict([("ts",ts),("client",address),
+                                       ("port",port),("qname",escape_name(qname)),
+                                       ("qtype",QTYPE[qtype]),
+                                       ("rcode",RCODE_NAMES.get(rcode,rcode)),
+                                       ("latency",latency)])) + "\n"
+
+class BinaryWriter(object):
+
+    """
+    Binary query log - BINARY_MAGIC followed by records of:
+
+        timestamp       double
+        latency         uint32 (microseconds)
+        port            uint16
+        qtype           uint16
+        rcode           uint8
+        family          uint8 (4/6 - or 0 if client is unknown)
+        qname length    uint16
+        address         4/16 bytes
+        qname           (presentation form)
+    """
+
+    def __init__(self,f):
+        self.f = f
+
+    def header(self):
+        self.f.write(BINARY_MAGIC)
+
+    def encode(self,record):
+        ts,client,qname,qtype,rcode,latency = record
+        if client is None:
+            family,address,port = 0,"",0
+        elif ":" in client[0]:
+            family = 6
+            address = socket.inet_pton(socket.AF_INET6,client[0])
+            port = client[1]
+        else:
+            family = 4
+            address = socket.inet_aton(client[0])
+            port = client[1]
+        qname = escape_name(qname)
+        return BINARY_RECORD.pack(ts,min(int(latency * 1000000),0xffffffff),
+                                  port,qtype,rcode,family,len(qname)) + \
+               address + qname
+
+def read_binary(f):
+    """
+        Read binary query log and yield (timestamp,client,port,qname,
+        qtype,rcode,latency)
+    """
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("Invalid query log")
+    while True:
+        h = f.read(BINARY_RECORD.size)
+        if len(h) < BINARY_RECORD.size:
+            break
+        ts,latency,port,qtype,rcode,family,qlen = BINARY_RECORD.unpack(h)
+        if family == 6:
+            address = socket.inet_ntop(socket.AF_INET6,f.read(16))
+        elif family == 4:
+            address = socket.inet_ntoa(f.read(4))
+        else:
+            address = None
+        qname = f.read(qlen)
+        yield (ts,address,port,qname,qtype,rcode,latency / 1000000.0)
+
+WRITERS = { 'ndjson': NDJSONWriter, 'binary': BinaryWriter }
+
+class QueryLog(object):
+
+    """
+    Query log - path is the log file, format 'ndjson' or 'binary'
+
+        sample          - fraction of requests logged
+        maxsize         - maximum queued records (further records are
+                          dropped and counted in self.dropped)
+        flush_interval  - background write interval (seconds)
+        max_bytes       - rotate log when larger than max_bytes (0 to
+                          disable rotation)
+        backups         - number of rotated logs kept
+
+    Records which cannot be encoded and failed flushes are counted in
+    self.errors
+    """
+
+    def __init__(self,path,format="ndjson",sample=1.0,maxsize=100000,
+                      flush_interval=1.0,max_bytes=0,backups=5):
+        if format not in WRITERS:
+            raise ValueError("Invalid format: %s" % format)
+        self.path = path
+        self.format = format
+        self.sample = sample
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = deque()
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.open()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self):
+        self.f = open(self.path,"ab")
+        self.writer = WRITERS[self.format](self.f)
+        if self.f.tell() == 0:
+            self.writer.header()
+
+    def log(self,ts,client,request,rcode,latency):
+        """
+            Queue record (called from server - must not block)
+        """
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        if len(self.queue) >= self.maxsize:
+            self.dropped += 1
+            return
+        q = request.q
+        self.queue.append((ts,client,q.qname,q.qtype,rcode,latency))
+
+    def flush(self):
+        """
+            Write queued records
+        """
+        with self.lock:
+            queue = self.queue
+            records = []
+            try:
+                while True:
+                    records.append(queue.popleft())
+            except IndexError:
+                pass
+            if records:
+                data = []
+                for record in records:
+                    try:
+                        data.append(self.writer.encode(record))
+                    except Exception:
+                        self.errors += 1
+                self.f.write("".join(data))
+                self.f.flush()
+                self.written += len(data)
+                if self.max_bytes and self.f.tell() >= self.max_bytes:
+                    self.rotate()
+
+    def rotate(self):
+        self.f.close()
+        if self.backups:
+            for i in range(self.backups - 1,0,-1):
+                src = "%s.%d" % (self.path,i)
+                if os.path.exists(src):
+                    os.rename(src,"%s.%d" % (self.path,i + 1))
+            os.rename(self.path,self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self.errors += 1
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.f.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
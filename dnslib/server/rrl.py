@@ -0,0 +1,189 @@
+
+"""
+    Response Rate Limiting
+
+    Responses are accounted against token buckets keyed by (client
+    prefix,response name,rcode class) - the client prefix is the /24
+    (IPv4) or /56 (IPv6) network of the client, the response name is the
+    qname (or the zone - SOA owner - for NXDOMAIN responses so that
+    random subdomains share a bucket).
+
+    Each bucket refills at rate tokens/second up to burst tokens. Once a
+    bucket is empty further responses are limited - every slip'th
+    limited response is replaced by a small truncated (TC=1) response
+    (so that legitimate clients can retry over TCP) and the others are
+    dropped (slip=0 drops all limited responses).
+
+    DNSServer checks RRL after resolving the request but before the
+    response is packed so limited responses cost neither CPU nor
+    bandwidth. Buckets are kept in a bounded LRU (maxsize) which is
+    updated under a lock (so that RRL can be shared by pool threads).
+
+    >>> now = [0.0]
+    >>> rrl = RRL(rate=2,slip=2,clock=lambda:now[0])
+    >>> request = DNSRecord(q=DNSQuestion("abc.com"))
+    >>> reply = request.reply("1.2.3.4")
+    >>> [ rrl.check(("192.0.2.%d" % i,53),request,reply) for i in range(6) ]
+    ['allow', 'allow', 'slip', 'drop', 'slip', 'drop']
+    >>> rrl.check(("198.51.100.1",53),request,reply)
+    'allow'
+    >>> now[0] = 0.5
+    >>> rrl.check(("192.0.2.1",53),request,reply)
+    'allow'
+    >>> rrl.check(("192.0.2.1",53),request,reply)
+    'slip'
+
+    NXDOMAIN responses are accounted against the zone:
+
+    >>> nx = make_reply(request,3)
+    >>> nx.add_ns(RR("abc.com",QTYPE.SOA,rdata=SOA("ns.abc.com","admin.abc.com",(1,2,3,4,5))))
+    >>> prefix,name,kind = rrl.key(("2001:db8::1",53),request,nx)
+    >>> prefix.encode('hex'), name, kind
+    ('20010db8000000', ('abc', 'com'), 'nxdomain')
+
+    Packed (cached) NXDOMAIN responses for random subdomains share the
+    zone bucket:
+
+    >>> keys = set()
+    >>> for name in ("a1.abc.com","b2.abc.com"):
+    ...     q = DNSRecord(q=DNSQuestion(name))
+    ...     r = make_reply(q,3)
+    ...     r.add_ns(RR("abc.com",QTYPE.SOA,rdata=SOA("ns.abc.com","admin.abc.com",(1,2,3,4,5))))
+    ...     keys.add(rrl.key(("192.0.2.1",53),q,bytearray(r.pack())))
+    >>> [ (name,kind) for prefix,name,kind in keys ]
+    [(('abc', 'com'), 'nxdomain')]
+
+    Limited responses from DNSServer:
+
+    >>> class TestResolver(BaseResolver):
+    ...     def resolve(self,request,client):
+    ...         return request.reply("1.2.3.4")
+    >>> server = DNSServer(TestResolver(),("127.0.0.1",0),rrl=RRL(rate=1,slip=2))
+    >>> client = ("192.0.2.1",1234)
+    >>> for i in range(4):
+    ...     response = server.handle(request.pack(),client)
+    ...     print response and DNSRecord.parse(response).header
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,TC,RD,RA rcode=None q=1 a=0 ns=0 ar=0>
+    None
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,TC,RD,RA rcode=None q=1 a=0 ns=0 ar=0>
+    >>> server.socket.close()
+
+"""
+
+import socket,threading,time
+
+from collections import OrderedDict
+
+from dnslib import DNSRecord, DNSQuestion, RR, SOA, QTYPE
+from dnslib.cache import mask
+from dnslib.wire import authority_soa
+from dnslib.server.base import BaseResolver, DNSServer, PARSE_ERRORS, \
+                               make_reply, reply_bitmap
+
+ALLOW = 'allow'
+SLIP = 'slip'
+DROP = 'drop'
+
+class RRL(object):
+
+    """
+    Response rate limiter (check returns RRL.ALLOW/RRL.SLIP/RRL.DROP)
+
+        rate            - responses/second per bucket
+        nxdomain_rate   - rate for NXDOMAIN responses (default: rate)
+        error_rate      - rate for other error responses (default: rate)
+        burst           - bucket size (default: rate)
+        slip            - send truncated response for every slip'th
+                          limited response (0 to drop all)
+        maxsize         - maximum number of buckets
+        ipv4_prefix     - IPv4 client prefix length (default: 24)
+        ipv6_prefix     - IPv6 client prefix length (default: 56)
+    """
+
+    ALLOW = ALLOW
+    SLIP = SLIP
+    DROP = DROP
+
+    def __init__(self,rate=5,nxdomain_rate=None,error_rate=None,burst=None,
+                      slip=2,maxsize=100000,ipv4_prefix=24,ipv6_prefix=56,
+                      clock=time.time):
+        self.rates = { 'response': rate,
+                       'nxdomain': nxdomain_rate is None and rate or nxdomain_rate,
+                       'error': error_rate is None and rate or error_rate }
+        self.burst = burst
+        self.slip = slip
+        self.maxsize = maxsize
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.clock = clock
+        # key -> [tokens,last update,limited count]
+        self.buckets = OrderedDict()
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def prefix(self,address):
+        """
+            Client network prefix (packed)
+        """
+        if ":" in address:
+            return mask(socket.inet_pton(socket.AF_INET6,address),
+                        self.ipv6_prefix)[:(self.ipv6_prefix + 7) // 8]
+        return mask(socket.inet_aton(address),
+                    self.ipv4_prefix)[:(self.ipv4_prefix + 7) // 8]
+
+    def key(self,client,request,reply):
+        """
+            Bucket key - (client prefix,response name,rcode class)
+        """
+        rcode = reply_bitmap(reply) & 0xf
+        name = request.q.qname
+        if rcode == 0:
+            kind = 'response'
+        elif rcode == 3:
+            kind = 'nxdomain'
+            if isinstance(reply,DNSRecord):
+                for rr in reply.ns:
+                    if rr.rtype == QTYPE.SOA:
+                        name = rr.rname
+                        break
+            else:
+                try:
+                    name = authority_soa(reply) or name
+                except PARSE_ERRORS:
+                    pass
+        else:
+            kind = 'error'
+        return (self.prefix(client[0]),
+                tuple([ l.lower() for l in name.label ]),kind)
+
+    def check(self,client,request,reply):
+        """
+            Account response and return action (ALLOW/SLIP/DROP)
+        """
+        key = self.key(client,request,reply)
+        rate = self.rates[key[2]]
+        burst = self.burst or rate
+        with self.lock:
+            now = self.clock()
+            bucket = self.buckets.pop(key,None)
+            if bucket is None:
+                bucket = [burst,now,0]
+                if len(self.buckets) >= self.maxsize:
+                    self.buckets.popitem(last=False)
+            else:
+                bucket[0] = min(burst,bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            self.buckets[key] = bucket
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return ALLOW
+            self.limited += 1
+            bucket[2] += 1
+            if self.slip and bucket[2] % self.slip == 1 % self.slip:
+                return SLIP
+            return DROP
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+
+"""
+    Consistent-hash sharding across a tier of caching forwarders
+
+    Each (qname,qtype) is owned by one node of the tier - the owner is
+    chosen from a consistent hash ring (HashRing) with vnodes virtual
+    nodes per node so that keys are spread evenly and only ~1/N of the
+    keys move when a node is added or removed. ShardResolver answers
+    requests it owns with the local resolver (eg. a CachingResolver) and
+    forwards other requests to the owner using a pooled DNSClient - if
+    the owner is down (or fails) the request is resolved locally.
+
+    Forwarded requests carry an EDNS option (FORWARDED_OPTION) and are
+    always resolved locally by the receiving node (so that nodes with
+    inconsistent node lists cannot forward a request back and forth).
+    As forwarding blocks until the owner answers the server should be
+    run with a WorkerPool (DNSServer.serve_forever(pool)).
+
+    As each node only caches the keys it owns the total cache capacity
+    scales with the number of nodes. All nodes must be configured with
+    the same node list.
+
+    Options (when run as a script):
+
+      --port=PORT           Server port (default: 53)
+      --bind=BIND           Server bind address (default: all)
+      --node=HOST:PORT      This node (as it appears in --nodes - default:
+                            127.0.0.1:PORT)
+      --nodes=LIST          Comma separated list of HOST:PORT nodes
+      --upstream=HOST:PORT  Upstream DNS server (default: 8.8.8.8:53)
+      --vnodes=N            Virtual nodes per node (default: 100)
+      --timeout=SECS        Forwarding timeout (default: 1.0)
+      --workers=N           Worker threads (default: 16)
+
+    Usage:
+
+    # python shard.py --port=8053 --nodes=127.0.0.1:8053,127.0.0.1:8054
+    # python shard.py --port=8054 --nodes=127.0.0.1:8053,127.0.0.1:8054
+
+    >>> ring = HashRing([("10.0.0.%d" % i,53) for i in range(4)])
+    >>> ring.get("abc.com/1") == ring.get("abc.com/1")
+    True
+    >>> counts = {}
+    >>> for i in range(10000):
+    ...     node = ring.get("host%d.abc.com/1" % i)
+    ...     counts[node] = counts.get(node,0) + 1
+    >>> sorted(counts) == sorted(ring.nodes)
+    True
+    >>> min(counts.values()) > 1800
+    True
+
+    Removing a node only moves the keys it owned:
+
+    >>> before = [ ring.get("host%d.abc.com/1" % i) for i in range(1000) ]
+    >>> ring.remove(("10.0.0.3",53))
+    >>> after = [ ring.get("host%d.abc.com/1" % i) for i in range(1000) ]
+    >>> all([ b == a for b,a in zip(before,after) if b != ("10.0.0.3",53) ])
+    True
+
+    Three local nodes - each name is resolved (and cached) by its owner
+    only:
+
+    >>> class CountResolver(BaseResolver):
+    ...     def __init__(self):
+    ...         self.names = []
+    ...     def resolve(self,request,client):
+    ...         self.names.append(str(request.q.qname))
+    ...         reply = make_reply(request)
+    ...         reply.add_answer(RR(request.q.qname,rdata=A("1.2.3.4"),ttl=60))
+    ...         return reply
+    >>> servers = [ DNSServer(None,("127.0.0.1",0)) for i in range(3) ]
+    >>> nodes = [ s.address for s in servers ]
+    >>> upstreams = [ CountResolver() for s in servers ]
+    >>> pools = [ WorkerPool(s,workers=4) for s in servers ]
+    >>> for server,upstream,pool in zip(servers,upstreams,pools):
+    ...     server.resolver = ShardResolver(nodes,CachingResolver(upstream),
+    ...                                     server.address,timeout=0.5)
+    ...     server.start_thread(pool)
+    >>> names = [ "host%d.abc.com" % i for i in range(30) ]
+    >>> for i in range(2):
+    ...     for name in names:
+    ...         r = DNSRecord(q=DNSQuestion(name)).send(*nodes[0])
+    >>> sorted(sum([ u.names for u in upstreams ],[])) == sorted(names)
+    True
+    >>> min([ len(u.names) for u in upstreams ]) > 0
+    True
+
+    Fall back to local resolution when the owner is down:
+
+    >>> servers[2].stop()
+    >>> owned = [ n for n in names if servers[0].resolver.owner(n,QTYPE.A) == nodes[2] ]
+    >>> for name in owned:
+    ...     print DNSRecord(q=DNSQuestion(name)).send(*nodes[0]).a.rdata
+    1.2.3.4
+    ...
+    >>> sorted([ n for n in upstreams[0].names if n in owned ]) == sorted(owned)
+    True
+    >>> servers[0].resolver.fallback >= len(owned)
+    True
+
+    Forwarded requests are answered locally by the receiving node even
+    if it does not consider itself the owner (eg. different node lists):
+
+    >>> a,b = [ s.resolver for s in servers[:2] ]
+    >>> a.owner = lambda qname,qtype: nodes[1]
+    >>> b.owner = lambda qname,qtype: nodes[0]
+    >>> a.forwarded = a.fallback = b.forwarded = b.fallback = 0
+    >>> print DNSRecord(q=DNSQuestion("loop.abc.com")).send(*nodes[0]).a.rdata
+    1.2.3.4
+    >>> a.forwarded, a.fallback, b.forwarded, b.fallback
+    (1, 0, 0, 0)
+    >>> upstreams[1].names[-1]
+    'loop.abc.com'
+
+    Requests are served while a forwarded request is waiting for the
+    owner:
+
+    >>> blackhole = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> blackhole.bind(("127.0.0.1",0))
+    >>> a.clients[blackhole.getsockname()] = DNSClient(*blackhole.getsockname(),
+    ...                                                timeout=0.5,retries=0)
+    >>> def owner(qname,qtype):
+    ...     if str(qname).startswith("slow"):
+    ...         return blackhole.getsockname()
+    ...     return nodes[0]
+    >>> a.owner = owner
+    >>> client = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> client.settimeout(2)
+    >>> for name in ("slow.abc.com","fast.abc.com"):
+    ...     n = client.sendto(DNSRecord(q=DNSQuestion(name)).pack(),nodes[0])
+    >>> [ str(DNSRecord.parse(client.recv(512)).q.qname) for i in range(2) ]
+    ['fast.abc.com', 'slow.abc.com']
+    >>> a.fallback
+    1
+    >>> for server,pool in zip(servers,pools)[:2]:
+    ...     server.stop()
+    ...     pool.close()
+
+"""
+
+import bisect,hashlib,optparse,socket,struct,sys
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, EDNSOption, RR, A, \
+                   QTYPE
+from dnslib.client import DNSClient
+from dnslib.label import DNSLabel
+from dnslib.server.base import BaseResolver, CachingResolver, DNSServer, \
+                               make_reply
+from dnslib.server.pool import WorkerPool
+
+# EDNS option (local/experimental range) marking forwarded requests -
+# data is '\x01' if the OPT RR was added by the forwarding node
+FORWARDED_OPTION = 65001
+
+class HashRing(object):
+
+    """
+    Consistent hash ring - nodes are (address,port) tuples each placed
+    on the ring at vnodes points
+    """
+
+    def __init__(self,nodes=(),vnodes=100):
+        self.vnodes = vnodes
+        self.nodes = []
+        self.ring = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def hash(self,key):
+        return struct.unpack("!Q",hashlib.md5(key).digest()[:8])[0]
+
+    def add(self,node):
+        self.nodes.append(node)
+        for i in xrange(self.vnodes):
+            h = self.hash("%s:%d#%d" % (node[0],node[1],i))
+            self.owners[h] = node
+            bisect.insort(self.ring,h)
+
+    def remove(self,node):
+        self.nodes.remove(node)
+        for i in xrange(self.vnodes):
+            h = self.hash("%s:%d#%d" % (node[0],node[1],i))
+            if self.owners.get(h) == node:
+                del self.owners[h]
+                self.ring.remove(h)
+
+    def get(self,key):
+        """
+            Return node owning key (or None if the ring is empty)
+        """
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.ring,self.hash(key)) % len(self.ring)
+        return self.owners[self.ring[i]]
+
+class ProxyResolver(BaseResolver):
+
+    """
+    Forward requests to upstream server (DNSClient) - errors are raised
+    (DNSServer returns SERVFAIL, CachingResolver may serve stale data)
+    """
+
+    def __init__(self,client):
+        self.client = client
+
+    def resolve(self,request,client):
+        return self.client.query(request.pack())
+
+class ShardResolver(BaseResolver):
+
+    """
+    Forward requests to owner node (from HashRing) or resolve locally
+
+        nodes       - list of (address,port) nodes
+        local       - local resolver
+        node        - this node (in nodes)
+        vnodes      - virtual nodes per node
+        timeout     - forwarding timeout
+
+    Forwarded/fallback request counts are kept in forwarded/fallback.
+    Requests forwarded by another node (see FORWARDED_OPTION) are always
+    resolved locally.
+    """
+
+    def __init__(self,nodes,local,node,vnodes=100,timeout=1.0):
+        self.ring = HashRing(nodes,vnodes)
+        self.local = local
+        self.node = node
+        self.clients = dict([ (n,DNSClient(n[0],n[1],timeout=timeout,retries=0))
+                                for n in nodes if n != node ])
+        self.forwarded = 0
+        self.fallback = 0
+
+    def owner(self,qname,qtype):
+        """
+            Owner node for (qname,qtype)
+        """
+        if not isinstance(qname,DNSLabel):
+            qname = DNSLabel(qname)
+        return self.ring.get("%s/%d" % (".".join(qname.label).lower(),qtype))
+
+    def mark(self,request):
+        """
+            Return copy of request with FORWARDED_OPTION added (the
+            request - including its header counts - is not modified)
+
+            >>> resolver = ShardResolver([],None,None)
+            >>> request = DNSRecord(q=DNSQuestion("abc.com"))
+            >>> marked = resolver.mark(request)
+            >>> request.header.ar, len(request.ar), marked.header.ar
+            (0, 0, 1)
+            >>> resolver.unmark(DNSRecord.parse(marked.pack()))
+            True
+        """
+        ar = []
+        opt = None
+        for rr in request.ar:
+            if rr.rtype == QTYPE.OPT and opt is None:
+                opt = RR("",QTYPE.OPT,rr.rclass,rr.ttl,
+                         rdata=list(rr.rdata) + [EDNSOption(FORWARDED_OPTION,"\x00")])
+                ar.append(opt)
+            else:
+                ar.append(rr)
+        if opt is None:
+            ar.append(RR("",QTYPE.OPT,4096,
+                         rdata=[EDNSOption(FORWARDED_OPTION,"\x01")]))
+        header = DNSHeader(id=request.header.id,bitmap=request.header.bitmap)
+        return DNSRecord(header,questions=list(request.questions),
+                         rr=list(request.rr),ns=list(request.ns),ar=ar)
+
+    def unmark(self,request):
+        """
+            Remove FORWARDED_OPTION from request - returns True if the
+            request was forwarded by another node
+        """
+        for rr in request.ar:
+            if rr.rtype != QTYPE.OPT:
+                continue
+            for option in rr.rdata:
+                if option.code == FORWARDED_OPTION:
+                    if option.data == "\x01":
+                        request.ar.remove(rr)
+                        request.set_header_qa()
+                    else:
+                        rr.rdata.remove(option)
+                    return True
+            break
+        return False
+
+    def resolve(self,request,client):
+        if self.unmark(request):
+            return self.local.resolve(request,client)
+        owner = self.owner(request.q.qname,request.q.qtype)
+        if owner != self.node:
+            upstream = self.clients[owner]
+            if not upstream.down:
+                try:
+                    response = upstream.query(self.mark(request).pack())
+                    self.forwarded += 1
+                    return response
+                except socket.error:
+                    pass
+            self.fallback += 1
+        return self.local.resolve(request,client)
+
+def parse_address(address,port=53):
+    """
+        Parse HOST[:PORT]
+
+        >>> parse_address("127.0.0.1:8053")
+        ('127.0.0.1', 8053)
+        >>> parse_address("8.8.8.8")
+        ('8.8.8.8', 53)
+    """
+    if ":" in address:
+        host,port = address.rsplit(":",1)
+        return (host,int(port))
+    return (address,port)
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--port",type=int,default=53,help="Server port (default: 53)")
+    parser.add_option("--bind",default="",help="Server bind address (default: all)")
+    parser.add_option("--node",help="This node as HOST:PORT (default: 127.0.0.1:PORT)")
+    parser.add_option("--nodes",default="",help="Comma separated list of HOST:PORT nodes")
+    parser.add_option("--upstream",default="8.8.8.8:53",help="Upstream DNS server (default: 8.8.8.8:53)")
+    parser.add_option("--vnodes",type=int,default=100,help="Virtual nodes per node (default: 100)")
+    parser.add_option("--timeout",type=float,default=1.0,help="Forwarding timeout (default: 1.0)")
+    parser.add_option("--workers",type=int,default=16,help="Worker threads (default: 16)")
+    parser.add_option("--doctest",action="store_true",default=False,help="Run doctests")
+    options,args = parser.parse_args()
+
+    if options.doctest:
+        import doctest
+        doctest.testmod(optionflags=doctest.ELLIPSIS)
+        sys.exit(0)
+
+    node = parse_address(options.node or "127.0.0.1:%d" % options.port)
+    nodes = [ parse_address(n) for n in options.nodes.split(",") if n ]
+    if node not in nodes:
+        nodes.append(node)
+
+    upstream = ProxyResolver(DNSClient(*parse_address(options.upstream)))
+    resolver = ShardResolver(nodes,CachingResolver(upstream),node,
+                             vnodes=options.vnodes,timeout=options.timeout)
+    server = DNSServer(resolver,(options.bind,options.port))
+    server.serve_forever(WorkerPool(server,workers=options.workers))
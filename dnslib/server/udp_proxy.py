@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-import optparse,socket,sys
+import collections,optparse,select,socket,sys,time
 from dnslib import DNSHeader, DNSRecord, QTYPE
+from dnslib.server.base import PARSE_ERRORS
+from dnslib.server.mmsg import BatchSocket
 
 """
     Simple DNS proxy - listens on proxy port and forwards request/reply to real server
@@ -39,33 +41,94 @@ options,args = parser.parse_args()
 
 proxy = socket.socket(AF_INET, SOCK_DGRAM)
 proxy.bind((options.bind,options.port))
-
-while True:
-    # Wait for client connection
-    data,client = proxy.recvfrom(8192)
+batch = BatchSocket(proxy)
+
+# Requests are forwarded over a single upstream socket and replies are
+# matched on (id,question) - key -> [(client,time sent)] for requests
+# awaiting a reply (oldest first) and (time sent,key) in the order sent
+# for expiry
+upstream = BatchSocket(socket.socket(AF_INET, SOCK_DGRAM),bufsize=8192)
+server = (socket.gethostbyname(options.dns),options.dns_port)
+pending = {}
+order = collections.deque()
+TIMEOUT = 5.0
+
+def key(record):
+    q = record.q
+    return (record.header.id,
+            tuple([ l.lower() for l in q.qname.label ]),q.qtype,q.qclass)
+
+def forward(data,client,now):
     # Parse and print request
     request = DNSRecord.parse(data)
-    id = request.header.id
     qname = request.q.qname
     qtype = request.q.qtype
     print "------ Request (%s): %r (%s)" % (str(client),qname.label,QTYPE[qtype])
     print data.encode('hex')
     print "\n".join([ "  %s" % l for l in str(request).split("\n")])
-    # Send request to server
-    s = socket.socket(AF_INET, SOCK_DGRAM)
-    s.sendto(data,(options.dns,options.dns_port))
-    # Wait for reply
-    data,server = s.recvfrom(8192)
-    # Parse and print reply
+    k = key(request)
+    pending.setdefault(k,collections.deque()).append((client,now))
+    order.append((now,k))
+    return data,server
+
+def receive(data,address):
+    # Parse and print reply - returns (data,client) or None if there is
+    # no matching request
     reply = DNSRecord.parse(data)
-    id = reply.header.id
+    clients = pending.get(key(reply))
+    if not clients:
+        return None
+    client,sent = clients.popleft()
+    if not clients:
+        del pending[key(reply)]
     qname = reply.q.qname
     qtype = reply.q.qtype
-    print "------ Reply (%s): %r (%s)" % (str(server),qname.label,QTYPE[qtype])
+    print "------ Reply (%s): %r (%s)" % (str(address),qname.label,QTYPE[qtype])
     print data.encode('hex')
     print "\n".join([ "  %s" % l for l in str(reply).split("\n")])
     print
-    # Send reply to client
-    proxy.sendto(data,client)
+    return data,client
 
+# poll is not limited to FD_SETSIZE descriptors (unlike select)
+poller = select.poll()
+poller.register(batch,select.POLLIN)
+poller.register(upstream,select.POLLIN)
 
+while True:
+    # Wait for client requests/server replies - requests are forwarded
+    # and replies returned in batches as they arrive
+    events = poller.poll(1000)
+    now = time.time()
+    for fd,event in events:
+        if fd == batch.fileno():
+            requests = []
+            for data,client in batch.recv():
+                try:
+                    requests.append(forward(data,client,now))
+                except PARSE_ERRORS as e:
+                    print "------ Invalid request (%s): %s" % (str(client),e)
+            if requests:
+                upstream.send(requests)
+        else:
+            replies = []
+            for data,address in upstream.recv():
+                if address != server:
+                    continue
+                try:
+                    reply = receive(data,address)
+                except PARSE_ERRORS as e:
+                    print "------ Invalid reply (%s): %s" % (str(address),e)
+                    continue
+                if reply is not None:
+                    replies.append(reply)
+            # Send replies to clients
+            if replies:
+                batch.send(replies)
+    # Discard requests which have not been answered
+    while order and now - order[0][0] > TIMEOUT:
+        sent,k = order.popleft()
+        clients = pending.get(k)
+        if clients and clients[0][1] == sent:
+            clients.popleft()
+            if not clients:
+                del pending[k]
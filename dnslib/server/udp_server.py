@@ -1,48 +1,81 @@
 #!/usr/bin/env python
 
-import socket
+"""
+    Simple test DNS server (using dnslib.server.base.DNSServer)
 
-from dnslib import A, AAAA, CNAME, MX, RR, TXT
-from dnslib import DNSHeader, DNSRecord, QTYPE
+    Options:
+
+      --port=PORT           Server port (default: 53)
+      --bind=BIND           Server bind address (default: all)
+      --metrics=PORT        Export Prometheus metrics on 127.0.0.1:PORT
+      --querylog=FILE       Write query log (NDJSON) to FILE
+      --sample=RATE         Query log sample rate (default: 1.0)
+      --rrl=RATE            Enable response rate limiting (responses/sec)
+
+    Usage:
+
+    # python udp_server.py --port=8053 --metrics=9153
+
+    (from another window)
+
+    # dig @127.0.0.1 www.google.com -p 8053
+    # curl http://127.0.0.1:9153/metrics
+
+"""
+
+import optparse
 
-AF_INET = 2
-SOCK_DGRAM = 2
+from dnslib import A, AAAA, CNAME, MX, RR, TXT
+from dnslib import QTYPE
+from dnslib.server.base import BaseResolver, DNSServer, make_reply
+from dnslib.server.metrics import Metrics, MetricsServer
+from dnslib.server.querylog import QueryLog
+from dnslib.server.rrl import RRL
 
 IP = "127.0.0.1"
 IPV6 = (0,) * 16
-MSG = "gevent_server.py"
-
-
-def dns_handler(s, peer, data):
-    request = DNSRecord.parse(data)
-    id = request.header.id
-    qname = request.q.qname
-    qtype = request.q.qtype
-    print "------ Request (%s): %r (%s)" % (str(peer),
-            qname.label, QTYPE[qtype])
-    print "\n".join([ "  %s" % l for l in str(request).split("\n")])
-
-    reply = DNSRecord(DNSHeader(id=id, qr=1, aa=1, ra=1), q=request.q)
-    if qtype == QTYPE.A:
-        reply.add_answer(RR(qname, qtype,       rdata=A(IP)))
-    if qtype == QTYPE.AAAA:
-        reply.add_answer(RR(qname, qtype,       rdata=AAAA(IPV6)))
-    elif qtype == QTYPE['*']:
-        reply.add_answer(RR(qname, QTYPE.A,     rdata=A(IP)))
-        reply.add_answer(RR(qname, QTYPE.MX,    rdata=MX(IP)))
-        reply.add_answer(RR(qname, QTYPE.TXT,   rdata=TXT(MSG)))
-    else:
-        reply.add_answer(RR(qname, QTYPE.CNAME, rdata=CNAME(MSG)))
-
-    print "------ Reply"
-    print "\n".join([ "  %s" % l for l in str(reply).split("\n")])
-
-    s.sendto(reply.pack(), peer)
-
-s = socket.socket(AF_INET, SOCK_DGRAM)
-s.bind(('', 53))
-
-while True:
-    print "====== Waiting for connection"
-    data, peer = s.recvfrom(8192)
-    dns_handler(s,peer,data)
+MSG = "udp_server.py"
+
+class TestResolver(BaseResolver):
+
+    def resolve(self,request,client):
+        reply = make_reply(request)
+        qname = request.q.qname
+        qtype = request.q.qtype
+        if qtype == QTYPE.A:
+            reply.add_answer(RR(qname, qtype,       rdata=A(IP)))
+        if qtype == QTYPE.AAAA:
+            reply.add_answer(RR(qname, qtype,       rdata=AAAA(IPV6)))
+        elif qtype == QTYPE['*']:
+            reply.add_answer(RR(qname, QTYPE.A,     rdata=A(IP)))
+            reply.add_answer(RR(qname, QTYPE.MX,    rdata=MX(IP)))
+            reply.add_answer(RR(qname, QTYPE.TXT,   rdata=TXT(MSG)))
+        else:
+            reply.add_answer(RR(qname, QTYPE.CNAME, rdata=CNAME(MSG)))
+        return reply
+
+parser = optparse.OptionParser(usage="Usage: %prog [options]")
+parser.add_option("--port",type=int,default=53,help="Server port (default: 53)")
+parser.add_option("--bind",default="",help="Server bind address (default: all)")
+parser.add_option("--metrics",type=int,help="Export Prometheus metrics on 127.0.0.1:PORT")
+parser.add_option("--querylog",help="Write query log (NDJSON) to FILE")
+parser.add_option("--sample",type=float,default=1.0,help="Query log sample rate (default: 1.0)")
+parser.add_option("--rrl",type=float,help="Enable response rate limiting (responses/sec)")
+options,args = parser.parse_args()
+
+hooks = None
+if options.metrics:
+    hooks = Metrics()
+    MetricsServer(hooks.registry,("127.0.0.1",options.metrics)).start_thread()
+
+querylog = None
+if options.querylog:
+    querylog = QueryLog(options.querylog,sample=options.sample)
+
+rrl = None
+if options.rrl:
+    rrl = RRL(rate=options.rrl)
+
+server = DNSServer(TestResolver(),(options.bind,options.port),hooks=hooks,
+                   querylog=querylog,rrl=rrl)
+server.serve_forever()
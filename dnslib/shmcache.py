@@ -0,0 +1,369 @@
+
+"""
+    Shared memory response cache
+
+    SharedCache stores packed responses in a memory mapped file so that
+    a single cache can be shared by several worker processes (eg.
+    servers using SO_REUSEPORT or forked from a common parent).
+
+    The mapping contains a header, a fixed size open-addressing hash
+    table of slots and an arena of (key,packed response) records:
+
+        header  - magic, number of slots, arena size, arena head
+        slots   - seq, hash, created, expires, ttl, arena position,
+                  record length, key length
+        arena   - ring buffer - records are appended at the head (a
+                  monotonic position - the offset in the arena is
+                  position % arena size) and old records are overwritten
+                  when the arena wraps
+
+    Readers do not take a lock - each slot is protected by a seqlock
+    (the writer increments seq before and after updating the slot and
+    readers retry if seq is odd or changes while the slot is read - up to
+    READ_RETRIES times, after which the slot is treated as a miss) and a
+    record is valid as long as the arena head has not advanced more than
+    the arena size past it (the writer advances the head before
+    overwriting the arena). Writers are serialised by a lock on the
+    mapped file (fcntl) and a thread lock. A slot left with an odd seq
+    (a writer died while updating it) is cleared by the next writer which
+    probes it.
+
+    Lookups probe up to PROBES slots - on insert the slot holding the
+    same key, an unused slot or the slot which expires first is used.
+
+    SharedCache has the same interface as DNSCache (lookup/get_packet/
+    get/put) so that it can be used by CachingResolver. Responses with
+    a non-zero ECS scope are not cached. CacheEntry objects (and so hit
+    counts and prefetch state) are kept per process and reused until the
+    slot changes.
+
+    >>> cache = SharedCache(slots=64,arena=4096)
+    >>> def response(name,ip,ttl=60):
+    ...     return DNSRecord(DNSHeader(qr=1),q=DNSQuestion(name),
+    ...                      a=RR(name,rdata=A(ip),ttl=ttl))
+    >>> cache.put(response("www.abc.com","1.2.3.4"),now=0)
+    >>> print cache.get("WWW.abc.com",QTYPE.A,now=10).a
+    <DNS RR: 'www.abc.com' rtype=A rclass=IN ttl=50 rdata='1.2.3.4'>
+    >>> cache.get("www.abc.com",QTYPE.MX,now=10) is None
+    True
+    >>> cache.get("www.abc.com",QTYPE.A,now=60) is None
+    True
+    >>> p = cache.get_packet("www.abc.com",QTYPE.A,now=10,id=1234)
+    >>> print DNSRecord.parse(str(p)).header
+    <DNS Header: id=0x4d2 type=RESPONSE opcode=QUERY flags=RD rcode=None q=1 a=1 ns=0 ar=0>
+
+    Shared with a forked process:
+
+    >>> import os
+    >>> pid = os.fork()
+    >>> if pid == 0:
+    ...     cache.put(response("child.abc.com","5.6.7.8"),now=0)
+    ...     os._exit(0)
+    >>> os.waitpid(pid,0)[1]
+    0
+    >>> print cache.get("child.abc.com",QTYPE.A,now=0).a
+    <DNS RR: 'child.abc.com' rtype=A rclass=IN ttl=60 rdata='5.6.7.8'>
+
+    Old records are overwritten when the arena wraps:
+
+    >>> for i in range(100):
+    ...     cache.put(response("%d.abc.com" % i,"1.2.3.4"),now=0)
+    >>> cache.get("0.abc.com",QTYPE.A,now=0) is None
+    True
+    >>> print cache.get("99.abc.com",QTYPE.A,now=0).a
+    <DNS RR: '99.abc.com' rtype=A rclass=IN ttl=60 rdata='1.2.3.4'>
+    >>> 0 < len(cache) < 100
+    True
+
+    A slot left locked by a failed writer is a miss and is repaired by
+    the next put:
+
+    >>> index = cache.hash(cache.key("99.abc.com",QTYPE.A)) % cache.slots
+    >>> offset = cache.slots_offset + index * SLOT.size
+    >>> seq = SEQ.unpack_from(cache.map,offset)[0]
+    >>> SEQ.pack_into(cache.map,offset,seq + 1)
+    >>> cache.read_slot(index) is None
+    True
+    >>> cache.get("99.abc.com",QTYPE.A,now=0) is None
+    True
+    >>> cache.put(response("99.abc.com","1.2.3.4"),now=0)
+    >>> SEQ.unpack_from(cache.map,offset)[0] % 2
+    0
+    >>> print cache.get("99.abc.com",QTYPE.A,now=0).a
+    <DNS RR: '99.abc.com' rtype=A rclass=IN ttl=60 rdata='1.2.3.4'>
+    >>> cache.close()
+
+"""
+
+import fcntl,mmap,os,struct,tempfile,threading,time,zlib
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,RR,A,QTYPE
+from label import DNSLabel
+from cache import CacheEntry,ClientSubnet,cache_packet,pack_labels,response_ttl
+
+SHM_MAGIC = "DNSSHM01"
+# magic,slots,arena size,arena head
+SHM_HEADER = struct.Struct("=8sIQQ")
+HEADER_SIZE = 64
+HEAD_OFFSET = 20
+HEAD = struct.Struct("=Q")
+# seq,hash,created,expires,ttl,position,length,key length
+SLOT = struct.Struct("=IIddIQIH6x")
+SEQ = struct.Struct("=I")
+PROBES = 8
+READ_RETRIES = 1000
+
+class SharedCache(object):
+
+    """
+    Shared memory response cache
+
+        path        - mapped file (default: unlinked temporary file in
+                      /dev/shm - shared with child processes only)
+        slots       - number of hash table slots
+        arena       - arena size (bytes)
+
+    An existing file with the same geometry is reused (otherwise it is
+    initialised).
+    """
+
+    def __init__(self,path=None,slots=65536,arena=64*1024*1024,
+                      clock=time.time,max_stale=0,stale_ttl=30):
+        self.slots = slots
+        self.arena_size = arena
+        self.clock = clock
+        self.max_stale = max_stale
+        self.stale_ttl = stale_ttl
+        self.slots_offset = HEADER_SIZE
+        self.arena_offset = HEADER_SIZE + slots * SLOT.size
+        self.size = self.arena_offset + arena
+        if path is None:
+            fd,path = tempfile.mkstemp(prefix="dnslib-",
+                            dir=os.path.isdir("/dev/shm") and "/dev/shm" or None)
+            os.unlink(path)
+            self.f = os.fdopen(fd,"r+b")
+        else:
+            fd = os.open(path,os.O_RDWR|os.O_CREAT,0600)
+            self.f = os.fdopen(fd,"r+b")
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock()
+        try:
+            if os.fstat(self.f.fileno()).st_size != self.size:
+                self.f.truncate(self.size)
+            self.map = mmap.mmap(self.f.fileno(),self.size)
+            magic,nslots,size,head = SHM_HEADER.unpack_from(self.map)
+            if (magic,nslots,size) != (SHM_MAGIC,slots,arena):
+                self.map[:self.arena_offset] = "\x00" * self.arena_offset
+                SHM_HEADER.pack_into(self.map,0,SHM_MAGIC,slots,arena,0)
+        finally:
+            self.write_unlock()
+        # Per-process CacheEntry objects - index -> (seq,entry)
+        self.entries = {}
+
+    def write_lock(self):
+        self.lock.acquire()
+        fcntl.lockf(self.f.fileno(),fcntl.LOCK_EX)
+
+    def write_unlock(self):
+        fcntl.lockf(self.f.fileno(),fcntl.LOCK_UN)
+        self.lock.release()
+
+    def key(self,qname,qtype):
+        """
+            Cache key - lowercase label encoding of qname + qtype
+        """
+        if not isinstance(qname,DNSLabel):
+            qname = DNSLabel(qname)
+        return pack_labels([l.lower() for l in qname.label]) + \
+               struct.pack("!H",qtype)
+
+    def hash(self,key):
+        return (zlib.crc32(key) & 0xffffffff) or 1
+
+    def get_head(self):
+        return HEAD.unpack_from(self.map,HEAD_OFFSET)[0]
+
+    def read_slot(self,index):
+        """
+            Read slot (seqlock) - returns None if a consistent copy could
+            not be read in READ_RETRIES attempts
+        """
+        offset = self.slots_offset + index * SLOT.size
+        for i in xrange(READ_RETRIES):
+            slot = SLOT.unpack_from(self.map,offset)
+            if not slot[0] & 1 and \
+                    SEQ.unpack_from(self.map,offset)[0] == slot[0]:
+                return slot
+        return None
+
+    def repair_slot(self,index):
+        """
+            Clear slot with odd seq (left by a failed writer) - must be
+            called with the write lock held
+        """
+        offset = self.slots_offset + index * SLOT.size
+        seq = SEQ.unpack_from(self.map,offset)[0]
+        SLOT.pack_into(self.map,offset,(seq + 1) & 0xffffffff,0,0,0,0,0,0,0)
+        return SLOT.unpack_from(self.map,offset)
+
+    def read_record(self,position,length):
+        """
+            Read arena record (or None if it has been overwritten)
+        """
+        start = self.arena_offset + position % self.arena_size
+        data = self.map[start:start + length]
+        if self.get_head() > position + self.arena_size:
+            return None
+        return data
+
+    def find(self,key,h):
+        """
+            Return (index,slot,record) for key (or None)
+        """
+        for i in xrange(PROBES):
+            index = (h + i) % self.slots
+            slot = self.read_slot(index)
+            if slot is None:
+                continue
+            seq,shash,created,expires,ttl,position,length,keylen = slot
+            if shash == 0:
+                return None
+            if shash != h:
+                continue
+            cached = self.entries.get(index)
+            if cached is not None and cached[0] == seq and \
+                    self.get_head() <= position + self.arena_size:
+                return index,slot,None
+            record = self.read_record(position,length)
+            if record is not None and record[:keylen] == key and \
+                    SEQ.unpack_from(self.map,
+                        self.slots_offset + index * SLOT.size)[0] == seq:
+                return index,slot,record
+        return None
+
+    def lookup(self,qname,qtype,subnet=None,now=None,stale=False):
+        """
+            Return matching CacheEntry (or None) - if stale is True an
+            entry which expired less than max_stale seconds ago is
+            returned (subnet is ignored)
+        """
+        if now is None:
+            now = self.clock()
+        key = self.key(qname,qtype)
+        match = self.find(key,self.hash(key))
+        if match is None:
+            return None
+        index,slot,record = match
+        seq,h,created,expires,ttl,position,length,keylen = slot
+        if not now < expires + (stale and self.max_stale or 0):
+            return None
+        if record is None:
+            entry = self.entries[index][1]
+        else:
+            entry = CacheEntry(record[keylen:],ttl,created)
+            self.entries[index] = (seq,entry)
+        entry.hits += 1
+        return entry
+
+    def get_packet(self,qname,qtype,subnet=None,now=None,id=None,
+                   rd=None,cd=None,stale=False):
+        """
+            Return cached response in packed form (as bytearray) with
+            TTLs reduced by the time spent in cache and the header
+            id/RD/CD flags replaced if specified (or None)
+        """
+        if now is None:
+            now = self.clock()
+        entry = self.lookup(qname,qtype,subnet,now,stale)
+        if entry is None:
+            return None
+        return entry.get_packet(now,id,rd,cd,self.stale_ttl)
+
+    def get(self,qname,qtype,subnet=None,now=None):
+        """
+            Return cached response as DNSRecord (or None)
+        """
+        packet = self.get_packet(qname,qtype,subnet,now)
+        if packet is None:
+            return None
+        return DNSRecord.parse(str(packet))
+
+    def put(self,record,subnet=None,now=None):
+        """
+            Store response (responses with a non-zero ECS scope are not
+            stored)
+        """
+        if now is None:
+            now = self.clock()
+        ttl = response_ttl(record)
+        if ttl <= 0:
+            return
+        if subnet is None:
+            subnet = ClientSubnet.from_record(record)
+        if subnet is not None and subnet.scope != 0:
+            return
+        key = self.key(record.q.qname,record.q.qtype)
+        data = key + cache_packet(record)
+        if len(data) > self.arena_size:
+            return
+        h = self.hash(key)
+        self.write_lock()
+        try:
+            # Reserve space in arena (advance head before writing)
+            position = self.get_head()
+            offset = position % self.arena_size
+            if offset + len(data) > self.arena_size:
+                position += self.arena_size - offset
+                offset = 0
+            HEAD.pack_into(self.map,HEAD_OFFSET,position + len(data))
+            start = self.arena_offset + offset
+            self.map[start:start + len(data)] = data
+            # Select slot - same key, unused or first to expire
+            victim = None
+            for i in xrange(PROBES):
+                index = (h + i) % self.slots
+                slot = self.read_slot(index) or self.repair_slot(index)
+                if slot[1] == 0:
+                    victim = index
+                    break
+                if slot[1] == h and \
+                        self.read_record(slot[5],slot[7]) == key:
+                    victim = index
+                    break
+                if victim is None or slot[3] < expires:
+                    victim,expires = index,slot[3]
+            offset = self.slots_offset + victim * SLOT.size
+            seq = SEQ.unpack_from(self.map,offset)[0]
+            SEQ.pack_into(self.map,offset,(seq + 1) & 0xffffffff)
+            SLOT.pack_into(self.map,offset,(seq + 1) & 0xffffffff,h,now,
+                           now + ttl,ttl,position,len(data),len(key))
+            SEQ.pack_into(self.map,offset,(seq + 2) & 0xffffffff)
+        finally:
+            self.write_unlock()
+
+    def purge(self,now=None):
+        """
+            Deliberate no-op (kept for interface compatibility with
+            DNSCache) - expired entries are overwritten when the
+            slot/arena is reused
+        """
+
+    def __len__(self):
+        """
+            Number of slots with a (readable) record
+        """
+        count = 0
+        for index in xrange(self.slots):
+            slot = self.read_slot(index)
+            if slot is not None and slot[1] and self.get_head() <= slot[5] + self.arena_size:
+                count += 1
+        return count
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,248 @@
+
+"""
+    Synthesized PTR and forward (A/AAAA) records for address ranges
+
+    SynthRange computes answers for an address range at query time - PTR
+    records from in-addr.arpa/ip6.arpa names and A/AAAA records from a
+    forward name pattern - so large ranges (eg. an IPv4 /8 or an IPv6
+    /32) can be served without storing any RRs (memory use does not
+    depend on the size of the range).
+
+    The forward name pattern contains {ip} in its first label - this is
+    replaced by the address (IPv4 as dash separated decimal octets, IPv6
+    as 32 hex digits).
+
+    Ranges are added to a ZoneStore (see zone.ZoneStore.add_synthesizer)
+    for the reverse and/or forward zone - RRs in the zone take precedence
+    over synthesized records and the Bloom filter fast path is not used
+    for names below the range domains.
+
+    >>> r = SynthRange("10.0.0.0/8","ip-{ip}.abc.com",ttl=300)
+    >>> r.reverse_domain, r.forward_domain
+    (('10', 'in-addr', 'arpa'), ('abc', 'com'))
+    >>> n,bits = r.parse_reverse(r.key("4.3.2.10.in-addr.arpa"))
+    >>> r.hostname(n), bits
+    ('ip-10-2-3-4.abc.com', 32)
+    >>> r.format(r.parse_forward("ip-10-2-3-4"))
+    '10-2-3-4'
+    >>> r.parse_reverse(r.key("4.3.2.11.in-addr.arpa")) is None
+    True
+    >>> r.parse_forward("ip-10-2-3-256") is None
+    True
+
+    Plugged into ZoneStore:
+
+    >>> def soa(origin):
+    ...     return RR(origin,QTYPE.SOA,ttl=3600,
+    ...               rdata=SOA("ns1.abc.com","admin.abc.com",(1,7200,900,1209600,300)))
+    >>> reverse = ZoneStore("10.in-addr.arpa",[soa("10.in-addr.arpa"),
+    ...             RR("1.0.0.10.in-addr.arpa",QTYPE.PTR,ttl=3600,rdata=PTR("gw.abc.com"))])
+    >>> forward = ZoneStore("abc.com",[soa("abc.com")])
+    >>> reverse.add_synthesizer(r)
+    >>> forward.add_synthesizer(r)
+    >>> def query(zone,name,qtype="A"):
+    ...     reply = zone.answer(DNSRecord(q=DNSQuestion(name,getattr(QTYPE,qtype))))
+    ...     if not isinstance(reply,DNSRecord):
+    ...         reply = DNSRecord.parse(str(reply))
+    ...     return RCODE[reply.header.rcode], [ str(rr) for rr in reply.rr ]
+    >>> query(reverse,"4.3.2.10.in-addr.arpa","PTR")
+    ('None', ["<DNS RR: '4.3.2.10.in-addr.arpa' rtype=PTR rclass=IN ttl=300 rdata='ip-10-2-3-4.abc.com'>"])
+    >>> query(reverse,"1.0.0.10.in-addr.arpa","PTR")
+    ('None', ["<DNS RR: '1.0.0.10.in-addr.arpa' rtype=PTR rclass=IN ttl=3600 rdata='gw.abc.com'>"])
+    >>> query(reverse,"3.2.10.in-addr.arpa","PTR")
+    ('None', [])
+    >>> query(forward,"IP-10-2-3-4.abc.com")
+    ('None', ["<DNS RR: 'IP-10-2-3-4.abc.com' rtype=A rclass=IN ttl=300 rdata='10.2.3.4'>"])
+    >>> query(forward,"ip-10-2-3-4.abc.com","AAAA")
+    ('None', [])
+    >>> query(forward,"ip-11-2-3-4.abc.com")
+    ('Name Error', [])
+    >>> query(forward,"www.abc.com")
+    ('Name Error', [])
+
+    IPv6:
+
+    >>> r6 = SynthRange("2001:db8::/32","host-{ip}.abc.com")
+    >>> r6.reverse_domain
+    ('8', 'b', 'd', '0', '1', '0', '0', '2', 'ip6', 'arpa')
+    >>> forward.add_synthesizer(r6)
+    >>> name = r6.hostname(r6.parse_forward("host-20010db8000000000000000000000001"))
+    >>> name
+    'host-20010db8000000000000000000000001.abc.com'
+    >>> query(forward,name,"AAAA")
+    ('None', ["<DNS RR: 'host-20010db8000000000000000000000001.abc.com' rtype=AAAA rclass=IN ttl=3600 rdata='2001:0db8:0000:0000:0000:0000:0000:0001'>"])
+    >>> reverse6 = ZoneStore("8.b.d.0.1.0.0.2.ip6.arpa",[soa("8.b.d.0.1.0.0.2.ip6.arpa")])
+    >>> reverse6.add_synthesizer(r6)
+    >>> query(reverse6,".".join("1000000000000000000000008bd01002") + ".ip6.arpa","PTR")
+    ('None', ["<DNS RR: '1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa' rtype=PTR rclass=IN ttl=3600 rdata='host-20010db8000000000000000000000001.abc.com'>"])
+
+    Only the exact synthesized form (32 hex digits) is accepted:
+
+    >>> r0 = SynthRange("::/16","host-{ip}.abc.com")
+    >>> r0.parse_forward("host-" + "0" * 31 + "1")
+    1
+    >>> [ r0.parse_forward("host-" + ip + "0" * 29 + "1") for ip in ("0x","+0"," 0","-0") ]
+    [None, None, None, None]
+    >>> r0.parse_forward("host-" + "0" * 32 + "\\n") is None
+    True
+
+"""
+
+import re,socket
+
+from dns import DNSRecord,DNSQuestion,RR,A,AAAA,PTR,SOA,QTYPE,RCODE
+from label import DNSLabel
+from zone import ZoneStore
+
+# IPv6 address in forward name (as formatted by SynthRange.format)
+IPV6_LABEL = re.compile(r'^[0-9a-f]{32}\Z')
+
+class SynthRange(object):
+
+    """
+    Synthesized records for address range
+
+        network     - range as ADDRESS/PREFIXLEN
+        pattern     - forward name pattern ({ip} in first label)
+        ttl         - TTL of synthesized RRs
+    """
+
+    def __init__(self,network,pattern,ttl=3600):
+        address,prefixlen = network.split("/")
+        if ":" in address:
+            self.family,self.bits,self.suffix = socket.AF_INET6,128,('ip6','arpa')
+        else:
+            self.family,self.bits,self.suffix = socket.AF_INET,32,('in-addr','arpa')
+        self.prefixlen = int(prefixlen)
+        self.mask = ((1 << self.prefixlen) - 1) << (self.bits - self.prefixlen)
+        self.network = self.to_int(socket.inet_pton(self.family,address)) & self.mask
+        self.ttl = ttl
+        first,_,domain = pattern.partition(".")
+        if first.count("{ip}") != 1:
+            raise ValueError("Pattern must contain {ip} in first label: %s" % pattern)
+        self.label_prefix,self.label_suffix = [ s.lower() for s in first.split("{ip}") ]
+        self.domain = domain
+        self.forward_domain = self.key(domain)
+        self.reverse_domain = self.reverse_labels(self.network,self.prefixlen) + \
+                              self.suffix
+
+    def key(self,name):
+        if not isinstance(name,DNSLabel):
+            name = DNSLabel(name)
+        return tuple([ l.lower() for l in name.label ])
+
+    def domains(self):
+        """
+            Domains below which records are synthesized
+        """
+        return [self.reverse_domain,self.forward_domain]
+
+    def to_int(self,packed):
+        return int(packed.encode('hex'),16)
+
+    def to_packed(self,n):
+        return ("%0*x" % (self.bits // 4,n)).decode('hex')
+
+    def contains(self,n):
+        return n & self.mask == self.network
+
+    def reverse_labels(self,n,prefixlen):
+        """
+            Reverse name labels (without suffix) for first prefixlen bits
+            of address (whole octets/nibbles)
+        """
+        if self.family == socket.AF_INET:
+            octets = [ str((n >> (24 - 8 * i)) & 0xff) for i in range(prefixlen // 8) ]
+            return tuple(reversed(octets))
+        nibbles = [ "%x" % ((n >> (124 - 4 * i)) & 0xf) for i in range(prefixlen // 4) ]
+        return tuple(reversed(nibbles))
+
+    def parse_reverse(self,key):
+        """
+            Address from reverse name key - returns (address,bits) where
+            bits is the number of address bits in the name (or None if
+            the name is invalid or outside the range)
+        """
+        labels = key[:-2]
+        if self.family == socket.AF_INET:
+            width,base,valid = 8,10,lambda l:l.isdigit() and str(int(l)) == l \
+                                                and int(l) <= 255
+        else:
+            width,base,valid = 4,16,lambda l:len(l) == 1 and l in "0123456789abcdef"
+        if len(labels) > self.bits // width or \
+                [ l for l in labels if not valid(l) ]:
+            return None
+        n = 0
+        for l in reversed(labels):
+            n = (n << width) | int(l,base)
+        bits = len(labels) * width
+        n <<= self.bits - bits
+        mask = self.mask & ~((1 << (self.bits - bits)) - 1)
+        if n & mask != self.network & mask:
+            return None
+        return n,bits
+
+    def format(self,n):
+        if self.family == socket.AF_INET:
+            return "-".join([ str(ord(c)) for c in self.to_packed(n) ])
+        return "%032x" % n
+
+    def parse_forward(self,label):
+        """
+            Address from first label of forward name (or None)
+        """
+        label = label.lower()
+        if not (label.startswith(self.label_prefix) and
+                label.endswith(self.label_suffix)) or \
+                len(label) <= len(self.label_prefix) + len(self.label_suffix):
+            return None
+        ip = label[len(self.label_prefix):len(label) - len(self.label_suffix)]
+        if self.family == socket.AF_INET:
+            octets = ip.split("-")
+            if len(octets) != 4 or [ o for o in octets if not o.isdigit() or
+                                     str(int(o)) != o or int(o) > 255 ]:
+                return None
+            n = 0
+            for o in octets:
+                n = (n << 8) | int(o)
+        else:
+            if not IPV6_LABEL.match(ip):
+                return None
+            n = int(ip,16)
+        if not self.contains(n):
+            return None
+        return n
+
+    def hostname(self,n):
+        return "%s%s%s.%s" % (self.label_prefix,self.format(n),
+                              self.label_suffix,self.domain)
+
+    def lookup(self,key,qname):
+        """
+            Return {rtype:[RR]} for name, {} for an empty non-terminal in
+            the reverse tree or None if no record is synthesized
+        """
+        if key[-len(self.suffix):] == self.suffix and \
+                key[-len(self.reverse_domain):] == self.reverse_domain:
+            address = self.parse_reverse(key)
+            if address is None:
+                return None
+            n,bits = address
+            if bits < self.bits:
+                return {}
+            return { QTYPE.PTR: [ RR(qname,QTYPE.PTR,ttl=self.ttl,
+                                     rdata=PTR(self.hostname(n))) ] }
+        if key[1:] == self.forward_domain:
+            n = self.parse_forward(key[0])
+            if n is None:
+                return None
+            if self.family == socket.AF_INET:
+                return { QTYPE.A: [ RR(qname,QTYPE.A,ttl=self.ttl,
+                                       rdata=A(socket.inet_ntoa(self.to_packed(n)))) ] }
+            return { QTYPE.AAAA: [ RR(qname,QTYPE.AAAA,ttl=self.ttl,
+                                      rdata=AAAA(map(ord,self.to_packed(n)))) ] }
+        return None
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
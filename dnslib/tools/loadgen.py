@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+"""
+    DNS load generator (dnsperf style)
+
+    Sends queries (from a query list or a generated qtype mix) to a
+    server over UDP or TCP at a target rate (or as fast as possible)
+    with many outstanding queries, matching responses by DNSHeader.id.
+    Reports achieved QPS, loss and latency percentiles.
+
+    Options:
+
+      --server=SERVER       DNS server (default: 127.0.0.1)
+      --port=PORT           DNS server port (default: 53)
+      --queries=FILE        Query list - one 'name [qtype]' per line
+      --name=NAME           Query name if no query list (may be repeated)
+      --mix=MIX             Qtype mix for --name (default: A:1)
+                            eg. A:80,AAAA:15,MX:5
+      --qps=QPS             Target QPS (default: 0 - maximum rate)
+      --duration=SECS       Test duration (default: 10)
+      --outstanding=N       Maximum outstanding queries (default: 100)
+      --timeout=SECS        Query timeout (default: 2)
+      --tcp                 Use TCP (queries are pipelined)
+      --sockets=N           Number of UDP sockets/TCP connections (default: 1)
+
+    Usage:
+
+    # python dnslib/tools/loadgen.py --server=127.0.0.1 --port=8053 \\
+            --name=www.google.com --mix=A:80,AAAA:20 --qps=5000
+
+    Note: implemented as a select() based event loop (the library
+    targets Python 2 so asyncio is not available)
+
+"""
+
+import errno,math,optparse,random,select,socket,struct,sys,time
+
+from collections import deque
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, QTYPE
+
+def percentile(values,p):
+    """
+        Return p'th percentile (0-100) of sorted values (nearest rank)
+
+        >>> v = range(1,1001)
+        >>> [percentile(v,p) for p in (50,90,99,99.9)]
+        [500, 900, 990, 999]
+        >>> percentile([],50) is None
+        True
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(round(p * len(values) / 100.0,6))) - 1
+    return values[max(0,min(rank,len(values) - 1))]
+
+def parse_qtype(qtype):
+    """
+        Parse qtype mnemonic (or number) - raises ValueError if unknown
+
+        >>> parse_qtype("aaaa"), parse_qtype("65")
+        (28, 65)
+        >>> parse_qtype("XYZ")
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown qtype: XYZ
+    """
+    if qtype.isdigit() and int(qtype) < 65536:
+        return int(qtype)
+    value = QTYPE.reverse.get(qtype.upper())
+    if value is None:
+        raise ValueError("Unknown qtype: %s" % qtype)
+    return value
+
+def parse_mix(mix):
+    """
+        Parse qtype mix specification ('A:80,AAAA:15,MX:5') and return
+        list of (qtype,weight)
+
+        >>> parse_mix("A:80,AAAA:15,MX:5")
+        [(1, 80), (28, 15), (15, 5)]
+        >>> parse_mix("TXT")
+        [(16, 1)]
+        >>> parse_mix("A:80,AXFR2:20")
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown qtype: AXFR2
+    """
+    result = []
+    for item in mix.split(","):
+        qtype,_,weight = item.partition(":")
+        result.append((parse_qtype(qtype),int(weight or 1)))
+    return result
+
+def load_queries(f):
+    """
+        Read query list ('name [qtype]' per line - blank lines and lines
+        starting with '#' are ignored) and return list of (name,qtype)
+
+        >>> load_queries(["www.google.com A","# comment","","google.com MX",
+        ...               "abc.com"])
+        [('www.google.com', 1), ('google.com', 15), ('abc.com', 1)]
+    """
+    queries = []
+    for n,line in enumerate(f,1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        try:
+            qtype = len(fields) > 1 and parse_qtype(fields[1]) or QTYPE.A
+        except ValueError,e:
+            raise ValueError("Line %d: %s" % (n,e))
+        queries.append((fields[0],qtype))
+    return queries
+
+def mix_queries(names,mix,count=1000,seed=None):
+    """
+        Generate query list with qtypes chosen according to mix
+
+        >>> q = mix_queries(["abc.com"],[(QTYPE.A,3),(QTYPE.MX,1)],1000,seed=1)
+        >>> len(q), len([x for x in q if x[1] == QTYPE.A]) > 600
+        (1000, True)
+    """
+    rnd = random.Random(seed)
+    total = sum([w for q,w in mix])
+    queries = []
+    for i in range(count):
+        n = rnd.uniform(0,total)
+        for qtype,weight in mix:
+            n -= weight
+            if n <= 0:
+                break
+        queries.append((rnd.choice(names),qtype))
+    return queries
+
+class Stats(object):
+
+    """
+        Load test results
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.unexpected = 0
+        self.latencies = []
+        self.start = self.end = 0
+
+    def summary(self):
+        """
+            Return results as dict (latencies in ms)
+        """
+        latencies = sorted(self.latencies)
+        elapsed = max(self.end - self.start,1e-9)
+        result = { 'sent': self.sent,
+                   'received': self.received,
+                   'timeouts': self.timeouts,
+                   'errors': self.errors,
+                   'unexpected': self.unexpected,
+                   'elapsed': round(elapsed,3),
+                   'qps': round(self.received / elapsed,1),
+                   'loss': self.sent and
+                        round(100.0 * (self.sent - self.received) / self.sent,3) or 0 }
+        for p,name in ((50,'p50'),(90,'p90'),(99,'p99'),(99.9,'p999')):
+            v = percentile(latencies,p)
+            result[name] = v is not None and round(v * 1000,3) or None
+        return result
+
+    def __str__(self):
+        s = self.summary()
+        return "\n".join([
+            "Queries sent:       %(sent)d" % s,
+            "Queries completed:  %(received)d (%(loss).3f%% lost)" % s,
+            "Timeouts:           %(timeouts)d" % s,
+            "Errors:             %(errors)d" % s,
+            "Elapsed:            %(elapsed).3fs" % s,
+            "QPS:                %(qps).1f" % s,
+            "Latency (ms):       p50=%(p50)s p90=%(p90)s p99=%(p99)s p999=%(p999)s" % s])
+
+class Connection(object):
+
+    """
+        UDP socket or TCP connection (with framing)
+    """
+
+    def __init__(self,address,tcp=False):
+        self.address = address
+        self.tcp = tcp
+        self.buffer = ""
+        family = ':' in address[0] and socket.AF_INET6 or socket.AF_INET
+        if tcp:
+            self.sock = socket.socket(family,socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.socket(family,socket.SOCK_DGRAM)
+            self.sock.connect(address)
+        self.sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self,packet):
+        if self.tcp:
+            # Blocking send keeps framing intact if the socket buffer fills
+            self.sock.setblocking(1)
+            try:
+                self.sock.sendall(struct.pack("!H",len(packet)) + packet)
+            finally:
+                self.sock.setblocking(0)
+        else:
+            self.sock.send(packet)
+
+    def recv(self):
+        """
+            Return list of received packets
+        """
+        packets = []
+        if self.tcp:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error,e:
+                if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return packets
+                raise
+            if not data:
+                raise socket.error(errno.ECONNRESET,"Connection closed")
+            self.buffer += data
+            while len(self.buffer) >= 2:
+                (length,) = struct.unpack("!H",self.buffer[:2])
+                if len(self.buffer) < length + 2:
+                    break
+                packets.append(self.buffer[2:length+2])
+                self.buffer = self.buffer[length+2:]
+        else:
+            while True:
+                try:
+                    packets.append(self.sock.recv(65536))
+                except socket.error,e:
+                    if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                        break
+                    raise
+        return packets
+
+    def close(self):
+        self.sock.close()
+
+class LoadGenerator(object):
+
+    """
+    Send queries to server and collect Stats
+
+    >>> import threading
+    >>> server = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> server.bind(("127.0.0.1",0))
+    >>> def echo():
+    ...     while True:
+    ...         data,peer = server.recvfrom(8192)
+    ...         if data == "stop":
+    ...             break
+    ...         server.sendto(data[:2] + chr(ord(data[2]) | 0x80) + data[3:],peer)
+    >>> t = threading.Thread(target=echo)
+    >>> t.start()
+    >>> g = LoadGenerator(server.getsockname(),[("abc.com",QTYPE.A)],
+    ...                   qps=500,duration=0.2,timeout=1)
+    >>> stats = g.run()
+    >>> stats.sent == stats.received, stats.timeouts
+    (True, 0)
+    >>> 80 < stats.sent <= 101
+    True
+    >>> server.sendto("stop",server.getsockname())
+    4
+    >>> t.join()
+
+    """
+
+    def __init__(self,address,queries,qps=0,duration=10,outstanding=100,
+                      timeout=2,tcp=False,sockets=1):
+        self.address = address
+        self.qps = qps
+        self.duration = duration
+        self.outstanding = outstanding
+        self.timeout = timeout
+        self.tcp = tcp
+        self.sockets = sockets
+        # Pre-pack queries (the id is replaced when sent)
+        self.packets = [ DNSRecord(DNSHeader(id=0),
+                                   q=DNSQuestion(name,qtype)).pack()[2:]
+                            for name,qtype in queries ]
+
+    def run(self):
+        stats = Stats()
+        connections = [ Connection(self.address,self.tcp)
+                                    for i in range(self.sockets) ]
+        pending = {}            # id -> (send time,connection)
+        sent = deque()          # (send time,id) in send order
+        next_id = random.randint(0,65535)
+        n = 0
+        packets = self.packets
+        npackets = len(packets)
+        interval = self.qps and 1.0 / self.qps or 0
+        start = time.time()
+        stop = start + self.duration
+        stats.start = start
+        now = start
+        while True:
+            sending = now < stop
+            if not sending and not pending:
+                break
+            # Send queries which are due
+            while sending and len(pending) < self.outstanding and \
+                    (not interval or start + n * interval <= now):
+                while next_id in pending:
+                    next_id = (next_id + 1) & 0xffff
+                c = connections[n % len(connections)]
+                try:
+                    c.send(struct.pack("!H",next_id) + packets[n % npackets])
+                except socket.error:
+                    stats.errors += 1
+                else:
+                    pending[next_id] = (now,c)
+                    sent.append((now,next_id))
+                    stats.sent += 1
+                next_id = (next_id + 1) & 0xffff
+                n += 1
+            # Wait for responses (or next send time)
+            if sending and len(pending) < self.outstanding and interval:
+                wait = max(start + n * interval - now,0)
+            else:
+                wait = sent and max(sent[0][0] + self.timeout - now,0) or 0.01
+            r,w,x = select.select(connections,[],[],min(wait,0.1))
+            now = time.time()
+            for c in r:
+                try:
+                    responses = c.recv()
+                except socket.error:
+                    self.reconnect(c,connections,pending,stats)
+                    continue
+                for response in responses:
+                    if len(response) < 12:
+                        stats.unexpected += 1
+                        continue
+                    (id,) = struct.unpack("!H",response[:2])
+                    p = pending.pop(id,None)
+                    if p is None:
+                        stats.unexpected += 1
+                    else:
+                        stats.received += 1
+                        stats.latencies.append(now - p[0])
+            # Expire timed out queries
+            while sent and sent[0][0] + self.timeout <= now:
+                t,id = sent.popleft()
+                p = pending.get(id)
+                if p is not None and p[0] == t:
+                    del pending[id]
+                    stats.timeouts += 1
+            while sent and sent[0][1] not in pending:
+                sent.popleft()
+        stats.end = now
+        for c in connections:
+            c.close()
+        return stats
+
+    def reconnect(self,c,connections,pending,stats):
+        """
+            Replace failed connection (outstanding queries on the
+            connection are counted as errors)
+        """
+        for id,(t,conn) in pending.items():
+            if conn is c:
+                del pending[id]
+                stats.errors += 1
+        c.close()
+        connections[connections.index(c)] = Connection(self.address,self.tcp)
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--server",default="127.0.0.1",help="DNS server (default: 127.0.0.1)")
+    parser.add_option("--port",type=int,default=53,help="DNS server port (default: 53)")
+    parser.add_option("--queries",help="Query list - one 'name [qtype]' per line")
+    parser.add_option("--name",action="append",help="Query name if no query list (may be repeated)")
+    parser.add_option("--mix",default="A:1",help="Qtype mix for --name (default: A:1)")
+    parser.add_option("--qps",type=float,default=0,help="Target QPS (default: 0 - maximum rate)")
+    parser.add_option("--duration",type=float,default=10,help="Test duration (default: 10)")
+    parser.add_option("--outstanding",type=int,default=100,help="Maximum outstanding queries (default: 100)")
+    parser.add_option("--timeout",type=float,default=2,help="Query timeout (default: 2)")
+    parser.add_option("--tcp",action="store_true",default=False,help="Use TCP")
+    parser.add_option("--sockets",type=int,default=1,help="Number of UDP sockets/TCP connections (default: 1)")
+    parser.add_option("--doctest",action="store_true",default=False,help="Run doctests")
+    options,args = parser.parse_args()
+
+    if options.doctest:
+        import doctest
+        doctest.testmod()
+        sys.exit(0)
+
+    try:
+        if options.queries:
+            queries = load_queries(open(options.queries))
+        elif options.name:
+            queries = mix_queries(options.name,parse_mix(options.mix))
+        else:
+            parser.error("Either --queries or --name must be specified")
+    except ValueError,e:
+        parser.error(str(e))
+
+    g = LoadGenerator((options.server,options.port),queries,
+                      qps=options.qps,duration=options.duration,
+                      outstanding=options.outstanding,timeout=options.timeout,
+                      tcp=options.tcp,sockets=options.sockets)
+    print g.run()
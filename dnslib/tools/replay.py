@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+    DNS query replay tool
+
+    Reads captured queries (and responses) from a pcap file or queries
+    from a binary query log (server.querylog) and re-sends the queries to a target server - either
+    with the recorded inter-arrival times (optionally scaled by a speed
+    multiplier) or at maximum rate. Responses are compared with the
+    captured responses if there are any (rcode and answer RRsets, ignoring
+    TTLs and RR order) and latency is reported.
+
+    Queries are only examined with wire.parse_question while sending -
+    responses are compared (using lazy parsing) after the run so that the
+    tool does not limit the send rate.
+
+    Options:
+
+      --pcap=FILE           Read queries/responses from pcap/pcapng file
+      --log=FILE            Read queries from binary query log
+      --server=SERVER       Target DNS server (default: 127.0.0.1)
+      --port=PORT           Target DNS server port (default: 53)
+      --speed=SPEED         Speed multiplier for recorded timing (default: 1.0)
+      --max                 Send at maximum rate (ignore recorded timing)
+      --outstanding=N       Maximum outstanding queries (default: 1000)
+      --timeout=SECS        Query timeout (default: 2)
+      --mismatches=N        Number of mismatches to print (default: 10)
+
+    Usage:
+
+    # python dnslib/tools/replay.py --pcap=capture.pcap --server=127.0.0.1 \\
+            --port=8053 --speed=2
+
+"""
+
+import optparse,select,socket,struct,sys,time
+
+from collections import deque
+
+from dnslib import DNSRecord, DNSQuestion, QTYPE, RCODE
+from dnslib.label import unescape_name
+from dnslib.pcap import read_dns
+from dnslib.server.base import PARSE_ERRORS
+from dnslib.server.querylog import read_binary
+from dnslib.wire import parse_question
+from dnslib.tools.loadgen import Connection, Stats
+
+def log_entries(f):
+    """
+        Read binary query log (see server.querylog.BinaryWriter) and
+        return list of (timestamp,query,None) - queries are built from
+        the logged qname/qtype (responses are not logged)
+
+        >>> import os,tempfile
+        >>> from dnslib import DNSQuestion
+        >>> from dnslib.server.querylog import QueryLog
+        >>> fd,path = tempfile.mkstemp()
+        >>> log = QueryLog(path,format="binary")
+        >>> log.log(1.0,("10.0.0.1",1234),DNSRecord(q=DNSQuestion("abc.com",QTYPE.MX)),0,0.001)
+        >>> log.log(2.5,None,DNSRecord(q=DNSQuestion(["a.b","\\xff","com"])),0,0.001)
+        >>> log.close()
+        >>> for ts,query,response in log_entries(open(path,"rb")):
+        ...     print ts, DNSRecord.parse(query).q, response
+        1.0 <DNS Question: 'abc.com' qtype=MX qclass=IN> None
+        2.5 <DNS Question: 'a.b.\\xff.com' qtype=A qclass=IN> None
+        >>> os.close(fd)
+        >>> os.remove(path)
+    """
+    entries = []
+    for ts,client,port,qname,qtype,rcode,latency in read_binary(f):
+        query = DNSRecord(q=DNSQuestion(unescape_name(qname),qtype))
+        entries.append((ts,query.pack(),None))
+    return entries
+
+def pcap_entries(path=None,data=None):
+    """
+        Read pcap/pcapng capture (file path or data buffer) and return list of
+        (timestamp,query,response) matching responses to queries by
+        (client,server,id) - UDP and TCP messages are included
+
+        >>> import StringIO
+        >>> from dnslib.pcap import write_pcap, udp_packet
+        >>> from dnslib import DNSHeader, DNSQuestion
+        >>> q = DNSRecord(DNSHeader(id=7),q=DNSQuestion("abc.com"))
+        >>> r = q.reply("1.2.3.4")
+        >>> client,server = ("10.0.0.1",1234),("10.0.0.2",53)
+        >>> f = StringIO.StringIO()
+        >>> write_pcap(f,[(1.0,udp_packet(client,server,q.pack())),
+        ...               (1.1,udp_packet(server,client,r.pack()))])
+        >>> [(ts,DNSRecord.parse(q).header.id,DNSRecord.parse(r).header.id)
+        ...         for ts,q,r in pcap_entries(data=f.getvalue())]
+        [(1.0, 7, 7)]
+    """
+    entries = []
+    pending = {}
+    for ts,src,dst,message in read_dns(path,parser=None,data=data):
+        if len(message) < 12:
+            continue
+        (id,flags) = struct.unpack("!HH",message[:4])
+        if flags & 0x8000:
+            index = pending.pop((dst,src,id),None)
+            if index is not None:
+                entries[index] = (entries[index][0],entries[index][1],message)
+        else:
+            pending[(src,dst,id)] = len(entries)
+            entries.append((ts,message,None))
+    return entries
+
+def rrset_key(record):
+    """
+        Return comparison key for response - (rcode,sorted answer RRs)
+        ignoring TTLs/RR order and name case
+    """
+    answers = sorted([ (str(rr.rname).lower(),rr.rtype,rr.rclass,str(rr.rdata))
+                            for rr in record.rr ])
+    return (record.header.rcode,answers)
+
+def compare(captured,received):
+    """
+        Compare captured and received responses - returns None if they
+        match or a description of the mismatch
+
+        >>> from dnslib import DNSHeader, DNSQuestion, RR, A
+        >>> q = DNSRecord(DNSHeader(id=7),q=DNSQuestion("abc.com"))
+        >>> r1 = q.reply("1.2.3.4")
+        >>> r1.add_answer(RR("abc.com",rdata=A("5.6.7.8"),ttl=60))
+        >>> r2 = q.reply("5.6.7.8")
+        >>> r2.add_answer(RR("ABC.com",rdata=A("1.2.3.4"),ttl=30))
+        >>> compare(r1.pack(),r2.pack()) is None
+        True
+        >>> r2.header.rcode = 3
+        >>> compare(r1.pack(),r2.pack())
+        'rcode None != Name Error'
+        >>> r2.header.rcode = 0
+        >>> r2.rr[0].rdata = A("9.9.9.9")
+        >>> print compare(r1.pack(),r2.pack())
+        answer ['abc.com A 1.2.3.4', 'abc.com A 5.6.7.8'] != ['abc.com A 1.2.3.4', 'abc.com A 9.9.9.9']
+        >>> compare(r1.pack(),r2.pack()[:-2])
+        'parse error: unpack requires a string argument of length 4'
+    """
+    try:
+        a = rrset_key(DNSRecord.parse(captured,lazy=True))
+        b = rrset_key(DNSRecord.parse(received,lazy=True))
+    except PARSE_ERRORS,e:
+        return "parse error: %s" % e
+    if a[0] != b[0]:
+        return "rcode %s != %s" % (RCODE[a[0]],RCODE[b[0]])
+    if a[1] != b[1]:
+        fmt = lambda rrs: ["%s %s %s" % (n,QTYPE[t],d) for n,t,c,d in rrs]
+        return "answer %s != %s" % (fmt(a[1]),fmt(b[1]))
+    return None
+
+class Replay(object):
+
+    """
+    Replay captured queries against a server
+
+    >>> import threading
+    >>> from dnslib import DNSHeader, DNSQuestion
+    >>> server = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    >>> server.bind(("127.0.0.1",0))
+    >>> def respond():
+    ...     while True:
+    ...         data,peer = server.recvfrom(8192)
+    ...         if data == "stop":
+    ...             break
+    ...         server.sendto(DNSRecord.parse(data).reply("1.2.3.4").pack(),peer)
+    >>> t = threading.Thread(target=respond)
+    >>> t.start()
+    >>> entries = []
+    >>> for i,ip in enumerate(("1.2.3.4","1.2.3.4","5.6.7.8")):
+    ...     q = DNSRecord(DNSHeader(id=1),q=DNSQuestion("abc%d.com" % i))
+    ...     entries.append((i * 0.01,q.pack(),q.reply(ip).pack()))
+    >>> replay = Replay(server.getsockname(),entries,speed=2)
+    >>> stats = replay.run()
+    >>> stats.sent, stats.received
+    (3, 3)
+    >>> replay.mismatches
+    [(2, 'abc2.com', "answer ['abc2.com A 5.6.7.8'] != ['abc2.com A 1.2.3.4']")]
+    >>> server.sendto("stop",server.getsockname())
+    4
+    >>> t.join()
+
+    """
+
+    def __init__(self,address,entries,speed=1.0,maxrate=False,
+                      outstanding=1000,timeout=2):
+        if speed <= 0:
+            raise ValueError("speed must be greater than 0")
+        self.address = address
+        self.entries = entries
+        self.speed = speed
+        self.maxrate = maxrate
+        self.outstanding = outstanding
+        self.timeout = timeout
+        self.responses = [None] * len(entries)
+        self.mismatches = []
+
+    def run(self):
+        stats = Stats()
+        conn = Connection(self.address)
+        entries = self.entries
+        pending = {}            # id -> (send time,index)
+        sent = deque()
+        next_id = 0
+        n = 0
+        t0 = entries and entries[0][0] or 0
+        start = time.time()
+        stats.start = now = start
+        while n < len(entries) or pending:
+            # Send queries which are due
+            while n < len(entries) and len(pending) < self.outstanding:
+                ts,query,response = entries[n]
+                if not self.maxrate and start + (ts - t0) / self.speed > now:
+                    break
+                try:
+                    parse_question(query)
+                except PARSE_ERRORS:
+                    stats.errors += 1
+                    n += 1
+                    continue
+                while next_id in pending:
+                    next_id = (next_id + 1) & 0xffff
+                try:
+                    conn.send(struct.pack("!H",next_id) + query[2:])
+                except socket.error:
+                    stats.errors += 1
+                else:
+                    pending[next_id] = (now,n)
+                    sent.append((now,next_id))
+                    stats.sent += 1
+                next_id = (next_id + 1) & 0xffff
+                n += 1
+            if n < len(entries) and len(pending) < self.outstanding and not self.maxrate:
+                wait = max(start + (entries[n][0] - t0) / self.speed - now,0)
+            else:
+                wait = sent and max(sent[0][0] + self.timeout - now,0) or 0.01
+            r,w,x = select.select([conn],[],[],min(wait,0.1))
+            now = time.time()
+            if r:
+                for data in conn.recv():
+                    if len(data) < 12:
+                        stats.unexpected += 1
+                        continue
+                    (id,) = struct.unpack("!H",data[:2])
+                    p = pending.pop(id,None)
+                    if p is None:
+                        stats.unexpected += 1
+                        continue
+                    stats.received += 1
+                    stats.latencies.append(now - p[0])
+                    self.responses[p[1]] = data
+            while sent and sent[0][0] + self.timeout <= now:
+                t,id = sent.popleft()
+                p = pending.get(id)
+                if p is not None and p[0] == t:
+                    del pending[id]
+                    stats.timeouts += 1
+            while sent and sent[0][1] not in pending:
+                sent.popleft()
+        stats.end = now
+        conn.close()
+        self.compare()
+        return stats
+
+    def compare(self):
+        """
+            Compare received responses with captured responses
+        """
+        self.mismatches = []
+        for i,(ts,query,captured) in enumerate(self.entries):
+            received = self.responses[i]
+            if captured is None or received is None:
+                continue
+            # Restore original id before comparing
+            mismatch = compare(captured,query[:2] + received[2:])
+            if mismatch:
+                self.mismatches.append((i,parse_question(query)[3],mismatch))
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="Usage: %prog [options]")
+    parser.add_option("--pcap",help="Read queries/responses from pcap file")
+    parser.add_option("--log",help="Read queries from binary query log")
+    parser.add_option("--server",default="127.0.0.1",help="Target DNS server (default: 127.0.0.1)")
+    parser.add_option("--port",type=int,default=53,help="Target DNS server port (default: 53)")
+    parser.add_option("--speed",type=float,default=1.0,help="Speed multiplier for recorded timing (default: 1.0)")
+    parser.add_option("--max",action="store_true",default=False,help="Send at maximum rate")
+    parser.add_option("--outstanding",type=int,default=1000,help="Maximum outstanding queries (default: 1000)")
+    parser.add_option("--timeout",type=float,default=2,help="Query timeout (default: 2)")
+    parser.add_option("--mismatches",type=int,default=10,help="Number of mismatches to print (default: 10)")
+    parser.add_option("--doctest",action="store_true",default=False,help="Run doctests")
+    options,args = parser.parse_args()
+
+    if options.doctest:
+        import doctest
+        doctest.testmod()
+        sys.exit(0)
+
+    if options.speed <= 0:
+        parser.error("--speed must be greater than 0")
+
+    if options.pcap:
+        entries = pcap_entries(options.pcap)
+    elif options.log:
+        entries = log_entries(open(options.log,"rb"))
+    else:
+        parser.error("Either --pcap or --log must be specified")
+
+    replay = Replay((options.server,options.port),entries,
+                    speed=options.speed,maxrate=options.max,
+                    outstanding=options.outstanding,timeout=options.timeout)
+    stats = replay.run()
+    print stats
+    print "Mismatches:         %d" % len(replay.mismatches)
+    for i,qname,mismatch in replay.mismatches[:options.mismatches]:
+        print "  [%d] %s: %s" % (i,qname,mismatch)
@@ -0,0 +1,263 @@
+
+"""
+    Wire-level access to packed DNS messages (without building
+    DNSRecord objects)
+"""
+
+import struct
+
+from bit import set_bits
+from dns import DNSRecord,DNSHeader,DNSQuestion,DNSError,RR,SOA,QTYPE
+from label import DNSBuffer
+
+OPT = QTYPE.OPT
+CD_BIT = 1 << 4
+
+HEADER = struct.Struct("!HHHHHH")
+QTAIL = struct.Struct("!HH")
+
+def skip_name(data,offset):
+    """
+        Return offset following the encoded name at offset in data
+        (compression pointers are not followed)
+
+        >>> skip_name('\\x03abc\\x00\\xc0\\x00',0)
+        5
+        >>> skip_name('\\x03abc\\x00\\xc0\\x00',5)
+        7
+        >>> skip_name('\\x03abc',0)
+        Traceback (most recent call last):
+        ...
+        DNSError: Truncated name at offset 0
+    """
+    start = offset
+    end = len(data)
+    while offset < end:
+        length = ord(data[offset])
+        if length == 0:
+            return offset + 1
+        elif length & 0xc0 == 0xc0:
+            if offset + 2 > end:
+                break
+            return offset + 2
+        elif length & 0xc0:
+            raise DNSError("Invalid label type at offset %d" % offset)
+        offset += length + 1
+    raise DNSError("Truncated name at offset %d" % start)
+
+def parse_question(packet):
+    """
+        Fast path for routing/filtering queries - validate the header
+        and extract the (single) question without building a DNSRecord.
+
+        Returns (id,flags,qname wire bytes,lowercase qname,qtype,qclass,
+        offset of end of question)
+
+        The qname must not contain compression pointers and the packet
+        must contain exactly one question - otherwise DNSError is raised.
+
+        >>> packet = 'd5ad010000010000000000000377777706476f6f676c6503636f6d0000010001'.decode('hex')
+        >>> id,flags,wire,qname,qtype,qclass,end = parse_question(packet)
+        >>> (id,flags,qname,qtype,qclass,end)
+        (54701, 256, 'www.google.com', 1, 1, 32)
+        >>> wire
+        '\\x03www\\x06Google\\x03com\\x00'
+
+        >>> parse_question(packet[:20])
+        Traceback (most recent call last):
+        ...
+        DNSError: Truncated question
+        >>> parse_question(packet[:4] + '\\x00\\x02' + packet[6:])
+        Traceback (most recent call last):
+        ...
+        DNSError: Invalid question count: 2
+        >>> parse_question(packet[:12] + '\\xc0\\x0c\\x00\\x01\\x00\\x01')
+        Traceback (most recent call last):
+        ...
+        DNSError: Invalid label length: 192
+    """
+    end = len(packet)
+    if end < 17:
+        raise DNSError("Truncated question")
+    (id,flags,q,a,ns,ar) = HEADER.unpack_from(packet)
+    if q != 1:
+        raise DNSError("Invalid question count: %d" % q)
+    labels = []
+    offset = 12
+    length = ord(packet[offset])
+    while length:
+        if length > 63:
+            raise DNSError("Invalid label length: %d" % length)
+        start = offset + 1
+        offset = start + length
+        if offset >= end:
+            raise DNSError("Truncated question")
+        labels.append(packet[start:offset])
+        length = ord(packet[offset])
+    offset += 1
+    if offset + 4 > end:
+        raise DNSError("Truncated question")
+    if offset > 267:
+        raise DNSError("Domain name too long")
+    (qtype,qclass) = QTAIL.unpack_from(packet,offset)
+    return (id,flags,packet[12:offset],".".join(labels).lower(),
+            qtype,qclass,offset + 4)
+
+def authority_soa(packet):
+    """
+        Owner name (DNSLabel) of the first SOA RR in the authority
+        section of a packed message (or None) - eg. the zone of a
+        cached NXDOMAIN response
+
+        >>> q = DNSRecord(q=DNSQuestion("xyz.abc.com"))
+        >>> r = DNSRecord(DNSHeader(id=q.header.id,qr=1,rcode=3),q=q.q)
+        >>> r.add_ns(RR("abc.com",QTYPE.SOA,
+        ...             rdata=SOA("ns.abc.com","admin.abc.com",(1,2,3,4,5))))
+        >>> authority_soa(r.pack())
+        'abc.com'
+        >>> authority_soa(q.reply("1.2.3.4").pack()) is None
+        True
+    """
+    packet = str(packet)
+    end = len(packet)
+    if end < 12:
+        raise DNSError("Truncated header")
+    (id,flags,q,a,ns,ar) = HEADER.unpack_from(packet)
+    offset = 12
+    for i in xrange(q):
+        offset = skip_name(packet,offset) + 4
+    for i in xrange(a + ns):
+        start = offset
+        offset = skip_name(packet,offset)
+        if offset + 10 > end:
+            raise DNSError("Truncated RR at offset %d" % start)
+        rtype,rclass,ttl,rdlength = struct.unpack_from("!HHIH",packet,offset)
+        if i >= a and rtype == QTYPE.SOA:
+            buffer = DNSBuffer(packet)
+            buffer.offset = start
+            return buffer.decode_name()
+        offset += 10 + rdlength
+    return None
+
+class DNSWire(object):
+
+    """
+    Wire-level view of a packed DNS message.
+
+    The packet is scanned once to record the offset of the TTL field
+    of every RR (OPT pseudo-RRs are skipped). The message can then be
+    rewritten (header id, RD/CD flags, TTLs) with struct.pack_into
+    on a bytearray copy rather than a DNSRecord.parse/pack round trip.
+
+    >>> packet = 'd5ad818000010005000000000377777706676f6f676c6503636f6d0000010001c00c0005000100000005000803777777016cc010c02c0001000100000005000442f95b68c02c0001000100000005000442f95b63c02c0001000100000005000442f95b67c02c0001000100000005000442f95b93'.decode('hex')
+    >>> w = DNSWire(packet)
+    >>> w.ttl_offsets
+    [38, 58, 74, 90, 106]
+    >>> w.ttls
+    [5, 5, 5, 5, 5]
+    >>> w.min_ttl
+    5
+    >>> d = DNSRecord.parse(w.rewrite(id=1234,age=3))
+    >>> d.header.id
+    1234
+    >>> [rr.ttl for rr in d.rr]
+    [2, 2, 2, 2, 2]
+    >>> [rr.ttl for rr in DNSRecord.parse(w.rewrite(ttl=30)).rr]
+    [30, 30, 30, 30, 30]
+
+    Copy RD/CD flags from request:
+
+    >>> d = DNSRecord.parse(w.rewrite(rd=0,cd=1))
+    >>> print d.header
+    <DNS Header: id=0xd5ad type=RESPONSE opcode=QUERY flags=RA rcode=None q=1 a=5 ns=0 ar=0>
+    >>> d.header.bitmap & CD_BIT
+    16
+
+    Append RR to additional section:
+
+    >>> d = DNSRecord.parse(w.rewrite(additional="\\x00\\x00\\x29\\x10\\x00\\x00\\x00\\x00\\x00\\x00\\x00"))
+    >>> d.header.ar, d.ar[0].rtype, d.ar[0].rclass
+    (1, 41, 4096)
+
+    Malformed packets raise DNSError:
+
+    >>> DNSWire(packet[:-2])
+    Traceback (most recent call last):
+    ...
+    DNSError: Truncated RR at offset 100
+
+    """
+
+    def __init__(self,packet):
+        self.packet = packet
+        self.ttl_offsets = []
+        self.ttls = []
+        self.scan()
+
+    def scan(self):
+        """
+            Record header fields and TTL offsets
+        """
+        packet = self.packet
+        end = len(packet)
+        if end < 12:
+            raise DNSError("Truncated header")
+        (self.id,self.bitmap,q,a,ns,ar) = struct.unpack_from("!HHHHHH",packet)
+        offset = 12
+        for i in xrange(q):
+            offset = skip_name(packet,offset) + 4
+        if offset > end:
+            raise DNSError("Truncated question")
+        for i in xrange(a + ns + ar):
+            start = offset
+            offset = skip_name(packet,offset)
+            if offset + 10 > end:
+                raise DNSError("Truncated RR at offset %d" % start)
+            rtype,rclass,ttl,rdlength = struct.unpack_from("!HHIH",packet,offset)
+            if rtype != OPT:
+                self.ttl_offsets.append(offset + 4)
+                self.ttls.append(ttl)
+            offset += 10 + rdlength
+            if offset > end:
+                raise DNSError("Truncated RR at offset %d" % start)
+        self.end = offset
+
+    def get_min_ttl(self):
+        return self.ttls and min(self.ttls) or 0
+
+    min_ttl = property(get_min_ttl)
+
+    def rewrite(self,id=None,age=0,rd=None,cd=None,ttl=None,additional=None):
+        """
+            Return copy of packet (as bytearray) with header id and RD/CD
+            flags replaced and TTLs reduced by age seconds (if specified)
+            or set to ttl (if specified) - additional is a packed RR
+            (eg. OPT) appended to the additional section
+        """
+        data = bytearray(self.packet)
+        if additional:
+            data[self.end:] = additional
+            (ar,) = struct.unpack_from("!H",data,10)
+            struct.pack_into("!H",data,10,ar + 1)
+        if id is not None:
+            struct.pack_into("!H",data,0,id)
+        if rd is not None or cd is not None:
+            bitmap = self.bitmap
+            if rd is not None:
+                bitmap = set_bits(bitmap,rd,8)
+            if cd is not None:
+                bitmap = set_bits(bitmap,cd,4)
+            struct.pack_into("!H",data,2,bitmap)
+        if ttl is not None:
+            pack_into = struct.pack_into
+            for offset in self.ttl_offsets:
+                pack_into("!I",data,offset,ttl)
+        elif age:
+            pack_into = struct.pack_into
+            for offset,ttl in zip(self.ttl_offsets,self.ttls):
+                pack_into("!I",data,offset,ttl > age and ttl - age or 0)
+        return data
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,572 @@
+
+"""
+    Authoritative zone store
+
+    ZoneStore indexes the RRs of a zone by owner name (lowercase label
+    tuple) and type and answers requests for the zone (exact matches,
+    CNAME, wildcards - RFC 4592 - and NXDOMAIN/NODATA responses with the
+    SOA in the authority section). Records can also be synthesized at
+    query time for large address ranges (see synth.SynthRange and
+    add_synthesizer).
+
+    Negative fast path: a Bloom filter over all names which exist in the
+    zone (owner names and empty non-terminals) is built when the zone is
+    loaded and updated as names are added. Requests for names which are
+    not in the filter (and which no wildcard could match) are answered
+    with a precomputed NXDOMAIN response - the header and question are
+    copied from the request and the authority section (SOA) is already
+    packed - without walking the zone index or packing a DNSRecord. This
+    is most of the traffic in a random-subdomain attack. Names removed
+    from the zone remain in the filter (and are answered from the index)
+    until the zone is reloaded.
+
+    >>> soa = RR("abc.com",QTYPE.SOA,ttl=3600,
+    ...          rdata=SOA("ns1.abc.com","admin.abc.com",(1,7200,900,1209600,300)))
+    >>> zone = ZoneStore("abc.com",[soa,
+    ...                  RR("abc.com",QTYPE.NS,ttl=3600,rdata=NS("ns1.abc.com")),
+    ...                  RR("ns1.abc.com",QTYPE.A,ttl=3600,rdata=A("1.2.3.4")),
+    ...                  RR("www.abc.com",QTYPE.CNAME,ttl=3600,rdata=CNAME("web.abc.com")),
+    ...                  RR("web.a.b.abc.com",QTYPE.A,ttl=300,rdata=A("5.6.7.8")),
+    ...                  RR("*.wild.abc.com",QTYPE.TXT,ttl=300,rdata=TXT("wildcard"))])
+    >>> resolver = ZoneResolver(zone)
+    >>> def query(name,qtype="A"):
+    ...     reply = resolver.resolve(DNSRecord(q=DNSQuestion(name,getattr(QTYPE,qtype))),None)
+    ...     if not isinstance(reply,DNSRecord):
+    ...         reply = DNSRecord.parse(str(reply))
+    ...     print reply
+    >>> query("NS1.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Question: 'NS1.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'ns1.abc.com' rtype=A rclass=IN ttl=3600 rdata='1.2.3.4'>
+    >>> query("www.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Question: 'www.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'www.abc.com' rtype=CNAME rclass=IN ttl=3600 rdata='web.abc.com'>
+    >>> query("x.wild.abc.com","TXT")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Question: 'x.wild.abc.com' qtype=TXT qclass=IN>
+    <DNS RR: 'x.wild.abc.com' rtype=TXT rclass=IN ttl=300 rdata='wildcard'>
+
+    Empty non-terminals and missing types return NODATA:
+
+    >>> query("a.b.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=0 ns=1 ar=0>
+    <DNS Question: 'a.b.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'abc.com' rtype=SOA rclass=IN ttl=300 rdata='ns1.abc.com:admin.abc.com:1:7200:900:1209600:300'>
+
+    Nonexistent names use the fast path (the response is the same as the
+    response built from the index):
+
+    >>> query("random123.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=Name Error q=1 a=0 ns=1 ar=0>
+    <DNS Question: 'random123.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'abc.com' rtype=SOA rclass=IN ttl=300 rdata='ns1.abc.com:admin.abc.com:1:7200:900:1209600:300'>
+    >>> zone.fast
+    1
+    >>> slow = ZoneResolver(ZoneStore("abc.com",zone.records(),bloom=False))
+    >>> request = DNSRecord(q=DNSQuestion("random123.abc.com"))
+    >>> str(DNSRecord.parse(str(resolver.resolve(request,None)))) == \\
+    ...     str(DNSRecord.parse(slow.resolve(request,None).pack()))
+    True
+    >>> query("xyz.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=Refused q=1 a=0 ns=0 ar=0>
+    <DNS Question: 'xyz.com' qtype=A qclass=IN>
+
+    UPDATE (RFC 2136 - update section only) - refused unless enabled
+    with allow_update:
+
+    >>> update = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("abc.com",QTYPE.SOA))
+    >>> update.add_ns(RR("new.abc.com",QTYPE.A,ttl=60,rdata=A("9.9.9.9")))
+    >>> update.add_ns(RR("ns1.abc.com",QTYPE['*'],rclass=255))
+    >>> print resolver.resolve(update,None).header
+    <DNS Header: id=... type=RESPONSE opcode=UPDATE flags=AA,RD,RA rcode=Refused zo=1 pr=0 up=0 ad=0>
+    >>> updater = ZoneResolver(zone,allow_update=True)
+    >>> print updater.resolve(update,None).header
+    <DNS Header: id=... type=RESPONSE opcode=UPDATE flags=AA,RD,RA rcode=None zo=1 pr=0 up=0 ad=0>
+    >>> query("new.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=None q=1 a=1 ns=0 ar=0>
+    <DNS Question: 'new.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'new.abc.com' rtype=A rclass=IN ttl=60 rdata='9.9.9.9'>
+    >>> query("ns1.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=Name Error q=1 a=0 ns=1 ar=0>
+    <DNS Question: 'ns1.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'abc.com' rtype=SOA rclass=IN ttl=300 rdata='ns1.abc.com:admin.abc.com:2:7200:900:1209600:300'>
+
+    The SOA and NS RRsets at the apex cannot be deleted (RFC 2136
+    3.4.2.3/3.4.2.4) and the SOA serial is incremented when the zone
+    changes (3.6):
+
+    >>> update = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("abc.com",QTYPE.SOA))
+    >>> update.add_ns(RR("abc.com",QTYPE['*'],rclass=255))
+    >>> update.add_ns(RR("abc.com",QTYPE.SOA,rclass=254,rdata=zone.soa.rdata))
+    >>> update.add_ns(RR("abc.com",QTYPE.NS,rclass=254,rdata=NS("ns1.abc.com")))
+    >>> zone.update(update)
+    0
+    >>> sorted([ QTYPE[t] for t in zone.names[("abc","com")] ]), zone.soa.rdata.times[0]
+    (['NS', 'SOA'], 2)
+    >>> update = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("abc.com",QTYPE.SOA))
+    >>> update.add_ns(RR("abc.com",QTYPE.TXT,ttl=60,rdata=TXT("txt")))
+    >>> update.add_ns(RR("abc.com",QTYPE.NS,rclass=255))
+    >>> zone.update(update)
+    0
+    >>> sorted([ QTYPE[t] for t in zone.names[("abc","com")] ]), zone.soa.rdata.times[0]
+    (['NS', 'SOA', 'TXT'], 3)
+    >>> query("nx.abc.com")
+    <DNS Header: id=... type=RESPONSE opcode=QUERY flags=AA,RD,RA rcode=Name Error q=1 a=0 ns=1 ar=0>
+    <DNS Question: 'nx.abc.com' qtype=A qclass=IN>
+    <DNS RR: 'abc.com' rtype=SOA rclass=IN ttl=300 rdata='ns1.abc.com:admin.abc.com:3:7200:900:1209600:300'>
+
+    A new SOA is only accepted if its serial is newer:
+
+    >>> update = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("abc.com",QTYPE.SOA))
+    >>> update.add_ns(RR("abc.com",QTYPE.SOA,ttl=3600,
+    ...               rdata=SOA("ns1.abc.com","admin.abc.com",(2,7200,900,1209600,300))))
+    >>> zone.update(update), zone.soa.rdata.times[0]
+    (0, 3)
+    >>> update.ns[0].rdata = SOA("ns1.abc.com","admin.abc.com",(10,7200,900,1209600,300))
+    >>> zone.update(update), zone.soa.rdata.times[0], len(zone.names[("abc","com")][QTYPE.SOA])
+    (0, 10, 1)
+
+    >>> other = DNSRecord(DNSHeader(opcode=5),q=DNSQuestion("xyz.com",QTYPE.SOA))
+    >>> print updater.resolve(other,None).header
+    <DNS Header: id=... type=RESPONSE opcode=UPDATE flags=AA,RD,RA rcode=NOTAUTH zo=1 pr=0 up=0 ad=0>
+    >>> print resolver.resolve(DNSRecord(DNSHeader(opcode=2),q=DNSQuestion("abc.com")),None).header
+    <DNS Header: id=... type=RESPONSE opcode=STATUS flags=AA,RD,RA rcode=Not Implemented q=1 a=0 ns=0 ar=0>
+
+"""
+
+import hashlib,math,struct,threading
+
+from dns import DNSRecord,DNSHeader,DNSQuestion,RR,A,NS,CNAME,SOA,TXT,QTYPE,RCODE, \
+                OPCODE
+from label import DNSLabel,DNSBuffer
+from cache import pack_labels
+
+def serial_newer(a,b):
+    """
+        Serial number a is newer than b (RFC 1982)
+
+        >>> serial_newer(2,1), serial_newer(1,2), serial_newer(0,0xffffffff)
+        (True, False, True)
+    """
+    return 0 < (a - b) % (1 << 32) < (1 << 31)
+
+class BloomFilter(object):
+
+    """
+    Bloom filter sized for capacity keys with false positive rate
+    error_rate (k bit positions per key from a single md5 digest using
+    double hashing)
+
+    >>> f = BloomFilter(1000,0.01)
+    >>> for i in range(1000):
+    ...     f.add("key%d" % i)
+    >>> all([ ("key%d" % i) in f for i in range(1000) ])
+    True
+    >>> len([ i for i in range(10000) if ("other%d" % i) in f ]) < 300
+    True
+    >>> f.size, f.hashes
+    (9586, 7)
+    """
+
+    def __init__(self,capacity,error_rate=0.01):
+        capacity = max(capacity,1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1,int(round(float(self.size) / capacity *
+                                      math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self,key):
+        h1,h2 = struct.unpack("!QQ",hashlib.md5(key).digest())
+        size = self.size
+        return [ (h1 + i * h2) % size for i in xrange(self.hashes) ]
+
+    def add(self,key):
+        bits = self.bits
+        for p in self.positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self,key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+class ZoneStore(object):
+
+    """
+    Zone data for origin
+
+        records     - iterable of RRs
+        bloom       - build Bloom filter for negative fast path
+        error_rate  - Bloom filter false positive rate
+
+    The number of requests answered by the fast path is counted in fast.
+
+    Requests are answered and updates/reloads applied under self.lock (so
+    that updates are never seen half applied).
+    """
+
+    def __init__(self,origin,records=(),bloom=True,error_rate=0.01):
+        self.origin = DNSLabel(origin)
+        self.origin_key = self.key(self.origin)
+        self.bloom = bloom
+        self.error_rate = error_rate
+        self.fast = 0
+        # domain key -> [synthesizer] (kept across reloads)
+        self.synthesizers = {}
+        self.lock = threading.Lock()
+        self.load(records)
+
+    def key(self,name):
+        """
+            Index key - lowercase label tuple
+        """
+        if not isinstance(name,DNSLabel):
+            name = DNSLabel(name)
+        return tuple([ l.lower() for l in name.label ])
+
+    def load(self,records):
+        """
+            (Re)load zone from RRs and rebuild Bloom filter
+        """
+        with self.lock:
+            self._load(records)
+
+    def _load(self,records):
+        # owner key -> {rtype:[RR]}
+        self.names = {}
+        # existing names (owners and empty non-terminals) -> owner count
+        self.nodes = {}
+        # names below which answers may be synthesized (wildcard parents)
+        self.wildcards = set()
+        self.filter = None
+        self.soa = None
+        self.nx_authority = None
+        for rr in records:
+            self.add(rr)
+        self.build_filter()
+
+    def build_filter(self,capacity=None):
+        """
+            Build Bloom filter over existing names
+        """
+        if not self.bloom:
+            return
+        if capacity is None:
+            capacity = max(len(self.nodes) * 2,1024)
+        f = BloomFilter(capacity,self.error_rate)
+        for key in self.nodes:
+            f.add(pack_labels(key))
+        self.filter = f
+
+    def add_synthesizer(self,synth):
+        """
+            Add synthesizer (eg. synth.SynthRange) for its domains in this
+            zone - synth.lookup(key,qname) is called for names below these
+            domains which are not in the zone and returns {rtype:[RR]}
+            (or None if the name does not exist)
+        """
+        for domain in synth.domains():
+            if self.in_zone(domain):
+                self.synthesizers.setdefault(domain,[]).append(synth)
+
+    def records(self):
+        """
+            Return all RRs
+        """
+        return [ rr for node in self.names.values()
+                        for rrs in node.values() for rr in rrs ]
+
+    def in_zone(self,key):
+        n = len(self.origin_key)
+        return len(key) >= n and key[len(key) - n:] == self.origin_key
+
+    def ancestors(self,key):
+        """
+            Key and its ancestors down to origin
+        """
+        return [ key[i:] for i in xrange(len(key) - len(self.origin_key) + 1) ]
+
+    def add(self,rr):
+        """
+            Add RR (duplicate RRs are ignored) - returns True if the RR
+            was added
+        """
+        key = self.key(rr.rname)
+        if not self.in_zone(key):
+            raise ValueError("RR not in zone %s: %s" % (self.origin,rr.rname))
+        node = self.names.get(key)
+        if node is None:
+            node = self.names[key] = {}
+            for name in self.ancestors(key):
+                self.nodes[name] = self.nodes.get(name,0) + 1
+                if self.filter is not None:
+                    self.filter.add(pack_labels(name))
+            if key[0] == '*':
+                self.wildcards.add(key[1:])
+            if self.filter is not None and \
+                    self.filter.count > self.filter.capacity:
+                self.build_filter()
+        rrs = node.setdefault(rr.rtype,[])
+        if [ r for r in rrs if str(r.rdata) == str(rr.rdata) ]:
+            return False
+        rrs.append(rr)
+        if rr.rtype == QTYPE.SOA and key == self.origin_key:
+            self.set_soa(rr)
+        return True
+
+    def remove(self,name,rtype=None,rdata=None):
+        """
+            Remove RRs for name (all types if rtype is None, all RRs of
+            rtype if rdata is None) - returns True if any RR was removed
+        """
+        key = self.key(name)
+        node = self.names.get(key)
+        if node is None:
+            return False
+        removed = False
+        for t in (rtype is None and node.keys() or [rtype]):
+            if t not in node:
+                continue
+            if rdata is not None:
+                rrs = [ rr for rr in node[t] if str(rr.rdata) != str(rdata) ]
+                if len(rrs) == len(node[t]):
+                    continue
+                if rrs:
+                    node[t] = rrs
+                    removed = True
+                    continue
+            del node[t]
+            removed = True
+            if t == QTYPE.SOA and key == self.origin_key:
+                self.set_soa(None)
+        if not node:
+            del self.names[key]
+            for name in self.ancestors(key):
+                self.nodes[name] -= 1
+                if not self.nodes[name]:
+                    del self.nodes[name]
+            if key[0] == '*':
+                self.wildcards.discard(key[1:])
+        return removed
+
+    def update(self,record):
+        """
+            Apply update section of DNS UPDATE message (RFC 2136 3.4.2 -
+            prerequisites are not checked) - returns rcode
+
+            The apex SOA/NS RRsets are never deleted (the last apex NS RR
+            is kept), an added SOA replaces the current SOA only if its
+            serial is newer and the SOA serial is incremented if the zone
+            changed (3.6)
+        """
+        with self.lock:
+            for rr in record.ns:
+                if not self.in_zone(self.key(rr.rname)):
+                    return RCODE.lookup('NOTZONE')
+            changed = new_soa = False
+            for rr in record.ns:
+                key = self.key(rr.rname)
+                apex = key == self.origin_key
+                if rr.rclass == 255:
+                    if rr.rtype == QTYPE['*']:
+                        types = self.names.get(key,{}).keys()
+                    else:
+                        types = [rr.rtype]
+                    for t in types:
+                        if apex and t in (QTYPE.SOA,QTYPE.NS):
+                            continue
+                        changed = self.remove(rr.rname,t) or changed
+                elif rr.rclass == 254:
+                    if rr.rtype == QTYPE.SOA:
+                        continue
+                    if apex and rr.rtype == QTYPE.NS:
+                        ns = self.names.get(key,{}).get(QTYPE.NS,[])
+                        if not [ r for r in ns if str(r.rdata) != str(rr.rdata) ]:
+                            continue
+                    changed = self.remove(rr.rname,rr.rtype,rr.rdata) or changed
+                elif rr.rtype == QTYPE.SOA:
+                    if apex and (self.soa is None or
+                                 serial_newer(rr.rdata.times[0],
+                                              self.soa.rdata.times[0])):
+                        self.names[key].pop(QTYPE.SOA,None)
+                        self.add(rr)
+                        new_soa = True
+                else:
+                    changed = self.add(rr) or changed
+            if changed and not new_soa and self.soa is not None:
+                self.increment_serial()
+            return 0
+
+    def increment_serial(self):
+        """
+            Replace SOA with copy with serial incremented
+        """
+        soa = self.soa
+        times = ((soa.rdata.times[0] + 1) & 0xffffffff,) + tuple(soa.rdata.times[1:])
+        rr = RR(soa.rname,QTYPE.SOA,soa.rclass,soa.ttl,
+                SOA(soa.rdata.mname,soa.rdata.rname,times))
+        self.names[self.origin_key][QTYPE.SOA] = [rr]
+        self.set_soa(rr)
+
+    def set_soa(self,rr):
+        """
+            Set SOA and precompute packed NXDOMAIN authority section
+            (uncompressed SOA RR with negative TTL - RFC 2308)
+        """
+        self.soa = rr
+        self.nx_authority = None
+        if rr is None:
+            return
+        buffer = DNSBuffer()
+        buffer.encode_name_nocompress(rr.rname)
+        buffer.pack("!HHIH",QTYPE.SOA,rr.rclass,self.negative_ttl(),0)
+        start = buffer.offset
+        buffer.encode_name_nocompress(rr.rdata.mname)
+        buffer.encode_name_nocompress(rr.rdata.rname)
+        buffer.pack("!IIIII",*rr.rdata.times)
+        buffer.update(start - 2,"!H",buffer.offset - start)
+        self.nx_authority = buffer.data
+
+    def negative_ttl(self):
+        return min(self.soa.ttl,self.soa.rdata.times[-1])
+
+    def negative_soa(self):
+        soa = self.soa
+        return RR(soa.rname,QTYPE.SOA,soa.rclass,self.negative_ttl(),soa.rdata)
+
+    def nonexistent(self,key):
+        """
+            True if name is definitely not in zone (not in Bloom filter)
+            and no answer could be synthesized for it
+        """
+        if self.filter is None or self.nx_authority is None or \
+                pack_labels(key) in self.filter:
+            return False
+        if self.wildcards or self.synthesizers:
+            for name in self.ancestors(key):
+                if name in self.wildcards or name in self.synthesizers:
+                    return False
+        return True
+
+    def nxdomain(self,request):
+        """
+            Packed NXDOMAIN response for request (header flags as
+            server.base.make_reply)
+        """
+        q = request.q
+        bitmap = (request.header.bitmap & 0x7b70) | 0x8480 | \
+                 RCODE.lookup('Name Error')
+        return struct.pack("!HHHHHH",request.header.id,bitmap,1,0,1,0) + \
+               pack_labels(q.qname.label) + "\x00" + \
+               struct.pack("!HH",q.qtype,q.qclass) + self.nx_authority
+
+    def reply(self,request,rcode=0):
+        header = DNSHeader(id=request.header.id,bitmap=request.header.bitmap,
+                           qr=1,aa=1,ra=1,rcode=rcode)
+        return DNSRecord(header,questions=list(request.questions))
+
+    def lookup(self,key,qname):
+        """
+            Return {rtype:[RR]} for name (synthesized or from wildcard if
+            needed - owner is rewritten to qname) or None if the name does
+            not exist
+        """
+        node = self.names.get(key)
+        if node is not None or key in self.nodes:
+            return node or {}
+        if self.synthesizers:
+            for name in self.ancestors(key):
+                for synth in self.synthesizers.get(name,()):
+                    node = synth.lookup(key,qname)
+                    if node is not None:
+                        return node
+        # Wildcard at closest encloser
+        for name in self.ancestors(key)[1:]:
+            if name in self.nodes:
+                node = self.names.get(('*',) + name)
+                if node is None:
+                    return None
+                return dict([ (t,[ RR(qname,rr.rtype,rr.rclass,rr.ttl,rr.rdata)
+                                        for rr in rrs ])
+                                    for t,rrs in node.items() ])
+        return None
+
+    def answer(self,request):
+        """
+            Answer request - returns DNSRecord (or packed NXDOMAIN
+            response from fast path)
+        """
+        with self.lock:
+            return self._answer(request)
+
+    def _answer(self,request):
+        q = request.q
+        key = self.key(q.qname)
+        if not self.in_zone(key):
+            return self.reply(request,RCODE.lookup('Refused'))
+        if self.nonexistent(key):
+            self.fast += 1
+            return self.nxdomain(request)
+        node = self.lookup(key,q.qname)
+        if node is None:
+            reply = self.reply(request,RCODE.lookup('Name Error'))
+            if self.soa is not None:
+                reply.add_ns(self.negative_soa())
+            return reply
+        reply = self.reply(request)
+        if q.qtype == QTYPE['*']:
+            rrs = [ rr for t in sorted(node) for rr in node[t] ]
+        else:
+            rrs = node.get(q.qtype) or node.get(QTYPE.CNAME) or []
+        for rr in rrs:
+            reply.add_answer(rr)
+        if not rrs and self.soa is not None:
+            reply.add_ns(self.negative_soa())
+        return reply
+
+class ZoneResolver(object):
+
+    """
+    Resolver (see server.base.BaseResolver) answering from ZoneStore
+
+    UPDATE requests are applied to the zone (ZoneStore.update) if
+    allow_update is True (there is no access control - only enable for
+    trusted clients) and refused otherwise. Other opcodes are answered
+    with NOTIMP.
+    """
+
+    def __init__(self,zone,allow_update=False):
+        self.zone = zone
+        self.allow_update = allow_update
+
+    def resolve(self,request,client):
+        opcode = request.header.opcode
+        if opcode == OPCODE.lookup('QUERY'):
+            return self.zone.answer(request)
+        elif opcode == OPCODE.lookup('UPDATE'):
+            return self.zone.reply(request,self.update(request))
+        return self.zone.reply(request,RCODE.lookup('Not Implemented'))
+
+    def update(self,request):
+        """
+            Apply UPDATE request - returns rcode
+        """
+        if not self.allow_update:
+            return RCODE.lookup('Refused')
+        if len(request.questions) != 1 or request.q.qtype != QTYPE.SOA:
+            return RCODE.lookup('Format Error')
+        if self.zone.key(request.q.qname) != self.zone.origin_key:
+            return RCODE.lookup('NOTAUTH')
+        return self.zone.update(request)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -25,7 +25,7 @@ setup(name='dnslib',
       author_email = 'paul.chakravarti@gmail.com',
       url = 'http://bitbucket.org/paulc/dnslib/',
       cmdclass = { 'readme' : GenerateReadme },
-      packages = ['dnslib','dnslib.server'],
+      packages = ['dnslib','dnslib.server','dnslib.tools'],
       license = 'BSD',
       classifiers = [ "Topic :: Internet :: Name Service (DNS)" ],
      )